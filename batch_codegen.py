@@ -0,0 +1,334 @@
+"""
+batch_codegen.py
+
+Generate behave step modules for a whole directory of .feature files in one go.
+
+Every feature is parsed and resolved against the mappings store in parallel (process pool).
+Step definitions that more than one feature uses go into steps/common_steps.py (merged once, so
+behave never sees the same pattern registered twice); the rest go into one steps/<feature>_steps.py
+module per feature. Modules are written with splice_step_module, so hand edits in previously
+generated modules survive, and a manifest (steps/codegen_manifest.json) records which mapping
+produced which function plus an input hash per module: modules whose inputs did not change are not
+regenerated or rewritten on the next run. When a definition moves between modules (a second feature
+starts using it) or stops being used, the manifest says where it was generated before: the old copy is
+deleted if it was not edited, else reported as a conflict. A module that does not parse is left
+alone and reported. steps/step_dispatch.py (build_dispatch_module) indexes every
+generated definition so behave looks steps up in near-constant time.
+
+Usage:
+    python batch_codegen.py features/ --out . --store mappings_store.json \
+        --import "from myhelpers import Rubrik" --inst "rubrik = Rubrik()" [--lazy-helpers]
+"""
+
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import llm_utils
+import parser_utils_V3 as pu
+from step_clusters import iter_feature_files
+
+MANIFEST_FILE = "codegen_manifest.json"
+COMMON_MODULE = "common_steps.py"
+DISPATCH_MODULE = "step_dispatch.py"
+MANIFEST_VERSION = 3
+
+_STORE = {}
+
+
+def _init_worker(store: Dict[str, Any]) -> None:
+    # the store is shipped to each worker once instead of with every job
+    global _STORE
+    _STORE = store
+
+
+def resolve_feature(path: str, store: Dict[str, Any] = None, hoist: bool = True,
+                    default_instances: Dict[str, str] = None) -> Dict[str, Any]:
+    """Parse one feature and look up every step in the store: {'path', 'steps', 'calls', 'mapping_keys'}."""
+    store = _STORE if store is None else store
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        steps = pu.extract_steps_with_inheritance(f.read())
+    calls, mapping_keys = [], []
+    for s in steps:
+        mapping = pu.suggest_mapping_for_step(s["text"], store) or {}
+        calls.append([dict(c) for c in mapping.get("calls", [])])
+        mapping_keys.append(pu.make_step_key(s["text"]) if mapping else None)
+    if hoist:
+        calls, _ = pu.hoist_fetcher_calls(steps, calls, default_instances)
+    return {"path": path, "steps": steps, "calls": calls, "mapping_keys": mapping_keys}
+
+
+def _resolve_job(job: Tuple[str, bool, Dict[str, str]]) -> Dict[str, Any]:
+    return resolve_feature(job[0], hoist=job[1], default_instances=job[2])
+
+
+def module_name_for(path: str) -> str:
+    stem = os.path.basename(path)
+    stem = stem[:-len(".feature")] if stem.endswith(".feature") else stem
+    return re.sub(r"\W+", "_", stem).strip("_").lower() + "_steps.py"
+
+
+def _module_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Generate (splice) one module; runs in a worker process."""
+    prefix = "context." if job["lazy"] else ""
+    impls, merge_report = pu.generate_step_definitions(job["steps"], job["calls"], job["default_instances"],
+                                                       set(), prefix, job["registered"], job["case_sensitive"])
+    existing = ""
+    if os.path.exists(job["file"]):
+        with open(job["file"], "r", encoding="utf-8", errors="ignore") as f:
+            existing = f.read()
+    try:
+        text, splice_report = pu.splice_step_module(existing, job["imports"], job["insts"], impls, job["remove"],
+                                                    job["case_sensitive"])
+    except SyntaxError as e:
+        # regenerating would throw away the hand edits in it: leave the module alone and report it
+        return {"file": job["file"], "text": None, "changed": False, "merge": merge_report,
+                "error": f"does not parse ({e.msg}, line {e.lineno}); not updated", "kept_stale": []}
+    return {"file": job["file"], "text": text, "changed": text != existing, "merge": merge_report,
+            "splice": {k: len(v) for k, v in splice_report.items()}, "kept_stale": splice_report["kept_stale"]}
+
+
+def _functions_for(module: str, steps: List[Dict[str, Any]], keys: List[str],
+                   calls: List[List[Dict[str, Any]]], origins: List[str],
+                   case_sensitive: bool = True) -> List[Dict[str, Any]]:
+    """Manifest rows: one per generated definition, with the mapping(s) and features behind it."""
+    rows = {}
+    for step, key, chain, origin in zip(steps, keys, calls, origins):
+        kind, pattern = pu.step_definition_key(step, case_sensitive)
+        row = rows.setdefault((kind, pattern), {"module": module, "kind": kind, "pattern": step["text"],
+                                                "definition": pattern, "mapping_keys": [], "features": []})
+        if key and key not in row["mapping_keys"]:
+            row["mapping_keys"].append(key)
+        if origin not in row["features"]:
+            row["features"].append(origin)
+        row.setdefault("mapping_hash", llm_utils.fingerprint(chain)[:12])
+    return list(rows.values())
+
+
+def registration_conflicts(steps_dir: str, out_dir: str, case_sensitive: bool = True) -> List[Dict[str, Any]]:
+    """
+    Load the step modules the way behave does (steps/*.py in name order, one registry) and report
+    every definition behave would reject with AmbiguousStep, e.g. a hand-written or edited one.
+    """
+    definitions = []
+    for name in sorted(os.listdir(steps_dir)):
+        if not name.endswith(".py"):
+            continue
+        with open(os.path.join(steps_dir, name), "r", encoding="utf-8", errors="ignore") as f:
+            try:
+                found = pu.extract_step_definitions(f.read())
+            except SyntaxError:
+                continue   # reported as unparseable
+        definitions.extend(dict(d, module=os.path.relpath(os.path.join(steps_dir, name), out_dir)) for d in found)
+    out = []
+    for c in pu.registration_conflicts(definitions, case_sensitive):
+        d, existing = definitions[c["definition"]], definitions[c["existing"]]
+        out.append({"module": d["module"], "kind": d["kind"], "pattern": d["pattern"], "steps": [],
+                    "reason": f"behave raises AmbiguousStep at load: @{existing['kind']}({existing['pattern']!r}) "
+                              f"in {existing['module']} (line {existing['line']}) already matches it"})
+    return out
+
+
+def generate_steps_package(paths: List[str], out_dir: str, store: Dict[str, Any], imports: List[str],
+                           instantiations: List[str], lazy_helpers: bool = False, hoist: bool = True,
+                           max_workers: int = None, force: bool = False, dispatch: bool = True,
+                           case_sensitive: bool = True) -> Dict[str, Any]:
+    """
+    Generate <out_dir>/steps/common_steps.py plus one module per feature (see module docstring).
+    Returns a report: {'features', 'modules_written', 'modules_skipped', 'common_definitions',
+    'conflicts', 'invalid_mappings', 'unparseable_modules', 'manifest'}. Steps whose mapping is not
+    valid Python are left out of their module and listed in 'invalid_mappings'. Definitions recorded
+    in the previous manifest that moved to another module (or are no longer used) are removed from
+    their old module when unedited, else reported as conflicts. Modules that do not parse are not
+    touched and are listed in 'unparseable_modules'. A definition that behave would reject as
+    ambiguous with one registered before it (in its own module or a module loaded earlier) is not
+    generated, and any that remain in the written package are reported as conflicts.
+    Step wordings that differ only in case are separate definitions, as behave 1.3 matches
+    case-sensitively; case_sensitive=False merges them for behave 1.2.
+    """
+    features = list(iter_feature_files(paths))
+    steps_dir = os.path.join(out_dir, "steps")
+    os.makedirs(steps_dir, exist_ok=True)
+    manifest_path = os.path.join(steps_dir, MANIFEST_FILE)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("version") != MANIFEST_VERSION:
+            previous = {}
+
+    default_instances = {}
+    for line in instantiations:
+        m = re.match(r"\s*(\w+)\s*=\s*(\w+)\(", line)
+        if m:
+            default_instances[m.group(2)] = m.group(1)
+
+    parallel = len(features) > 1 and max_workers != 1
+    if parallel:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(store,)) as pool:
+            resolved = list(pool.map(_resolve_job, [(p, hoist, default_instances) for p in features], chunksize=4))
+    else:
+        resolved = [resolve_feature(p, store, hoist, default_instances) for p in features]
+
+    # a definition used by two or more features is shared
+    users = {}
+    for r in resolved:
+        for s in r["steps"]:
+            users.setdefault(pu.step_definition_key(s, case_sensitive), set()).add(r["path"])
+    common_keys = {k for k, who in users.items() if len(who) > 1}
+
+    if lazy_helpers:
+        mod_imports, mod_insts = [], []
+    else:
+        mod_imports, mod_insts = imports, instantiations
+
+    modules = {}   # file -> {'steps', 'calls', 'keys', 'origins'}
+    for r in resolved:
+        for s, c, k in zip(r["steps"], r["calls"], r["mapping_keys"]):
+            name = COMMON_MODULE if pu.step_definition_key(s, case_sensitive) in common_keys else module_name_for(r["path"])
+            mod = modules.setdefault(os.path.join(steps_dir, name), {"steps": [], "calls": [], "keys": [], "origins": []})
+            mod["steps"].append(s)
+            mod["calls"].append(c)
+            mod["keys"].append(k)
+            mod["origins"].append(r["path"])
+
+    # behave loads steps/*.py in name order: a module's definitions must get past those of the modules before it
+    registered, loaded = {}, []
+    for file in sorted(modules):
+        registered[file] = list(loaded)
+        loaded.extend(dict.fromkeys((s["kind"], pu.step_pattern_and_args(s)[0]) for s in modules[file]["steps"]))
+
+    options = [mod_imports, mod_insts, lazy_helpers, default_instances, case_sensitive]
+    manifest_modules, functions = {}, {}
+    for file, mod in modules.items():
+        rel = os.path.relpath(file, out_dir)
+        manifest_modules[rel] = {"input_hash": llm_utils.fingerprint([(s["kind"], s["text"]) for s in mod["steps"]],
+                                                                     mod["calls"], options, registered[file]),
+                                 "features": sorted(set(mod["origins"]))}
+        functions[rel] = _functions_for(rel, mod["steps"], mod["keys"], mod["calls"], mod["origins"], case_sensitive)
+
+    # definitions generated last time whose pattern now lives in another module, or in none (its
+    # features were removed or stopped using it): left in place behave would register them twice
+    location = {(row["kind"], row["definition"]): row["module"] for rows in functions.values() for row in rows}
+    stale = {}
+    for row in previous.get("functions", []):
+        key = (row["kind"], row["definition"])
+        if location.get(key) != row["module"]:
+            stale.setdefault(row["module"], []).append(key)
+
+    jobs, skipped = [], []
+    for rel in sorted(set(manifest_modules) | set(stale)):
+        file = os.path.join(out_dir, rel)
+        mod = modules.get(file)
+        if mod is None:
+            if os.path.exists(file):
+                jobs.append({"file": file, "steps": [], "calls": [], "default_instances": default_instances,
+                             "imports": [], "insts": [], "lazy": lazy_helpers, "remove": stale[rel], "registered": [],
+                             "case_sensitive": case_sensitive})
+            continue
+        unchanged = previous.get("modules", {}).get(rel, {}).get("input_hash") == manifest_modules[rel]["input_hash"]
+        if unchanged and not force and rel not in stale and os.path.exists(file):
+            skipped.append(rel)
+            continue
+        jobs.append({"file": file, "steps": mod["steps"], "calls": mod["calls"], "default_instances": default_instances,
+                     "imports": mod_imports, "insts": mod_insts, "lazy": lazy_helpers, "remove": stale.get(rel, []),
+                     "registered": registered[file], "case_sensitive": case_sensitive})
+
+    if len(jobs) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_module_job, jobs))
+    else:
+        results = [_module_job(j) for j in jobs]
+
+    written, conflicts, invalid, unparseable = [], [], [], []
+    previous_rows = {}
+    for row in previous.get("functions", []):
+        previous_rows.setdefault(row["module"], []).append(row)
+    for res in results:
+        rel = os.path.relpath(res["file"], out_dir)
+        conflicts.extend(dict(c, module=rel) for c in res["merge"]["conflicts"])
+        invalid.extend(dict(c, module=rel) for c in res["merge"]["invalid"])
+        kept = [row for row in previous_rows.get(rel, []) if row["definition"] in res["kept_stale"]]
+        conflicts.extend({"module": rel, "kind": row["kind"], "pattern": row["pattern"], "steps": [],
+                          "reason": "edited definition is no longer generated into this module (moved or unused); "
+                                    "remove it by hand or behave reports an ambiguous step"} for row in kept)
+        # still in the file: keep its manifest row so the next run reports it again until it is removed
+        functions.setdefault(rel, []).extend(kept)
+        if res.get("error"):
+            unparseable.append({"module": rel, "reason": res["error"]})
+            # the manifest keeps describing what is actually in the file, so the next run retries it
+            manifest_modules.pop(rel, None)
+            if rel in previous.get("modules", {}):
+                manifest_modules[rel] = previous["modules"][rel]
+            functions[rel] = previous_rows.get(rel, [])
+            continue
+        if res["changed"]:
+            with open(res["file"], "w", encoding="utf-8") as f:
+                f.write(res["text"])
+            written.append(os.path.relpath(res["file"], out_dir))
+    conflicts.extend(registration_conflicts(steps_dir, out_dir, case_sensitive))
+    if dispatch:
+        definitions = [(s["kind"], pu.step_pattern_and_args(s)[0]) for mod in modules.values() for s in mod["steps"]]
+        dispatch_path = os.path.join(steps_dir, DISPATCH_MODULE)
+        dispatch_text = pu.build_dispatch_module(definitions, case_sensitive)
+        old = None
+        if os.path.exists(dispatch_path):
+            with open(dispatch_path, "r", encoding="utf-8", errors="ignore") as f:
+                old = f.read()
+        if dispatch_text != old:
+            with open(dispatch_path, "w", encoding="utf-8") as f:
+                f.write(dispatch_text)
+            written.append(os.path.relpath(dispatch_path, out_dir))
+    if lazy_helpers:
+        env_text = pu.build_environment_module(imports, instantiations)
+        env_path = os.path.join(out_dir, "environment.py")
+        if not os.path.exists(env_path):
+            # environment.py is usually extended by hand: only created, never overwritten
+            with open(env_path, "w", encoding="utf-8") as f:
+                f.write(env_text)
+            written.append("environment.py")
+
+    manifest = {"version": MANIFEST_VERSION, "modules": manifest_modules,
+                "functions": [row for rel in sorted(functions) for row in functions[rel]]}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return {"features": len(features), "modules_written": written, "modules_skipped": skipped,
+            "common_definitions": len(common_keys), "conflicts": conflicts, "invalid_mappings": invalid,
+            "unparseable_modules": unparseable, "manifest": os.path.relpath(manifest_path, out_dir)}
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Generate a behave steps package for many feature files.")
+    ap.add_argument("paths", nargs="+", help="feature files or directories")
+    ap.add_argument("--out", default=".", help="directory that receives steps/ (and environment.py)")
+    ap.add_argument("--store", default=pu.MAPPINGS_STORE_FILE, help="mappings store JSON file")
+    ap.add_argument("--import", dest="imports", action="append", default=[], help="import line (repeatable)")
+    ap.add_argument("--inst", dest="insts", action="append", default=[], help="helper instantiation line (repeatable)")
+    ap.add_argument("--lazy-helpers", action="store_true", help="create helpers lazily in environment.py")
+    ap.add_argument("--no-hoist", action="store_true", help="do not memoize repeated idempotent fetches")
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--force", action="store_true", help="regenerate every module, even when its inputs did not change")
+    ap.add_argument("--no-dispatch", action="store_true", help="do not write steps/step_dispatch.py")
+    ap.add_argument("--ignore-case", action="store_true",
+                    help="merge step wordings that differ only in case (behave 1.2's case-insensitive matching)")
+    args = ap.parse_args(argv)
+
+    report = generate_steps_package(args.paths, args.out, pu.load_mappings_store(args.store), args.imports,
+                                    args.insts, args.lazy_helpers, not args.no_hoist, args.workers, args.force,
+                                    not args.no_dispatch, not args.ignore_case)
+    print(f"{report['features']} features, {report['common_definitions']} shared definitions; "
+          f"{len(report['modules_written'])} modules written, {len(report['modules_skipped'])} unchanged")
+    for c in report["conflicts"]:
+        print(f"  conflict in {c['module']}: [{c['kind']}] {c['pattern']}: {c['reason']}")
+    for m in report["unparseable_modules"]:
+        print(f"  skipped {m['module']}: {m['reason']}")
+    for c in report["invalid_mappings"]:
+        print(f"  not generated in {c['module']}: [{c['kind']}] {c['pattern']}: invalid mapping ({c['reason']})")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
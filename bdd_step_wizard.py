@@ -2,8 +2,13 @@ import streamlit as st, re, json
 import parser_utils as pu
 import mapping_store as ms
 import validator_utils as vu
+import parser_utils_V3 as pu3
+import step_miner as miner
+import llm_utils as llm
+import grounding_utils as gu
+import telemetry as tm
+import step_resolver as sr
 from datetime import datetime
-import google.generativeai as genai
 
 st.set_page_config(page_title="BDD Automation Wizard v7.3", layout="wide")
 st.title("🧠 BDD Automation Wizard v7.3")
@@ -13,11 +18,56 @@ use_llm = st.sidebar.checkbox("Use Gemini 2.5 Flash for autosuggest", value=True
 api_key = st.sidebar.text_input("Gemini API key", type="password")
 if not api_key:
     api_key = st.secrets.get("GEMINI_API_KEY")
-if api_key and use_llm:
-    genai.configure(api_key=api_key)
 
 project = st.sidebar.text_input("Project Name", value="Default")
 
+# persistent LLM response cache: repeated simulations of the same feature cost no Gemini calls
+if "llm_cache" not in st.session_state:
+    st.session_state["llm_cache"] = llm.LLMResponseCache()
+llm_cache = st.session_state["llm_cache"]
+if "telemetry" not in st.session_state:
+    st.session_state["telemetry"] = tm.SessionTelemetry()
+telemetry = st.session_state["telemetry"]
+if "llm_executor" not in st.session_state:
+    st.session_state["llm_executor"] = llm.LLMExecutor(max_concurrency=4, requests_per_minute=60, telemetry=telemetry)
+llm_executor = st.session_state["llm_executor"]
+with st.sidebar.expander("Resolver thresholds"):
+    st.caption("Steps resolve locally (exact → fuzzy → heuristic); only the rest go to Gemini.")
+    thresholds = {
+        "fuzzy": st.slider("Fuzzy store match", 0.5, 1.0, sr.DEFAULT_THRESHOLDS["fuzzy"], 0.01),
+        "heuristic": st.slider("Helper-name heuristic", 0.5, 1.0, sr.DEFAULT_THRESHOLDS["heuristic"], 0.01),
+    }
+with st.sidebar.expander("LLM deadline / hedging"):
+    llm_deadline = st.slider("Deadline per request (s)", 5, 120, 30)
+    llm_hedge = st.checkbox("Send a hedged duplicate for slow requests", value=True)
+    llm_hedge_pct = st.slider("Hedge after latency percentile", 0.5, 0.99, 0.95, 0.01)
+with st.sidebar.expander("LLM response cache"):
+    st.json(llm_cache.stats())
+    st.caption("Shared Gemini clients (all sessions)")
+    st.json(llm.registry_stats())
+    if st.button("Clear LLM cache"):
+        llm_cache.clear()
+
+with st.sidebar.expander("Mine existing step files"):
+    mine_files = st.file_uploader("Step files to mine", type=["py"], accept_multiple_files=True, key="mine_files")
+    if st.button("Load mined mappings into MongoDB") and mine_files:
+        mined = []
+        for f in mine_files:
+            mined.extend(miner.mine_step_source(f.read().decode("utf-8", errors="ignore"), f.name))
+        # first definition per normalized pattern wins, same as the JSON store
+        seen, chains = set(), []
+        for m in mined:
+            key = pu3.make_step_key(m["step_text"])
+            if key in seen or m["mapping"].get("unresolved"):
+                # partial chains (arguments built by statements that were not mined) are not stored
+                continue
+            seen.add(key)
+            chains.append((m["step_text"], [{"class_name": c["class"], "method_name": c["method"],
+                                             "param_map": c["param_map"], "save_to": c["save_to"]}
+                                            for c in m["mapping"]["calls"]]))
+        added = ms.save_mappings_bulk(chains, project)
+        st.success(f"Mined {len(mined)} step definitions, {added} new mappings stored.")
+
 tabs = st.tabs(["Text ➜ BDD", "BDD ➜ StepFile", "Validate"])
 
 # ======================================================================
@@ -45,88 +95,88 @@ with tabs[1]:
     simulate = st.button("Simulate Step Generation")
 
     if simulate and feat:
-        feature_text = feat.read().decode("utf-8")
-        steps = pu.parse_feature_file(feature_text)
-
-        # Parse helpers
-        helper_classes = {}
-        for f in helpers or []:
-            content = f.read().decode("utf-8")
-            helper_classes.update(pu.parse_helper_classes(content))
-
-        # Load grounding templates safely
-        repo_templates = pu.load_grounding_templates()
-        uploaded_grounding = {}
-        for f in grounding_files or []:
-            try:
-                uploaded_grounding[f.name] = f.read().decode("utf-8")
-            except Exception as e:
-                st.warning(f"Failed reading {f.name}: {e}")
-        templates = {**repo_templates, **uploaded_grounding}
+        with telemetry.stage("simulate.parse"):
+            feature_text = feat.read().decode("utf-8")
+            steps = pu.parse_feature_file(feature_text)
+
+            # Parse helpers
+            helper_classes = {}
+            helper_catalog = {}
+            for f in helpers or []:
+                content = f.read().decode("utf-8")
+                classes = pu.parse_helper_classes(content)
+                helper_classes.update(classes)
+                # per file: typed signatures where the file parses, plain method names otherwise
+                helper_catalog.update(classes)
+                helper_catalog.update(pu3.parse_helper_file_typed(content))
+            # compact signature table, identical for the same helper set, reused by every prompt
+            helper_text = llm.encode_helper_catalog(helper_catalog)
+
+            # Load grounding templates safely
+            repo_templates = pu.load_grounding_templates()
+            uploaded_grounding = {}
+            for f in grounding_files or []:
+                try:
+                    uploaded_grounding[f.name] = f.read().decode("utf-8")
+                except Exception as e:
+                    st.warning(f"Failed reading {f.name}: {e}")
+            templates = {**repo_templates, **uploaded_grounding}
 
         if not helper_classes and not templates:
             st.warning("⚠️ No helper classes or grounding templates provided — LLM may hallucinate.")
 
+        # 1️⃣ Deterministic tiers first (exact / fuzzy store, helper heuristic), Gemini only for the rest
+        llm_resolver = None
+        if use_llm and api_key:
+            # deadline + hedging; the HedgedModel lives in the session so its latency history carries over
+            shared = llm.get_shared_model(api_key, "gemini-2.5-flash")
+            hedged = st.session_state.get("llm_hedged")
+            if hedged is None or hedged.model is not shared:
+                hedged = st.session_state["llm_hedged"] = llm.HedgedModel(shared)
+            hedged.deadline, hedged.hedge, hedged.hedge_percentile = llm_deadline, llm_hedge, llm_hedge_pct
+            model = llm.CachedModel(hedged, llm_cache, "gemini-2.5-flash",
+                                    grounding_hash=llm.fingerprint(helper_text, templates))
+            model = tm.InstrumentedModel(model, telemetry, "simulate.map", "gemini-2.5-flash")
+
+            def llm_resolver(texts):
+                with st.spinner(f"Asking Gemini to map {len(texts)} unresolved steps..."), telemetry.stage("simulate.llm"):
+                    # answers are validated against the typed signatures; invalid ones get one repair prompt
+                    return llm.batch_map_steps(texts, model, helper_catalog, templates, helper_text=helper_text,
+                                               executor=llm_executor, retriever=gu.get_retriever(templates))
+
+        with telemetry.stage("simulate.resolve"):
+            # typed signatures: the heuristic tier fills arguments and is checked like LLM answers
+            resolver = sr.StepResolver(ms.fetch_mappings(project), helper_catalog, thresholds)
+            resolutions, report = resolver.resolve_all([s["text"] for s in steps], llm_resolver)
+        for err in report["errors"]:
+            st.warning(f"⚠️ {err}")
+        st.info("Resolved by tier: " + ", ".join(f"{t} {n}" for t, n in report["by_tier"].items())
+                + f" — {report['sent_to_llm']} steps sent to Gemini")
+        if "llm_hedged" in st.session_state:
+            st.caption(f"LLM requests: {st.session_state['llm_hedged'].stats}")
+
         # Iterate through each step
         for i, s in enumerate(steps):
             step = s["text"]
             st.markdown(f"### 🔹 Step {i+1}: {s['kind'].upper()} {step}")
 
-            suggestion = None
-            stored = None
-
-            # 1️⃣ Try LLM autosuggest first
-            if use_llm and api_key:
-                helper_text = json.dumps(helper_classes, indent=2)
-                grounding = json.dumps(templates)
-                prompt = f"""
-You are a BDD step mapping generator for test automation.
-Only use the helper classes and methods shown below. 
-Respond strictly in JSON format as a list of call objects.
-
-Helper classes/methods:
-{helper_text}
-
-Grounding context (sample BDD and step templates):
-{grounding}
+            res = resolutions[i]
+            telemetry.record_resolution(res["tier"] if res else "unresolved")
 
-Step: {step}
+            # 2️⃣ Stored mapping (Mongo), exact or fuzzy
+            if res and res["tier"] in ("exact", "fuzzy"):
+                st.success(f"✅ Found mapping in MongoDB ({res['tier']}, confidence {res['confidence']:.2f}): "
+                           f"{res['matched']}")
+                st.json(res["mapping"])
+                continue
 
-Return JSON list, e.g.:
-[{{"class_name": "Rubrik", "method_name": "get_oracle_db_id", "save_to": "context.db_id"}}]
-"""
-                try:
-                    model = genai.GenerativeModel("gemini-2.5-flash")
-                    resp = model.generate_content(prompt)
-                    text = (resp.text or "").strip()
-                    if not text:
-                        st.warning("⚠️ Gemini returned empty response.")
-                        suggestion = []
-                    else:
-                        match = re.search(r"(\[.*\]|\{.*\})", text, re.S)
-                        if match:
-                            suggestion = json.loads(match.group(1))
-                        else:
-                            st.warning(f"⚠️ LLM output not JSON:\n{text[:400]}")
-                            suggestion = []
-                except Exception as e:
-                    st.warning(f"LLM generation failed: {e}")
-                    suggestion = []
-
-            # 2️⃣ Fallback to stored mapping (Mongo)
-            if not suggestion:
-                stored = ms.find_mapping(step, project)
-                if stored:
-                    st.success("✅ Found mapping in MongoDB.")
-                    st.json(stored)
-                    continue
-
-            # 3️⃣ Show suggestion if available
-            if suggestion:
-                st.write("💡 Gemini Suggested Mapping:")
-                st.json(suggestion)
+            # 3️⃣ Show heuristic / Gemini suggestion if available
+            if res:
+                label = {"llm": "Gemini", "heuristic": "Heuristic"}.get(res["tier"], "Low-confidence fallback")
+                st.write(f"💡 {label} Suggested Mapping (confidence {res['confidence']:.2f}):")
+                st.json(res["mapping"])
                 if st.button(f"Accept mapping for '{step}'", key=f"accept_{i}"):
-                    ms.save_mapping(step, suggestion, project, "llm", confidence=0.9)
+                    ms.save_mapping(step, res["mapping"], project, res["tier"], confidence=res["confidence"])
                     st.success("Mapping saved to MongoDB.")
                 if st.button(f"Reject mapping for '{step}'", key=f"reject_{i}"):
                     st.info("You can edit or create a manual mapping below.")
@@ -182,16 +232,33 @@ with tabs[2]:
                 st.write(f"`{line}` → {note}")
 
             st.subheader("🔍 Function Call Validation")
-            val = vu.validate_stepfile(step_py, helpers)
+            with telemetry.stage("validate.calls"):
+                val, state, _ = vu.validate_stepfile_incremental(step_py, helpers)
             good = [v for v in val if v["valid"]]
             bad = [v for v in val if not v["valid"]]
             st.success(f"✅ Valid calls: {len(good)}")
             st.error(f"❌ Invalid calls: {len(bad)}")
             if bad:
                 st.table(bad)
+            # kept across reruns: the editor below only re-checks the functions that were edited
+            st.session_state["validator"] = {"helpers": helpers, "step_py": step_py, "state": state,
+                                             "validated_text": step_py}
+
+    session = st.session_state.get("validator")
+    if session:
+        st.subheader("📄 Inline Editor")
+        edited = st.text_area("Edit Step File", value=session["step_py"], height=300,
+                              key=f"validator_editor_{hash(session['step_py'])}")
+        if st.button("Re-validate after Edit") or edited != session["validated_text"]:
+            with telemetry.stage("validate.incremental"):
+                val2, session["state"], rep = vu.validate_stepfile_incremental(edited, session["helpers"], session["state"])
+            session["validated_text"] = edited
+            st.info(f"Now valid {sum(v['valid'] for v in val2)} of {len(val2)} "
+                    f"({rep['revalidated']} of {rep['blocks']} blocks re-checked)")
+            for err in rep["syntax_errors"]:
+                st.error(f"Syntax error: {err}")
+            bad2 = [v for v in val2 if not v["valid"]]
+            if bad2:
+                st.table(bad2)
 
-            st.subheader("📄 Inline Editor")
-            edited = st.text_area("Edit Step File", value=step_py, height=300)
-            if st.button("Re-validate after Edit"):
-                val2 = vu.validate_stepfile(edited, helpers)
-                st.info(f"Now valid {sum(v['valid'] for v in val2)} of {len(val2)}")
+tm.render_sidebar_panel(st, telemetry)
@@ -3,8 +3,16 @@ import streamlit as st
 import json
 import textwrap
 import os
+import difflib
+import threading
+import time
 from typing import List, Dict, Any
-import parser_utils as pu
+import parser_utils_V3 as pu
+import step_miner as miner
+import cost_estimator as ce
+import llm_utils as llm
+import grounding_utils as gu
+import telemetry as tm
 
 st.set_page_config(page_title="BDD Step Wizard v5.5", layout="wide")
 st.title("BDD Step Wizard v5.5 — with mapping store & autosuggest")
@@ -27,6 +35,11 @@ with st.sidebar:
 # mapping store load
 mappings_store = pu.load_mappings_store()
 
+# per-session telemetry (sidebar panel rendered at the end of the script)
+if "telemetry" not in st.session_state:
+    st.session_state["telemetry"] = tm.SessionTelemetry()
+telemetry = st.session_state["telemetry"]
+
 # Helper: save store and sync session
 def persist_store():
     pu.save_mappings_store(mappings_store)
@@ -144,19 +157,66 @@ with tab_wizard:
                     st.success("Mapping saved to store (mappings_store.json).")
 
         # Generate consolidated stepfile
+        hoist_fetches = st.checkbox("Reuse idempotent fetcher results across each scenario", value=True, key="hoist_fetches")
+        lazy_helpers = st.checkbox("Create helpers lazily in environment.py (steps use context.<helper>)", value=False, key="lazy_helpers")
+        existing_steps = st.file_uploader("Existing step file to update in place (optional)", type=["py", "txt"], key="existing_steps")
         if st.button("Generate Stepfile from mappings"):
             imports = [default_import]
             insts = default_inst.splitlines()
+            instance_prefix = ""
+            if lazy_helpers:
+                # helpers move to environment.py; the step module itself imports nothing expensive
+                env_text = pu.build_environment_module(imports, insts)
+                imports, insts, instance_prefix = [], [], "context."
             impls = []
             known_context_vars = set()
-            for i, s in enumerate(steps):
-                key = f"step_{i}"
-                mapping = st.session_state['wizard_mappings'].get(key, {"calls":[]})
-                impls.append(pu.generate_step_impl(s, mapping.get("calls", []), default_instances, known_context_vars))
-            module_text = pu.build_module(imports, insts, impls)
+            calls_per_step = [st.session_state['wizard_mappings'].get(f"step_{i}", {"calls":[]}).get("calls", []) for i in range(len(steps))]
+            if hoist_fetches:
+                calls_per_step, hoist_report = pu.hoist_fetcher_calls(steps, calls_per_step, default_instances)
+                if hoist_report["calls_saved"]:
+                    st.info(f"Fetcher dedup: {hoist_report['calls_saved']} remote call(s) per run replaced by context reuse.")
+                    st.json(hoist_report["hoisted"])
+            gen_start = time.perf_counter()
+            cache_hits = pu.STEP_CODE_STATS["hits"]
+            # one definition per behave pattern; compatible chains merge, conflicting ones are flagged
+            impls, merge_report = pu.generate_step_definitions(steps, calls_per_step, default_instances, known_context_vars,
+                                                               instance_prefix)
+            existing_src = existing_steps.read().decode("utf-8", errors="ignore") if existing_steps else ""
+            try:
+                # only new / changed generated functions are spliced in; hand edits stay untouched
+                module_text, splice_report = pu.splice_step_module(existing_src, imports, insts, impls)
+            except SyntaxError as e:
+                st.error(f"Existing step file does not parse ({e}); generating a fresh module instead.")
+                existing_src = ""
+                module_text, splice_report = pu.splice_step_module("", imports, insts, impls)
+            st.caption(f"Generated {merge_report['definitions']} definitions for {len(steps)} steps in "
+                       f"{(time.perf_counter() - gen_start) * 1000:.1f} ms "
+                       f"({pu.STEP_CODE_STATS['hits'] - cache_hits} reused from the step cache, "
+                       f"{merge_report['duplicates_removed']} duplicates removed)")
+            for c in merge_report["conflicts"]:
+                st.warning(f"Conflicting mappings for [{c['kind']}] '{c['pattern']}' (steps {c['steps']}): {c['reason']}")
+            if merge_report["invalid"]:
+                st.error(f"{len(merge_report['invalid'])} step(s) left out of the module: their mapping is not valid Python.")
+                for c in merge_report["invalid"]:
+                    st.write(f"[{c['kind']}] '{c['pattern']}' (steps {c['steps']}): {c['reason']}")
+            if existing_src:
+                st.info(", ".join(f"{k.replace('_', ' ')}: {len(v)}" for k, v in splice_report.items()))
+                if splice_report["kept_edited"] or splice_report["kept_handwritten"]:
+                    with st.expander("Kept existing functions (edited or hand-written)"):
+                        st.write(splice_report["kept_edited"] + splice_report["kept_handwritten"])
+                diff = "\n".join(difflib.unified_diff(existing_src.splitlines(), module_text.splitlines(),
+                                                      "existing", "updated", lineterm=""))
+                st.code(diff or "(no changes)", language="diff")
             st.subheader("Generated Stepfile")
             st.code(module_text, language="python")
             st.download_button("Download generated_steps.py", module_text, file_name="generated_steps.py")
+            # optional: drop into steps/ next to the generated module for constant-time step lookup
+            dispatch_text = pu.build_dispatch_module([(s["kind"], pu.step_pattern_and_args(s)[0]) for s in steps])
+            st.download_button("Download step_dispatch.py (fast step lookup)", dispatch_text, file_name="step_dispatch.py")
+            if lazy_helpers:
+                st.subheader("environment.py")
+                st.code(env_text, language="python")
+                st.download_button("Download environment.py", env_text, file_name="environment.py")
 
 # --------------------
 # Simulate tab
@@ -188,13 +248,16 @@ with tab_simulate:
                 suggestion = pu.suggest_mapping_for_step(stp['text'], mappings_store)
                 if suggestion:
                     suggestions[i] = suggestion
+                    telemetry.record_resolution("store")
                     continue
                 # heuristic infer
                 h, m = pu.infer_helper_and_method(stp['text'], helper_map)
                 calls = []
                 if stp['kind'] == 'given':
                     suggestions[i] = {"calls": []}
+                    telemetry.record_resolution("given-assign")
                     continue
+                telemetry.record_resolution("heuristic" if h and m else "unresolved")
                 if h and m:
                     arglist = helper_map.get(h, {}).get(m, [])
                     pmap = {}
@@ -233,14 +296,57 @@ with tab_transform:
             gem_key_t = st.secrets["GEMINI_API_KEY"]
     templates = pu.load_grounding_templates()
     grounding_text = "\n\n".join([f"### {n}\n{c}" for n,c in templates.items()])
+    retrieve_grounding = st.checkbox("Send only the most relevant template chunks (BM25)", value=True, key="retrieve_grounding")
+    stream_t = st.checkbox("Stream Gemini output as it is generated", value=True, key="stream_transform")
 
     if st.button("Generate BDD from text"):
         if not text_in or not text_in.strip():
             st.error("Provide text input")
         else:
-            bdd = pu.generate_bdd_from_text(text_in, use_llm=use_llm_t, api_key=gem_key_t, grounding_text=grounding_text)
-            st.code(bdd, language="gherkin")
-            st.download_button("Download generated .feature", bdd, file_name="generated_from_text.feature")
+            if "llm_cache" not in st.session_state:
+                st.session_state["llm_cache"] = llm.LLMResponseCache()
+            executor = llm.LLMExecutor(max_concurrency=8, requests_per_minute=60, telemetry=telemetry)
+            llm_args = dict(use_llm=use_llm_t, api_key=gem_key_t, grounding_text=grounding_text,
+                            cache=st.session_state["llm_cache"], executor=executor,
+                            retriever=gu.get_retriever(templates) if retrieve_grounding else None, telemetry=telemetry)
+            if use_llm_t and gem_key_t and stream_t:
+                # every part streams into its own placeholder; Stop cancels whatever is still generating
+                cancel = threading.Event()
+                st.button("Stop generation", key="stop_transform", on_click=cancel.set)
+                n_parts = len(pu.split_text_parts(text_in))
+                holders = {i: st.empty() for i in range(1, n_parts + 1)}
+                texts = {i: "" for i in holders}
+                st.session_state["transform_parts"] = texts
+                with telemetry.stage("transform"):
+                    for ev in pu.stream_bdd_from_text(text_in, cancel=cancel, **llm_args):
+                        i = ev["part"]
+                        if ev["event"] == "start":
+                            texts[i] = ""
+                        elif ev["event"] == "chunk":
+                            texts[i] += ev["text"]
+                        else:
+                            texts[i] = ev["text"]
+                        holders[i].code(texts[i] or "…", language="gherkin")
+                for h in holders.values():
+                    h.empty()
+                bdd = "\n\n".join(texts[i].strip() for i in sorted(texts))
+            else:
+                with telemetry.stage("transform"):
+                    bdd = pu.generate_bdd_from_text(text_in, **llm_args)
+            st.session_state["transform_parts"] = {}
+            st.session_state["transform_bdd"] = bdd
+            if use_llm_t and gem_key_t:
+                st.caption(f"LLM calls: {executor.stats()}")
+    elif st.session_state.get("transform_parts"):
+        # generation was stopped (the Stop button reruns the script): keep what had arrived
+        parts_done = st.session_state.pop("transform_parts")
+        st.session_state["transform_bdd"] = "\n\n".join(parts_done[i].strip() for i in sorted(parts_done) if parts_done[i].strip())
+        st.warning("Generation stopped; showing the text received so far.")
+
+    if st.session_state.get("transform_bdd"):
+        bdd = st.session_state["transform_bdd"]
+        st.code(bdd, language="gherkin")
+        st.download_button("Download generated .feature", bdd, file_name="generated_from_text.feature")
 
 # --------------------
 # Validator tab
@@ -258,21 +364,36 @@ with tab_validator:
             ftxt = f.read().decode("utf-8")
             stxt = sfile.read().decode("utf-8")
             helper_map = {}
-            for h in hf:
-                helper_map.update(pu.parse_helper_file(h.read().decode("utf-8")))
+            helper_sources = [h.read().decode("utf-8") for h in hf]
+            for src in helper_sources:
+                # typed signatures: the validator also checks argument counts and keywords
+                helper_map.update(pu.parse_helper_file_typed(src))
             parsed = pu.parse_feature_text(ftxt)
             feature_steps = parsed["steps"]
-            amb = pu.detect_ambiguous_steps(feature_steps)
-            issues = pu.validate_stepfile_against_helpers(stxt, helper_map)
-            # missing implementations: naive check
-            missing = []
-            for sstep in feature_steps:
-                if sstep['text'] not in stxt:
-                    missing.append(sstep['text'])
+            with telemetry.stage("validate"):
+                amb = pu.detect_ambiguous_steps(feature_steps)
+                issues = pu.validate_stepfile_against_helpers(stxt, helper_map)
+                # behave matching rules: decorator patterns vs. every step, Examples rows expanded
+                try:
+                    step_match = pu.match_feature_steps(ftxt, stxt)
+                except SyntaxError as e:
+                    step_match = {"unmatched": [], "ambiguous": [], "unused": [], "stats": {"error": str(e)}}
+            with telemetry.stage("estimate_runtime"):
+                try:
+                    runtime = ce.estimate_feature_cost(ftxt, stxt, helper_sources)["scenarios"]
+                except SyntaxError:
+                    runtime = []
             report = {
                 "duplicate_steps": amb,
-                "missing_steps_by_text": missing,
-                "issues_with_helpers": issues
+                "missing_steps": step_match["unmatched"],
+                "ambiguous_steps": step_match["ambiguous"],
+                "unused_step_definitions": [f"{d['function']} (line {d['line']}): {d['pattern']}" for d in step_match["unused"]],
+                "step_matching": step_match["stats"],
+                "issues_with_helpers": issues,
+                # static estimate: sleeps/poll loops and remote calls reached from each step
+                "estimated_runtime": [{"scenario": r["scenario"], "worst_seconds": r["worst_seconds"],
+                                       "expected_seconds": r["expected_seconds"], "unmatched_steps": r["unmatched"]}
+                                      for r in runtime]
             }
             st.json(report)
 
@@ -284,6 +405,15 @@ st.sidebar.header("Mappings store")
 if st.sidebar.button("Download mappings store"):
     data = pu.load_mappings_store()
     st.sidebar.download_button("Download JSON", json.dumps(data, indent=2), file_name="mappings_store.json")
+mine_files = st.sidebar.file_uploader("Mine existing step files into the store", type=["py"], accept_multiple_files=True, key="mine_files")
+if mine_files and st.sidebar.button("Load mined mappings"):
+    mined = []
+    for mf in mine_files:
+        mined.extend(miner.mine_step_source(mf.read().decode("utf-8", errors="ignore"), mf.name))
+    entries, conflicts, partial = miner.mined_to_store_entries(mined)
+    added = pu.save_mappings_bulk(entries)
+    st.sidebar.success(f"Mined {len(mined)} step definitions, {added} new mappings saved ({len(conflicts)} conflicts, "
+                       f"{len(partial)} partial chains skipped).")
 uploaded_store = st.sidebar.file_uploader("Upload mappings store JSON to replace current", type=["json"])
 if uploaded_store:
     try:
@@ -295,4 +425,6 @@ if uploaded_store:
 
 st.info("Mapping persistence stores user-saved mappings to mappings_store.json in app folder. On Streamlit Cloud, this persists during app runtime and can be exported/imported.")
 
+tm.render_sidebar_panel(st, telemetry)
+
 # end of bdd_step_wizard.py
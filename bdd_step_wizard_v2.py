@@ -6,6 +6,7 @@ import ast
 import json
 from typing import List, Dict, Any
 import parser_utils as pu
+import llm_utils as llm
 
 # optional LLM
 try:
@@ -52,9 +53,8 @@ def call_gemini(prompt: str, api_key: str):
         st.error("No Gemini API key provided.")
         return None
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(prompt)
+        # shared per (key, model) across sessions; identical in-flight prompts are sent once
+        resp = llm.get_shared_model(api_key, "gemini-1.5-flash").generate_content(prompt)
         return resp.text
     except Exception as e:
         st.error(f"Gemini call failed: {e}")
@@ -253,7 +253,8 @@ If uncertain about param_map, leave empty.
                 llm_out = call_gemini(prompt, gemini_key_sim)
                 if llm_out:
                     try:
-                        parsed_json = json.loads(llm_out)
+                        # first JSON array in the reply, tolerating prose, code fences and trailing commas
+                        parsed_json = next(v for v in llm.extract_json_values(llm_out) if isinstance(v, list))
                         # merge suggestions into our suggestions structure
                         for item in parsed_json:
                             # find matching step index by step text
@@ -0,0 +1,107 @@
+"""
+bench_dispatch.py
+
+Benchmark step lookup with behave's default parse matcher against the generated dispatch index
+(parser_utils_V3.build_dispatch_module).
+
+A synthetic suite of N step definitions is registered in a fresh behave StepRegistry, every
+definition is looked up with a matching step text, and both lookups must return the same step
+function. Requires behave.
+
+Usage:
+    python bench_dispatch.py --definitions 200 1000 5000 --lookups 20000
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+from typing import List, Tuple
+
+from behave.step_registry import StepRegistry
+
+import parser_utils_V3 as pu
+
+FIRST_WORDS = ["the", "a", "user", "admin", "backup", "restore", "cluster", "database", "snapshot", "policy",
+               "job", "host", "i", "we", "system", "sla", "archive", "replication", "report", "alert"]
+WORDS = ["oracle", "sql", "vm", "share", "fileset", "primary", "secondary", "target", "source", "daily",
+         "weekly", "retention", "status", "completed", "failed", "started", "exists", "created", "deleted",
+         "assigned", "paused", "resumed", "verified", "listed", "enabled", "disabled", "live", "mount"]
+KINDS = ("given", "when", "then")
+
+
+def synthetic_suite(n: int, seed: int = 7) -> List[Tuple[str, str, str]]:
+    """n distinct (kind, pattern, matching step text) triples, with and without fields."""
+    rng = random.Random(seed)
+    suite, seen = [], set()
+    while len(suite) < n:
+        words = [rng.choice(FIRST_WORDS)] + rng.sample(WORDS, rng.randint(2, 5)) + [f"w{len(suite)}"]
+        pattern_words, text_words = list(words), list(words)
+        for field in range(rng.randint(0, 2)):
+            pos = rng.randint(1, len(pattern_words))
+            pattern_words.insert(pos, f'"{{p{field}}}"')
+            text_words.insert(pos, f'"value{rng.randint(1, 99)}"')
+        kind = rng.choice(KINDS)
+        pattern = " ".join(pattern_words)
+        if pu.pattern_key(kind, pattern) in seen:
+            continue
+        seen.add(pu.pattern_key(kind, pattern))
+        suite.append((kind, pattern, " ".join(text_words)))
+    return suite
+
+
+def build_registries(suite: List[Tuple[str, str, str]]):
+    """(plain registry, registry with the dispatch index installed) holding the same definitions."""
+    registries = []
+    for _ in range(2):
+        registry = StepRegistry()
+        for n, (kind, pattern, _) in enumerate(suite):
+            def step_impl(context, **kwargs):
+                pass
+            step_impl.__name__ = f"step_{n}"
+            registry.add_step_definition(kind, pattern, step_impl)
+        registries.append(registry)
+    namespace = {"__name__": "step_dispatch"}
+    exec(compile(pu.build_dispatch_module([(k, p) for k, p, _ in suite]), "step_dispatch.py", "exec"), namespace)
+    namespace["install"](registries[1])
+    return registries
+
+
+def time_lookups(registry, steps) -> float:
+    start = time.perf_counter()
+    for step in steps:
+        registry.find_match(step)
+    return time.perf_counter() - start
+
+
+def run(n: int, lookups: int) -> dict:
+    suite = synthetic_suite(n)
+    plain, indexed = build_registries(suite)
+    rng = random.Random(n)
+    steps = [SimpleNamespace(step_type=kind, name=text) for kind, _, text in (rng.choice(suite) for _ in range(lookups))]
+    # same function for every step, or the index is wrong
+    mismatches = sum(1 for s in steps[:2000]
+                     if plain.find_match(s).func.__name__ != indexed.find_match(s).func.__name__)
+    indexed.dispatch_index.bind()
+    plain_seconds = time_lookups(plain, steps)
+    indexed_seconds = time_lookups(indexed, steps)
+    return {"definitions": n, "lookups": lookups, "parse_matcher_us": plain_seconds / lookups * 1e6,
+            "dispatch_us": indexed_seconds / lookups * 1e6, "speedup": plain_seconds / indexed_seconds,
+            "mismatches": mismatches, "fallbacks": indexed.dispatch_index.stats["fallbacks"]}
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark behave step lookup with and without the dispatch index.")
+    ap.add_argument("--definitions", type=int, nargs="+", default=[100, 1000, 5000])
+    ap.add_argument("--lookups", type=int, default=5000)
+    args = ap.parse_args(argv)
+    print(f"{'definitions':>11} {'parse (us/step)':>16} {'dispatch (us/step)':>19} {'speedup':>8} {'mismatches':>10}")
+    for n in args.definitions:
+        r = run(n, args.lookups)
+        print(f"{r['definitions']:>11} {r['parse_matcher_us']:>16.1f} {r['dispatch_us']:>19.1f} "
+              f"{r['speedup']:>7.1f}x {r['mismatches']:>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,438 @@
+"""
+cost_estimator.py
+
+Static runtime-cost estimate for behave step modules and the scenarios that use them.
+
+Step functions and the helper methods they call (and what those call through self.*) are walked
+without running anything. The walk counts remote calls (requests.*, pyodbc/oracledb connects) and
+adds up sleep budgets, with constants propagated from literals, parameter defaults, call-site
+arguments and constant self.* attributes set in __init__. Loops are bounded where the code allows:
+  - for x in [30, 60, 90] / range(n)        one pass per value (sleep(x) uses the value)
+  - while elapsed < max_wait: elapsed += c  ceil(max_wait / c) passes
+  - while True: ... if elapsed >= timeout   ceil(timeout / sleep per pass) + 1 passes
+Loops that cannot be bounded count as --max-iterations passes and are listed in 'notes'.
+
+Two figures are reported:
+  worst     every poll loop runs to its limit, remote calls take --remote-worst seconds
+  expected  poll loops (loops that sleep and can return/break) stop after --poll-fraction of their
+            passes, remote calls take --remote-expected seconds
+Scenario figures are the sum of their steps (Background steps included, one per Examples row).
+
+Usage:
+    python cost_estimator.py --steps templates/JFMN_71-steps.py \
+        --helpers templates/rubrik.py templates/mssql_connector.py --feature templates/JFMN_71.feature
+"""
+
+import argparse
+import ast
+import json
+import math
+import operator
+from typing import List, Dict, Any, Tuple
+
+import parser_utils_V3 as pu
+
+REMOTE_CALLS = {
+    "requests.get", "requests.post", "requests.put", "requests.patch", "requests.delete", "requests.head",
+    "requests.request", "pyodbc.connect", "oracledb.connect", "cx_Oracle.connect", "psycopg2.connect",
+    "pymysql.connect", "paramiko.SSHClient.connect", "urllib.request.urlopen",
+}
+SLEEP_CALLS = {"time.sleep", "sleep", "asyncio.sleep"}
+BINOPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+          ast.FloorDiv: operator.floordiv}
+DEFAULTS = {"remote_expected": 0.5, "remote_worst": 5.0, "poll_fraction": 0.5, "max_iterations": 10}
+
+
+class Cost:
+    """Sleep seconds and remote calls, each as (worst, expected), plus where the time goes."""
+
+    def __init__(self, sleep=(0.0, 0.0), remote=(0.0, 0.0)):
+        self.sleep = sleep
+        self.remote = remote
+        self.calls = {}      # helper method -> worst sleep seconds contributed (top level only)
+        self.notes = []
+
+    def add(self, other: "Cost") -> "Cost":
+        self.sleep = (self.sleep[0] + other.sleep[0], self.sleep[1] + other.sleep[1])
+        self.remote = (self.remote[0] + other.remote[0], self.remote[1] + other.remote[1])
+        for k, v in other.calls.items():
+            self.calls[k] = self.calls.get(k, 0.0) + v
+        self.notes.extend(n for n in other.notes if n not in self.notes)
+        return self
+
+    def scaled(self, worst: float, expected: float) -> "Cost":
+        out = Cost((self.sleep[0] * worst, self.sleep[1] * expected), (self.remote[0] * worst, self.remote[1] * expected))
+        out.calls = {k: v * worst for k, v in self.calls.items()}
+        out.notes = list(self.notes)
+        return out
+
+    @staticmethod
+    def larger(a: "Cost", b: "Cost") -> "Cost":
+        """Branch merge: the costlier branch, per figure."""
+        out = Cost((max(a.sleep[0], b.sleep[0]), max(a.sleep[1], b.sleep[1])),
+                   (max(a.remote[0], b.remote[0]), max(a.remote[1], b.remote[1])))
+        out.calls = dict(a.calls if a.sleep[0] + a.remote[0] >= b.sleep[0] + b.remote[0] else b.calls)
+        out.notes = a.notes + [n for n in b.notes if n not in a.notes]
+        return out
+
+    def summary(self, options: Dict[str, float]) -> Dict[str, Any]:
+        return {
+            "worst_seconds": round(self.sleep[0] + self.remote[0] * options["remote_worst"], 1),
+            "expected_seconds": round(self.sleep[1] + self.remote[1] * options["remote_expected"], 1),
+            "sleep_seconds": {"worst": round(self.sleep[0], 1), "expected": round(self.sleep[1], 1)},
+            "remote_calls": {"worst": round(self.remote[0], 1), "expected": round(self.remote[1], 1)},
+            "by_helper_call": {k: round(v, 1) for k, v in sorted(self.calls.items(), key=lambda kv: -kv[1])},
+            "notes": self.notes,
+        }
+
+
+def _dotted(node: ast.AST) -> str:
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+        return ".".join(reversed(parts))
+    return ""
+
+
+def _const(node: ast.AST, env: Dict[str, Any]):
+    """Value of a constant expression under env (names, self.attrs, arithmetic, lists, range), else None."""
+    if node is None:
+        return None
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        return env.get(_dotted(node))
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_const(e, env) for e in node.elts]
+        return values if all(isinstance(v, (int, float)) for v in values) else None
+    if isinstance(node, ast.BinOp):
+        a, b = _const(node.left, env), _const(node.right, env)
+        op = BINOPS.get(type(node.op))
+        if op and isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            try:
+                return op(a, b)
+            except ZeroDivisionError:
+                return None
+    if isinstance(node, ast.Call) and _dotted(node.func) == "range":
+        args = [_const(a, env) for a in node.args]
+        if args and all(isinstance(a, int) for a in args):
+            return list(range(*args))
+    return None
+
+
+def load_helpers(sources: List[str]) -> Dict[str, Dict[str, Any]]:
+    """{Class: {'methods': {name: FunctionDef}, 'attrs': {'self.x': constant from __init__}}}."""
+    helpers = {}
+    for src in sources:
+        try:
+            tree = ast.parse(src)
+        except SyntaxError:
+            continue
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            methods = {f.name: f for f in node.body if isinstance(f, (ast.FunctionDef, ast.AsyncFunctionDef))}
+            attrs = {}
+            for stmt in ast.walk(methods["__init__"]) if "__init__" in methods else ():
+                if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+                    value = _const(stmt.value, attrs)
+                    if value is not None and _dotted(stmt.targets[0]).startswith("self."):
+                        attrs[_dotted(stmt.targets[0])] = value
+            entry = helpers.setdefault(node.name, {"methods": {}, "attrs": {}})
+            entry["methods"].update(methods)
+            entry["attrs"].update(attrs)
+    return helpers
+
+
+class CostEstimator:
+    def __init__(self, helpers: Dict[str, Dict[str, Any]], options: Dict[str, float] = None):
+        self.helpers = helpers
+        self.options = dict(DEFAULTS, **(options or {}))
+        self._stack = []
+
+    # ---- helper methods ----
+    def method_cost(self, cls: str, method: str, call: ast.Call = None, caller_env: Dict[str, Any] = None) -> Cost:
+        """Cost of one call of cls.method, with constant call-site arguments bound to its parameters."""
+        func = self.helpers.get(cls, {}).get("methods", {}).get(method)
+        if func is None:
+            return Cost()
+        if (cls, method) in self._stack:
+            cost = Cost()
+            cost.notes.append(f"recursion in {cls}.{method} not followed")
+            return cost
+        env = dict(self.helpers[cls]["attrs"])
+        params = func.args.posonlyargs + func.args.args
+        params = params[1:] if params and params[0].arg in ("self", "cls") else params
+        defaults = [None] * (len(params) - len(func.args.defaults)) + list(func.args.defaults)
+        for p, d in zip(params, defaults):
+            env[p.arg] = _const(d, {})
+        for p, d in zip(func.args.kwonlyargs, func.args.kw_defaults):
+            env[p.arg] = _const(d, {})
+        if call is not None:
+            for p, a in zip(params, call.args):
+                env[p.arg] = _const(a, caller_env or {})
+            for k in call.keywords:
+                if k.arg:
+                    env[k.arg] = _const(k.value, caller_env or {})
+        self._stack.append((cls, method))
+        try:
+            return self.block_cost(func.body, env, cls)
+        finally:
+            self._stack.pop()
+
+    # ---- statements ----
+    def block_cost(self, body: List[ast.stmt], env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        total = Cost()
+        for stmt in body:
+            total.add(self.stmt_cost(stmt, env, cls, symbols))
+        return total
+
+    def stmt_cost(self, stmt: ast.stmt, env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            return Cost()
+        if isinstance(stmt, ast.If):
+            return self.expr_cost(stmt.test, env, cls, symbols).add(
+                Cost.larger(self.block_cost(stmt.body, dict(env), cls, symbols),
+                            self.block_cost(stmt.orelse, dict(env), cls, symbols)))
+        if isinstance(stmt, (ast.For, ast.AsyncFor)):
+            return self.for_cost(stmt, env, cls, symbols)
+        if isinstance(stmt, ast.While):
+            return self.while_cost(stmt, env, cls, symbols)
+        if isinstance(stmt, ast.Try) or type(stmt).__name__ == "TryStar":
+            handlers = Cost()
+            for h in stmt.handlers:
+                handlers = Cost.larger(handlers, self.block_cost(h.body, dict(env), cls, symbols))
+            return self.block_cost(stmt.body, env, cls, symbols).add(handlers).add(
+                self.block_cost(stmt.orelse + stmt.finalbody, env, cls, symbols))
+        if isinstance(stmt, (ast.With, ast.AsyncWith)):
+            cost = Cost()
+            for item in stmt.items:
+                cost.add(self.expr_cost(item.context_expr, env, cls, symbols))
+            return cost.add(self.block_cost(stmt.body, env, cls, symbols))
+        cost = Cost()
+        for child in ast.iter_child_nodes(stmt):
+            if isinstance(child, ast.expr):
+                cost.add(self.expr_cost(child, env, cls, symbols))
+        # constant propagation for the statements that follow
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and _dotted(stmt.targets[0]):
+            env[_dotted(stmt.targets[0])] = _const(stmt.value, env)
+        elif isinstance(stmt, ast.AugAssign) and _dotted(stmt.target):
+            a, b = env.get(_dotted(stmt.target)), _const(stmt.value, env)
+            env[_dotted(stmt.target)] = a + b if isinstance(a, (int, float)) and isinstance(b, (int, float)) \
+                and isinstance(stmt.op, ast.Add) else None
+        return cost
+
+    @staticmethod
+    def _is_poll(loop: ast.AST) -> bool:
+        """A loop that sleeps and can finish early: in the expected case it stops part way."""
+        nodes = list(ast.walk(loop))
+        sleeps = any(isinstance(n, ast.Call) and _dotted(n.func) in SLEEP_CALLS for n in nodes)
+        return sleeps and any(isinstance(n, (ast.Return, ast.Break)) for n in nodes)
+
+    def _passes(self, loop: ast.AST, n: float) -> Tuple[float, float]:
+        expected = max(1, math.ceil(n * self.options["poll_fraction"])) if self._is_poll(loop) else n
+        return n, min(n, expected)
+
+    def for_cost(self, stmt: ast.For, env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        cost = self.expr_cost(stmt.iter, env, cls, symbols)
+        values = _const(stmt.iter, env)
+        if not isinstance(values, list):
+            # iterating over data: one pass per item, count unknown
+            return cost.add(self.block_cost(stmt.body + stmt.orelse, dict(env), cls, symbols))
+        worst_n, expected_n = self._passes(stmt, len(values))
+        passes = []
+        for v in values:
+            body_env = dict(env)
+            if isinstance(stmt.target, ast.Name):
+                body_env[stmt.target.id] = v
+            passes.append(self.block_cost(stmt.body, body_env, cls, symbols))
+        worst, expected = Cost(), Cost()
+        for p in passes:
+            worst.add(p)
+        for p in passes[:int(expected_n)]:
+            expected.add(p)
+        out = Cost((worst.sleep[0], expected.sleep[1]), (worst.remote[0], expected.remote[1]))
+        out.calls, out.notes = worst.calls, worst.notes
+        return cost.add(out).add(self.block_cost(stmt.orelse, env, cls, symbols))
+
+    def while_cost(self, stmt: ast.While, env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        body = self.block_cost(stmt.body, dict(env), cls, symbols).add(self.expr_cost(stmt.test, env, cls, symbols))
+        n = self._while_bound(stmt, env, body.sleep[0])
+        if n is None:
+            n = self.options["max_iterations"]
+            body.notes.append(f"unbounded loop at line {stmt.lineno} counted as {n} passes")
+        worst_n, expected_n = self._passes(stmt, n)
+        return body.scaled(worst_n, expected_n)
+
+    def _while_bound(self, stmt: ast.While, env: Dict[str, Any], sleep_per_pass: float):
+        # while counter < limit: ... counter += step
+        t = stmt.test
+        if isinstance(t, ast.Compare) and len(t.ops) == 1 and isinstance(t.ops[0], (ast.Lt, ast.LtE)):
+            counter, limit = _dotted(t.left), _const(t.comparators[0], env)
+            start = env.get(counter) if isinstance(env.get(counter), (int, float)) else 0
+            for n in ast.walk(stmt):
+                if isinstance(n, ast.AugAssign) and _dotted(n.target) == counter and isinstance(n.op, ast.Add):
+                    step = _const(n.value, env)
+                    if isinstance(limit, (int, float)) and isinstance(step, (int, float)) and step > 0:
+                        return max(0, math.ceil((limit - start) / step))
+        # while True: ... if elapsed >= timeout: return/break   (time budget over the sleep per pass)
+        for n in ast.walk(stmt):
+            if isinstance(n, ast.If) and isinstance(n.test, ast.Compare) and len(n.test.ops) == 1 \
+                    and isinstance(n.test.ops[0], (ast.Gt, ast.GtE)) \
+                    and any(isinstance(x, (ast.Return, ast.Break, ast.Raise)) for b in n.body for x in ast.walk(b)):
+                budget = _const(n.test.comparators[0], env)
+                if isinstance(budget, (int, float)) and sleep_per_pass > 0:
+                    return math.ceil(budget / sleep_per_pass) + 1
+        return None
+
+    # ---- expressions ----
+    def expr_cost(self, node: ast.AST, env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        cost = Cost()
+        for n in ast.walk(node):
+            if isinstance(n, ast.Lambda):
+                continue
+            if isinstance(n, ast.Call):
+                cost.add(self.call_cost(n, env, cls, symbols))
+        return cost
+
+    def call_cost(self, call: ast.Call, env: Dict[str, Any], cls: str = None, symbols=None) -> Cost:
+        name = _dotted(call.func)
+        if name in SLEEP_CALLS:
+            seconds = _const(call.args[0], env) if call.args else 0
+            cost = Cost()
+            if not isinstance(seconds, (int, float)):
+                seconds = 1.0
+                cost.notes.append(f"sleep with unknown duration at line {call.lineno} counted as 1s")
+            cost.sleep = (float(seconds), float(seconds))
+            return cost
+        if name in REMOTE_CALLS or any(name.endswith("." + r) for r in REMOTE_CALLS):
+            return Cost(remote=(1.0, 1.0))
+        if not isinstance(call.func, ast.Attribute):
+            return Cost()
+        receiver, method = _dotted(call.func.value), call.func.attr
+        target = None
+        if cls is not None and receiver == "self":
+            target = cls
+        elif symbols is not None and receiver:
+            target = symbols(receiver)
+        if not target:
+            return Cost()
+        cost = self.method_cost(target, method, call, env)
+        if cls is None:
+            # top level of a step: remember which helper call the time goes to
+            cost.calls = {f"{target}.{method}": cost.sleep[0] + cost.remote[0] * self.options["remote_worst"]}
+        return cost
+
+    # ---- step modules ----
+    def step_costs(self, step_src: str) -> List[Dict[str, Any]]:
+        """Per step function: {'function', 'kind', 'pattern', 'line', 'cost' (summary)}, in file order."""
+        tree = ast.parse(step_src)
+        module_symbols, local_symbols = pu.build_instance_symbols(tree, self.helpers)
+        by_lower = {c.lower(): c for c in self.helpers}
+        definitions = {(d["function"], d["line"]): d for d in pu.extract_step_definitions(step_src)}
+        out = []
+        for node in tree.body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            local = local_symbols.get(node, {})
+
+            def symbols(key, local=local):
+                cls = local.get(key) if not key.startswith("context.") else None
+                cls = module_symbols.get(key) if cls is None else cls
+                return cls if cls is not None else by_lower.get(key.split(".")[-1].lower())
+
+            cost = self.block_cost(node.body, {}, None, symbols)
+            for d in node.decorator_list:
+                definition = definitions.get((node.name, d.lineno))
+                if definition:
+                    out.append({"function": node.name, "kind": definition["kind"], "pattern": definition["pattern"],
+                                "line": definition["line"], "cost": cost})
+        return out
+
+
+def estimate_feature_cost(feature_text: str, step_src: str, helper_sources: List[str],
+                          options: Dict[str, float] = None) -> Dict[str, Any]:
+    """
+    Cost per step definition and per scenario run (one per Examples row), sorted by worst case.
+    Returns {'steps': [...], 'scenarios': [...], 'unmatched_steps': n}. A scenario row with steps that
+    match no definition has 'unmatched' > 0 and 'partial': True: its figures leave those steps out.
+    """
+    estimator = CostEstimator(load_helpers(helper_sources), options)
+    steps = estimator.step_costs(step_src)
+    definitions = [{k: s[k] for k in ("function", "kind", "pattern", "line")} for s in steps]
+    feature_steps = pu.expand_feature_steps(feature_text)
+    match = pu.match_steps_to_definitions(feature_steps, definitions)
+    headers = [s["header"] for s in pu.parse_feature_text(feature_text)["scenarios"]]
+    background = [s for s in feature_steps if s["scenario"] == -1]
+    runs = {}
+    for s in feature_steps:
+        if s["scenario"] >= 0:
+            runs.setdefault((s["scenario"], s["row"]), []).append(s)
+    scenarios = []
+    for (idx, row), run_steps in runs.items():
+        total, unmatched = Cost(), 0
+        for s in background + run_steps:
+            n = match["matched"].get((s["kind"], s["text"]))
+            if n is not None:
+                total.add(steps[n]["cost"])
+            else:
+                unmatched += 1
+        if unmatched:
+            total.notes.append(f"{unmatched} step(s) match no definition and count as 0s")
+        name = headers[idx] if idx < len(headers) else f"scenario {idx}"
+        scenarios.append(dict(total.summary(estimator.options), scenario=name if row is None else f"{name} [row {row + 1}]",
+                              steps=len(background) + len(run_steps), unmatched=unmatched, partial=bool(unmatched)))
+    step_rows = [dict(s["cost"].summary(estimator.options), function=s["function"], kind=s["kind"],
+                      pattern=s["pattern"], line=s["line"]) for s in steps]
+    return {"steps": sorted(step_rows, key=lambda r: -r["worst_seconds"]),
+            "scenarios": sorted(scenarios, key=lambda r: -r["worst_seconds"]),
+            "unmatched_steps": len(match["unmatched"])}
+
+
+def _read(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Estimate scenario runtime from step modules and helpers, statically.")
+    ap.add_argument("--steps", required=True, help="step module")
+    ap.add_argument("--helpers", nargs="+", default=[], help="helper modules")
+    ap.add_argument("--feature", help="feature file (per-scenario totals)")
+    ap.add_argument("--remote-expected", type=float, default=DEFAULTS["remote_expected"], help="seconds per remote call")
+    ap.add_argument("--remote-worst", type=float, default=DEFAULTS["remote_worst"], help="seconds per remote call")
+    ap.add_argument("--poll-fraction", type=float, default=DEFAULTS["poll_fraction"],
+                    help="share of its passes a poll loop runs in the expected case")
+    ap.add_argument("--max-iterations", type=int, default=DEFAULTS["max_iterations"], help="passes of an unbounded loop")
+    ap.add_argument("--json", dest="json_path", help="write the full report here")
+    args = ap.parse_args(argv)
+
+    options = {"remote_expected": args.remote_expected, "remote_worst": args.remote_worst,
+               "poll_fraction": args.poll_fraction, "max_iterations": args.max_iterations}
+    helper_sources = [_read(p) for p in args.helpers]
+    if args.feature:
+        report = estimate_feature_cost(_read(args.feature), _read(args.steps), helper_sources, options)
+    else:
+        estimator = CostEstimator(load_helpers(helper_sources), options)
+        rows = [dict(s["cost"].summary(estimator.options), function=s["function"], kind=s["kind"],
+                     pattern=s["pattern"], line=s["line"]) for s in estimator.step_costs(_read(args.steps))]
+        report = {"steps": sorted(rows, key=lambda r: -r["worst_seconds"]), "scenarios": []}
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    for s in report["scenarios"]:
+        partial = f"  (partial: {s['unmatched']} of {s['steps']} steps unmatched)" if s["partial"] else ""
+        print(f"{s['worst_seconds']:>8.0f}s worst {s['expected_seconds']:>8.0f}s expected  {s['scenario']}{partial}")
+    print("Slowest steps:")
+    for s in report["steps"][:10]:
+        top = next(iter(s["by_helper_call"]), "")
+        print(f"{s['worst_seconds']:>8.0f}s worst {s['expected_seconds']:>8.0f}s expected  "
+              f"[{s['kind']}] {s['pattern']}" + (f"  <- {top}" if top else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
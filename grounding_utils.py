@@ -0,0 +1,191 @@
+"""
+grounding_utils.py
+
+Retrieval-based grounding for LLM prompts.
+
+Instead of pasting every file in templates/ into each prompt, templates are chunked
+(.feature files per Scenario, Python files per class method / step function, anything else
+per paragraph) and indexed with BM25. Each prompt then carries only the top-N chunks relevant
+to its step or text part.
+
+Functions exported:
+- chunk_template(name, content)
+- GroundingRetriever(templates): .search(query, top_n), .grounding_text(query, top_n, max_chars)
+- get_retriever(templates): retriever cached per template set
+"""
+
+import ast
+import math
+import re
+from collections import Counter
+from typing import List, Dict, Any
+
+import llm_utils
+
+DEFAULT_TOP_N = 6
+DEFAULT_MAX_CHARS = 12000
+MAX_CHUNK_CHARS = 4000
+TITLE_WEIGHT = 3
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+")
+SCENARIO_PATTERN = re.compile(r"^\s*(Scenario Outline:|Scenario:|Background:)", re.IGNORECASE)
+PY_BLOCK_PATTERN = re.compile(r"^(\s*)(class\s+\w+|def\s+\w+|@(given|when|then|step)\b)")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; snake_case / CamelCase identifiers also contribute their parts."""
+    out = []
+    for tok in TOKEN_PATTERN.findall(text or ""):
+        parts = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", tok)
+        low = tok.lower()
+        out.append(low)
+        out.extend(p.lower() for p in parts if p.lower() != low)
+    return out
+
+
+# -------------------------
+# Chunking
+# -------------------------
+def _chunk(name: str, title: str, text: str) -> Dict[str, Any]:
+    return {"source": name, "title": title, "text": text[:MAX_CHUNK_CHARS]}
+
+
+def _chunk_feature(name: str, content: str) -> List[Dict[str, Any]]:
+    lines = content.splitlines()
+    header = next((l.strip() for l in lines if l.strip().lower().startswith("feature:")), "")
+    chunks, cur = [], None
+    for line in lines:
+        if SCENARIO_PATTERN.match(line):
+            if cur:
+                chunks.append(cur)
+            cur = [line]
+        elif cur is not None:
+            cur.append(line)
+    if cur:
+        chunks.append(cur)
+    if not chunks:
+        return [_chunk(name, header or name, content)]
+    return [_chunk(name, c[0].strip(), "\n".join([header] + c).strip()) for c in chunks]
+
+
+def _chunk_python(name: str, content: str) -> List[Dict[str, Any]]:
+    try:
+        tree = ast.parse(content)
+    except SyntaxError:
+        return _chunk_python_lines(name, content)
+    lines = content.splitlines()
+
+    def src(node):
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        return "\n".join(lines[start - 1:node.end_lineno])
+
+    chunks = []
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+            for m in methods:
+                chunks.append(_chunk(name, f"{node.name}.{m.name}", f"class {node.name}:\n{src(m)}"))
+            if not methods:
+                chunks.append(_chunk(name, node.name, src(node)))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            title = node.name
+            for d in node.decorator_list:
+                if isinstance(d, ast.Call) and d.args and isinstance(d.args[0], ast.Constant):
+                    title = f"{ast.unparse(d.func)}: {d.args[0].value}"
+                    break
+            chunks.append(_chunk(name, title, src(node)))
+    return chunks or [_chunk(name, name, content)]
+
+
+def _chunk_python_lines(name: str, content: str) -> List[Dict[str, Any]]:
+    """Fallback for files that do not parse: split at top-level class/def/decorator lines."""
+    chunks, cur = [], []
+    for line in content.splitlines():
+        m = PY_BLOCK_PATTERN.match(line)
+        starts_block = m and (not m.group(1) or m.group(2).startswith("def")) and not (
+            cur and cur[-1].lstrip().startswith("@"))
+        if starts_block and any(l.strip() for l in cur):
+            chunks.append(cur)
+            cur = []
+        cur.append(line)
+    if any(l.strip() for l in cur):
+        chunks.append(cur)
+    return [_chunk(name, c[0].strip(), "\n".join(c)) for c in chunks]
+
+
+def _chunk_paragraphs(name: str, content: str) -> List[Dict[str, Any]]:
+    paras = [p.strip() for p in re.split(r"\n\s*\n", content) if p.strip()]
+    return [_chunk(name, p.splitlines()[0][:80], p) for p in paras]
+
+
+def chunk_template(name: str, content: str) -> List[Dict[str, Any]]:
+    """Split one template into retrievable chunks: {'source', 'title', 'text'}."""
+    low = name.lower()
+    if low.endswith(".feature"):
+        return _chunk_feature(name, content)
+    if low.endswith(".py") or low.endswith(".py.txt") or PY_BLOCK_PATTERN.search(content):
+        return _chunk_python(name, content)
+    return _chunk_paragraphs(name, content)
+
+
+# -------------------------
+# BM25 retriever
+# -------------------------
+class GroundingRetriever:
+    """BM25 (k1, b) index over template chunks."""
+
+    def __init__(self, templates: Dict[str, str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks = [c for name, content in templates.items() for c in chunk_template(name, content or "")]
+        # titles (scenario names, decorator patterns, Class.method) are repeated to weigh them up
+        self._tfs = [Counter(tokenize(((c["title"] + "\n") * TITLE_WEIGHT) + c["text"])) for c in self.chunks]
+        self._lens = [sum(tf.values()) for tf in self._tfs]
+        self._avg_len = (sum(self._lens) / len(self._lens)) if self._lens else 0.0
+        df = Counter()
+        for tf in self._tfs:
+            df.update(tf.keys())
+        n = len(self.chunks)
+        self._idf = {t: math.log(1 + (n - f + 0.5) / (f + 0.5)) for t, f in df.items()}
+        self._postings = {}
+        for i, tf in enumerate(self._tfs):
+            for t in tf:
+                self._postings.setdefault(t, []).append(i)
+
+    def search(self, query: str, top_n: int = DEFAULT_TOP_N) -> List[Dict[str, Any]]:
+        """Return the top_n chunks for query, best first, each with a 'score'."""
+        scores = {}
+        for t in set(tokenize(query)):
+            idf = self._idf.get(t)
+            if idf is None:
+                continue
+            for i in self._postings[t]:
+                f = self._tfs[i][t]
+                norm = f + self.k1 * (1 - self.b + self.b * self._lens[i] / (self._avg_len or 1))
+                scores[i] = scores.get(i, 0.0) + idf * f * (self.k1 + 1) / norm
+        best = sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:top_n]
+        return [dict(self.chunks[i], score=round(sc, 4)) for i, sc in best]
+
+    def grounding_text(self, query: str, top_n: int = DEFAULT_TOP_N, max_chars: int = DEFAULT_MAX_CHARS) -> str:
+        """Concatenate the top chunks as '### source — title' sections, capped at max_chars."""
+        out, used = [], 0
+        for c in self.search(query, top_n):
+            block = f"### {c['source']} — {c['title']}\n{c['text']}"
+            if out and used + len(block) > max_chars:
+                break
+            out.append(block[:max_chars])
+            used += len(block)
+        return "\n\n".join(out)
+
+
+_RETRIEVERS = {}
+
+
+def get_retriever(templates: Dict[str, str]) -> GroundingRetriever:
+    """Build (or reuse) the retriever for this exact template set."""
+    key = llm_utils.fingerprint(templates)
+    if key not in _RETRIEVERS:
+        if len(_RETRIEVERS) >= 8:
+            _RETRIEVERS.pop(next(iter(_RETRIEVERS)))
+        _RETRIEVERS[key] = GroundingRetriever(templates)
+    return _RETRIEVERS[key]
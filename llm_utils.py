@@ -0,0 +1,953 @@
+"""
+llm_utils.py
+
+LLM helpers for the BDD Step Wizard.
+
+Functions exported:
+- estimate_tokens(text)
+- plan_batches(step_texts, fixed_tokens, max_prompt_tokens, max_steps_per_batch)
+- build_batch_prompt(keyed_steps, helper_text, grounding_text)
+- extract_json_values(text), parse_batch_response(text, keys): tolerant JSON extraction
+- validate_calls(calls, helpers): check LLM calls against the helper symbol table
+- encode_helper_catalog(helpers), encode_templates(templates): compact, deterministic prompt sections
+- batch_map_steps(step_texts, model, helper_classes, templates, ...)
+- StubModel: offline stand-in for genai.GenerativeModel
+- LLMResponseCache / CachedModel: persistent prompt-fingerprint response cache
+- TokenBucket / LLMExecutor: bounded-concurrency, rate-limited LLM calls with retries
+- get_shared_model(api_key, model_name): process-wide model registry with single-flight coalescing
+- HedgedModel: per-request deadline plus an optional hedged duplicate request
+
+`model` is anything with generate_content(prompt) returning an object with a .text attribute,
+so genai.GenerativeModel and StubModel are interchangeable.
+"""
+
+import hashlib
+import json
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Any, Tuple, Callable
+
+CHARS_PER_TOKEN = 4
+DEFAULT_CACHE_FILE = ".llm_cache.sqlite3"
+DEFAULT_MAX_PROMPT_TOKENS = 200000
+DEFAULT_MAX_STEPS_PER_BATCH = 40
+PER_STEP_OVERHEAD_TOKENS = 8
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token); good enough for batch budgeting."""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+# -------------------------
+# Stub model (offline / tests)
+# -------------------------
+class StubResponse:
+    def __init__(self, text: str, cached: bool = False):
+        self.text = text
+        self.cached = cached
+
+
+class StubModel:
+    """
+    Local stand-in for genai.GenerativeModel.
+    responder(prompt) -> response text; every prompt is recorded in .prompts.
+    """
+
+    def __init__(self, responder: Callable[[str], str], model_name: str = "stub"):
+        self.responder = responder
+        self.model_name = model_name
+        self.prompts = []
+
+    def generate_content(self, prompt: str, **kwargs):
+        self.prompts.append(prompt)
+        text = self.responder(prompt)
+        if kwargs.get("stream"):
+            # one chunk per line, like a streamed Gemini response
+            return iter([StubResponse(line) for line in text.splitlines(keepends=True)])
+        return StubResponse(text)
+
+
+def chunk_text(chunk) -> str:
+    """Text of one streamed response chunk; chunks without text parts (e.g. a final safety block) give ''."""
+    try:
+        return getattr(chunk, "text", "") or ""
+    except ValueError:
+        return ""
+
+
+# -------------------------
+# Batched step mapping
+# -------------------------
+BATCH_PROMPT_TEMPLATE = """
+You are a BDD step mapping generator for test automation.
+Only use the helper classes and methods shown below.
+
+Helper classes and method signatures (class name, then one indented line per method):
+{helper_text}
+
+Grounding context (sample BDD and step templates):
+{grounding_text}
+
+Map EVERY step below. Respond strictly with one JSON object whose keys are the step ids and whose
+values are JSON lists of call objects, e.g.
+{{"s1": [{{"class_name": "Rubrik", "method_name": "get_oracle_db_id", "save_to": "context.db_id"}}], "s2": []}}
+
+Steps:
+{steps_text}
+"""
+
+
+def _format_arg(arg) -> str:
+    if isinstance(arg, str):
+        return arg
+    out = arg["name"]
+    if arg.get("type"):
+        out += f": {arg['type']}"
+    if arg.get("default") is not None:
+        out += f"={arg['default']}"
+    return out
+
+
+def _format_args(args: List[Any]) -> str:
+    """Argument list with a bare * before keyword-only args when there is no *args to mark them."""
+    out, starred = [], False
+    for a in args:
+        if isinstance(a, dict):
+            if a["name"].startswith("*") and not a["name"].startswith("**"):
+                starred = True
+            elif a.get("kwonly") and not starred:
+                out.append("*")
+                starred = True
+        out.append(_format_arg(a))
+    return ", ".join(out)
+
+
+def _format_method(name: str, spec) -> str:
+    """spec: None, [arg names], or {"args": [...], "returns": ...} (parse_helper_file_typed)."""
+    if isinstance(spec, dict):
+        sig = f"{name}({_format_args(spec.get('args', []))})"
+        return sig + (f" -> {spec['returns']}" if spec.get("returns") else "")
+    if isinstance(spec, (list, tuple)):
+        return f"{name}({_format_args(spec)})"
+    return f"{name}(...)"
+
+
+_CATALOG_CACHE = {}
+
+
+def encode_helper_catalog(helpers: Dict[str, Any]) -> str:
+    """
+    Signature table for prompts, e.g.
+        Rubrik
+          get_oracle_db_id(db_name: str, host=None) -> str
+    helpers is {class: [method names]}, {class: {method: [args]}} or parse_helper_file_typed output.
+    Classes and methods are sorted and private methods (leading underscore) are skipped, so the same
+    helper set always gives byte-identical text (cached per helper set), a stable prompt prefix.
+    """
+    key = fingerprint(helpers)
+    text = _CATALOG_CACHE.get(key)
+    if text is None:
+        lines = []
+        for cls in sorted(helpers):
+            methods = helpers[cls]
+            items = methods.items() if isinstance(methods, dict) else ((m, None) for m in methods)
+            lines.append(cls)
+            lines.extend(f"  {_format_method(m, spec)}" for m, spec in sorted(items, key=lambda kv: kv[0])
+                         if not m.startswith("_"))
+        text = "\n".join(lines)
+        if len(_CATALOG_CACHE) >= 32:
+            _CATALOG_CACHE.pop(next(iter(_CATALOG_CACHE)))
+        _CATALOG_CACHE[key] = text
+    return text
+
+
+def encode_templates(templates: Dict[str, str]) -> str:
+    """Templates as '### name' sections in name order (no JSON escaping of newlines and quotes)."""
+    return "\n\n".join(f"### {name}\n{(templates[name] or '').strip()}" for name in sorted(templates))
+
+
+def build_batch_prompt(keyed_steps: List[Tuple[str, str]], helper_text: str, grounding_text: str) -> str:
+    steps_text = "\n".join(f"{key}: {text}" for key, text in keyed_steps)
+    return BATCH_PROMPT_TEMPLATE.format(helper_text=helper_text, grounding_text=grounding_text, steps_text=steps_text)
+
+
+def plan_batches(step_texts: List[str], fixed_tokens: int,
+                 max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+                 max_steps_per_batch: int = DEFAULT_MAX_STEPS_PER_BATCH) -> List[List[int]]:
+    """
+    Greedily pack step indices into batches so that the shared context (fixed_tokens) plus the
+    steps of each batch stay under max_prompt_tokens. A batch always holds at least one step.
+    """
+    batches, cur, cur_tokens = [], [], fixed_tokens
+    for i, text in enumerate(step_texts):
+        cost = estimate_tokens(text) + PER_STEP_OVERHEAD_TOKENS
+        if cur and (cur_tokens + cost > max_prompt_tokens or len(cur) >= max_steps_per_batch):
+            batches.append(cur)
+            cur, cur_tokens = [], fixed_tokens
+        cur.append(i)
+        cur_tokens += cost
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+REPAIR_PROMPT_TEMPLATE = """
+Some of your step mappings were invalid. Only use the helper classes and methods shown below.
+
+Helper classes and method signatures (class name, then one indented line per method):
+{helper_text}
+
+Fix ONLY these steps. Valid calls already kept for a step are shown for context and stay as they are;
+answer only with the calls that replace the invalid ones (or all calls of a step that has no answer).
+Respond strictly with one JSON object keyed by the same step ids, whose values are JSON lists of call
+objects ({{"class_name", "method_name", "param_map", "save_to"}}) in execution order.
+
+{items_text}
+"""
+
+_JSON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _string_spans(text: str, start: int = 0):
+    """
+    Split text[start:] into (begin, end, is_string) runs: JSON string literals (quotes included,
+    escapes honoured) and the text between them. An unterminated string runs to the end.
+    """
+    i = run = start
+    while i < len(text):
+        if text[i] != '"':
+            i += 1
+            continue
+        if run < i:
+            yield run, i, False
+        j = i + 1
+        while j < len(text) and text[j] != '"':
+            j += 2 if text[j] == "\\" else 1
+        end = min(j + 1, len(text))
+        yield i, end, True
+        run = i = end
+    if run < len(text):
+        yield run, len(text), False
+
+
+def _balanced_end(text: str, start: int) -> int:
+    """Index just past the bracket matching text[start] ('{' or '['), skipping strings; -1 if unclosed."""
+    depth = 0
+    for begin, end, is_string in _string_spans(text, start):
+        if is_string:
+            continue
+        for i in range(begin, end):
+            ch = text[i]
+            if ch in "{[":
+                depth += 1
+            elif ch in "}]":
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+    return -1
+
+
+def _relaxed_loads(fragment: str) -> Any:
+    """
+    json.loads, retried once with trailing commas removed and Python literals (True/None) mapped;
+    the fixes only touch text outside string values.
+    """
+    try:
+        return json.loads(fragment)
+    except ValueError:
+        parts = []
+        for begin, end, is_string in _string_spans(fragment):
+            part = fragment[begin:end]
+            if not is_string:
+                part = re.sub(r",\s*([}\]])", r"\1", part)
+                part = re.sub(r"\b(True|False|None)\b", lambda m: _JSON_LITERALS[m.group(1)], part)
+            parts.append(part)
+        return json.loads("".join(parts))
+
+
+def extract_json_values(text: str) -> List[Any]:
+    """
+    Every top-level JSON object / array embedded in text (prose, ``` fences, several objects), in
+    order. Brackets inside strings are ignored; a fragment that does not decode is skipped and the
+    scan continues inside it, so one stray bracket no longer loses the whole response.
+    """
+    text = text or ""
+    out, i = [], 0
+    while i < len(text):
+        if text[i] in "{[":
+            end = _balanced_end(text, i)
+            if end != -1:
+                try:
+                    out.append(_relaxed_loads(text[i:end]))
+                    i = end
+                    continue
+                except ValueError:
+                    pass
+        i += 1
+    return out
+
+
+def _salvage_member(text: str, key: str) -> Any:
+    """Decode the value of '"key": <value>' directly, for objects that are broken elsewhere or truncated."""
+    for m in re.finditer(r'"%s"\s*:\s*' % re.escape(key), text):
+        start = m.end()
+        if start < len(text) and text[start] in "{[":
+            end = _balanced_end(text, start)
+            if end != -1:
+                try:
+                    return _relaxed_loads(text[start:end])
+                except ValueError:
+                    continue
+    return None
+
+
+def parse_batch_response(text: str, keys: List[str]) -> Tuple[Dict[str, List[Any]], List[str]]:
+    """
+    Parse a keyed JSON object response. Returns ({key: [calls]}, missing_keys).
+    Non-list values are wrapped in a list; unknown keys are ignored. Keys spread over several
+    objects are merged, and keys the whole-object parse missed are salvaged member by member.
+    """
+    out = {}
+    for data in extract_json_values(text):
+        if isinstance(data, dict):
+            for k in keys:
+                if k not in out and data.get(k) is not None:
+                    out[k] = data[k]
+    for k in keys:
+        if k not in out:
+            v = _salvage_member(text or "", k)
+            if v is not None:
+                out[k] = v
+    out = {k: (v if isinstance(v, list) else [v]) for k, v in out.items()}
+    return out, [k for k in keys if k not in out]
+
+
+def _signature(spec) -> Tuple[set, set, bool]:
+    """(all arg names, required arg names, accepts **kwargs) for a helper method spec; unknown -> None."""
+    if isinstance(spec, dict):
+        args = spec.get("args", [])
+    elif isinstance(spec, (list, tuple)):
+        args = [{"name": a, "default": None} if isinstance(a, str) else a for a in spec]
+    else:
+        return None
+    names = {a["name"] for a in args if not a["name"].startswith("*")}
+    if isinstance(spec, dict):
+        required = {a["name"] for a in args if not a["name"].startswith("*") and a.get("default") is None}
+    else:
+        required = set()   # plain arg-name lists carry no defaults
+    return names, required, any(a["name"].startswith("**") for a in args)
+
+
+def validate_calls(calls: List[Any], helpers: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Check LLM calls against the helper symbol table ({class: [methods]}, {class: {method: [args]}} or
+    parse_helper_file_typed output). 'class' / 'method' keys are accepted as aliases.
+    Returns (valid calls normalized to class_name / method_name, problems).
+    """
+    valid, problems = [], []
+    for call in calls:
+        if not isinstance(call, dict):
+            problems.append(f"not a call object: {call!r}"[:120])
+            continue
+        call = dict(call)
+        cls = call.pop("class", None) or call.get("class_name")
+        meth = call.pop("method", None) or call.get("method_name")
+        call["class_name"], call["method_name"] = cls, meth
+        methods = helpers.get(cls)
+        if methods is None:
+            problems.append(f"unknown class {cls!r}")
+            continue
+        if meth not in methods:
+            problems.append(f"{cls} has no method {meth!r}")
+            continue
+        sig = _signature(methods[meth]) if isinstance(methods, dict) else None
+        param_map = call.get("param_map") or {}
+        if not isinstance(param_map, dict):
+            problems.append(f"{cls}.{meth}: param_map must be an object")
+            continue
+        if sig:
+            names, required, var_kw = sig
+            unknown = sorted(set(param_map) - names) if not var_kw else []
+            missing = sorted(required - set(param_map))
+            if unknown or missing:
+                problems.append(f"{cls}.{meth}: " + "; ".join(
+                    ([f"unknown args {unknown}"] if unknown else []) + ([f"missing args {missing}"] if missing else [])))
+                continue
+        valid.append(call)
+    return valid, problems
+
+
+def batch_map_steps(step_texts: List[str], model, helper_classes: Dict[str, Any], templates: Dict[str, str],
+                    max_prompt_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+                    max_steps_per_batch: int = DEFAULT_MAX_STEPS_PER_BATCH,
+                    helper_text: str = None, grounding_text: str = None,
+                    executor: "LLMExecutor" = None, retriever=None,
+                    grounding_top_n: int = 12, grounding_max_chars: int = 24000,
+                    repair_rounds: int = 1) -> Tuple[Dict[int, List[Any]], List[str]]:
+    """
+    Map all steps of a feature with as few model calls as the token budget allows.
+
+    Identical step texts are sent once. The helper catalog is encoded once (encode_helper_catalog,
+    unless helper_text is given) and reused verbatim as the prompt prefix of every batch. With a
+    retriever (grounding_utils.GroundingRetriever) each batch carries only the template chunks
+    relevant to its steps; otherwise all templates are sent. With an LLMExecutor, batches run
+    concurrently with rate limiting and retries.
+
+    Answers are validated against helper_classes (when given). Steps whose answer was missing or
+    invalid get up to repair_rounds targeted repair prompts listing only those steps, their invalid
+    calls and problems; the answer replaces only the invalid calls, valid ones are kept. Calls still
+    invalid afterwards are dropped and reported.
+    Returns ({step_index: [calls]}, errors); steps the model did not answer get an empty list.
+    """
+    if helper_text is None:
+        helper_text = encode_helper_catalog(helper_classes)
+    if retriever is not None:
+        grounding_for = lambda texts: retriever.grounding_text("\n".join(texts), grounding_top_n, grounding_max_chars)
+        fixed_tokens = estimate_tokens(build_batch_prompt([], helper_text, "")) + grounding_max_chars // CHARS_PER_TOKEN
+    else:
+        if grounding_text is None:
+            grounding_text = encode_templates(templates)
+        grounding_for = lambda texts: grounding_text
+        fixed_tokens = estimate_tokens(build_batch_prompt([], helper_text, grounding_text))
+    unique = list(dict.fromkeys(t.strip() for t in step_texts))
+    text_of = {f"s{i + 1}": t for i, t in enumerate(unique)}
+
+    def _run(prompts, label):
+        def _generate(prompt):
+            resp = model.generate_content(prompt)
+            return (getattr(resp, "text", "") or "").strip()
+        if executor is not None:
+            return executor.map(_generate, prompts, labels=[f"{label} {n + 1}" for n in range(len(prompts))])
+        results = []
+        for prompt in prompts:
+            try:
+                results.append({"ok": True, "value": _generate(prompt)})
+            except Exception as e:
+                results.append({"ok": False, "error": e})
+        return results
+
+    # key -> call slots (None where the call was invalid) / invalid calls as answered / [problems]
+    answers, invalid, problems, errors = {}, {}, {}, []
+
+    def _merge(k, replacements):
+        """Put repair answers into the invalid slots of k: one per slot, or all at the first slot."""
+        slots = answers[k]
+        holes = [n for n, c in enumerate(slots) if c is None]
+        if len(replacements) == len(holes):
+            for n, c in zip(holes, replacements):
+                slots[n] = c
+            return slots
+        return slots[:holes[0]] + list(replacements) + [c for c in slots[holes[0]:] if c is not None]
+
+    def _collect(batch_keys, results):
+        for keys, res in zip(batch_keys, results):
+            if not res["ok"]:
+                errors.append(f"LLM batch of {len(keys)} steps failed: {res['error']}")
+                continue
+            text = res["value"]
+            if not text:
+                errors.append(f"LLM returned an empty response for a batch of {len(keys)} steps.")
+                continue
+            parsed, missing = parse_batch_response(text, keys)
+            if len(missing) == len(keys):
+                errors.append(f"LLM output not keyed JSON:\n{text[:400]}")
+            for k in keys:
+                if k in missing:
+                    problems.setdefault(k, ["no answer for this step"])
+                    continue
+                new = parsed[k] if isinstance(parsed[k], list) else [parsed[k]]
+                # a repair answers only for the invalid calls; the valid ones are kept in place
+                slots = _merge(k, new) if k in invalid else new
+                answers[k], invalid[k], bad = [], [], []
+                for c in slots:
+                    calls, why = validate_calls([c], helper_classes) if helper_classes else ([c], [])
+                    if why:
+                        answers[k].append(None)
+                        invalid[k].append(c)
+                        bad.extend(why)
+                    else:
+                        answers[k].extend(calls)
+                if bad:
+                    problems[k] = bad
+                else:
+                    problems.pop(k, None)
+                    del invalid[k]
+
+    batch_keys = [[f"s{i + 1}" for i in batch]
+                  for batch in plan_batches(unique, fixed_tokens, max_prompt_tokens, max_steps_per_batch)]
+    prompts = [build_batch_prompt([(k, text_of[k]) for k in keys], helper_text, grounding_for([text_of[k] for k in keys]))
+               for keys in batch_keys]
+    _collect(batch_keys, _run(prompts, "map batch"))
+
+    for _ in range(repair_rounds):
+        # only steps with a (partly) invalid or missing answer from a call that did come back
+        todo = [k for k in text_of if k in problems]
+        if not todo:
+            break
+        fixed_repair = estimate_tokens(REPAIR_PROMPT_TEMPLATE.format(helper_text=helper_text, items_text=""))
+        repair_keys = [[todo[i] for i in batch] for batch in plan_batches(
+            [text_of[k] for k in todo], fixed_repair, max_prompt_tokens, max_steps_per_batch)]
+        def _item(k):
+            if k not in invalid:
+                return f"{k}: {text_of[k]}\n  problems: {'; '.join(problems[k])}"
+            kept = [c for c in answers[k] if c is not None]
+            return (f"{k}: {text_of[k]}\n  kept calls: {json.dumps(kept)}\n"
+                    f"  invalid calls to replace: {json.dumps(invalid[k])}\n  problems: {'; '.join(problems[k])}")
+        prompts = [REPAIR_PROMPT_TEMPLATE.format(helper_text=helper_text, items_text="\n\n".join(_item(k) for k in keys))
+                   for keys in repair_keys]
+        _collect(repair_keys, _run(prompts, "repair batch"))
+
+    for k, bad in problems.items():
+        errors.append(f"Step '{text_of[k]}': {'; '.join(bad)}")
+    by_text = {text_of[k]: [c for c in calls if c is not None] for k, calls in answers.items()}
+    return {i: by_text.get(t.strip(), []) for i, t in enumerate(step_texts)}, errors
+
+
+# -------------------------
+# Persistent response cache
+# -------------------------
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace so re-indented but otherwise identical prompts share a cache entry."""
+    return re.sub(r"\s+", " ", prompt or "").strip()
+
+
+def fingerprint(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        if not isinstance(p, str):
+            p = json.dumps(p, sort_keys=True, default=str)
+        h.update(p.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk (sqlite) cache of LLM responses keyed by (model name, normalized prompt hash, grounding hash).
+
+    max_bytes / max_entries bound the store; the least recently used entries are evicted first.
+    ttl_seconds (optional) expires entries by age. stats() reports hits, misses and hit rate for
+    this process plus the persisted size.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_FILE, max_bytes: int = 50 * 1024 * 1024,
+                 max_entries: int = 20000, ttl_seconds: float = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = self.misses = self.expired = self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, model TEXT, response TEXT,
+            created REAL, last_used REAL, size INTEGER)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses(last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str, grounding_hash: str = "") -> str:
+        return fingerprint(model_name, fingerprint(normalize_prompt(prompt)), grounding_hash or "")
+
+    def get(self, key: str) -> str:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                self.expired += 1
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model_name: str, response: str) -> None:
+        if not response:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, model_name, response, now, now, len(response.encode("utf-8"))))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count, total = count - 1, total - size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "expired": self.expired, "evictions": self.evictions, "entries": count, "bytes": total}
+
+
+class CachedModel:
+    """
+    Wrap a model so generate_content is served from an LLMResponseCache when possible.
+    grounding_hash should fingerprint the grounding material the prompts were built from.
+    With stream=True a hit is returned as a single chunk, and a miss is passed through chunk by
+    chunk and only cached once the stream has been consumed to the end.
+    """
+
+    def __init__(self, model, cache: LLMResponseCache, model_name: str, grounding_hash: str = ""):
+        self.model = model
+        self.cache = cache
+        self.model_name = model_name
+        self.grounding_hash = grounding_hash
+
+    def generate_content(self, prompt: str, **kwargs):
+        key = self.cache.make_key(self.model_name, prompt, self.grounding_hash)
+        text = self.cache.get(key)
+        if text is not None:
+            resp = StubResponse(text, cached=True)
+            return iter([resp]) if kwargs.get("stream") else resp
+        resp = self.model.generate_content(prompt, **kwargs)
+        if kwargs.get("stream"):
+            return self._stream_and_store(key, resp)
+        self.cache.put(key, self.model_name, getattr(resp, "text", "") or "")
+        return resp
+
+    def _stream_and_store(self, key: str, chunks):
+        pieces = []
+        for chunk in chunks:
+            pieces.append(chunk_text(chunk))
+            yield chunk
+        self.cache.put(key, self.model_name, "".join(pieces))
+
+
+# -------------------------
+# Concurrent, rate-limited executor
+# -------------------------
+RETRYABLE_ERROR_NAMES = ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                         "InternalServerError", "GatewayTimeout", "TimeoutError", "ConnectionError")
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Quota / transient server errors are retried; bad requests and auth errors are not."""
+    names = [c.__name__ for c in type(exc).__mro__]
+    return any(n in RETRYABLE_ERROR_NAMES for n in names) or "429" in str(exc)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Block until tokens are available; returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class LLMExecutor:
+    """
+    Runs LLM calls on a thread pool with bounded concurrency, a token-bucket rate limit
+    (requests_per_minute) and jittered exponential backoff on retryable errors.
+
+    Every call is recorded in .calls as {'label', 'latency', 'attempts', 'ok', 'error'};
+    stats() summarizes them. If telemetry (telemetry.SessionTelemetry) is set, each finished
+    call is also reported through telemetry.record_task.
+    """
+
+    def __init__(self, max_concurrency: int = 4, requests_per_minute: float = 60, max_retries: int = 3,
+                 base_delay: float = 1.0, max_delay: float = 30.0, retryable: Callable[[BaseException], bool] = is_retryable,
+                 telemetry=None):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(requests_per_minute / 60.0, capacity=max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+        self.telemetry = telemetry
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def call(self, fn: Callable, *args, label: str = "", **kwargs) -> Dict[str, Any]:
+        """Run fn with rate limiting and retries; never raises, returns a result dict."""
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.bucket.acquire()
+            try:
+                value = fn(*args, **kwargs)
+                res = {"ok": True, "value": value, "error": None}
+                break
+            except Exception as e:
+                if attempt > self.max_retries or not self.retryable(e):
+                    res = {"ok": False, "value": None, "error": e}
+                    break
+                # full jitter: sleep somewhere in [0, min(max_delay, base * 2^attempt)]
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+        res.update({"label": label, "latency": time.monotonic() - start, "attempts": attempt})
+        record = {k: (str(v) if k == "error" and v is not None else v) for k, v in res.items() if k != "value"}
+        with self._lock:
+            self.calls.append(record)
+        if self.telemetry is not None:
+            self.telemetry.record_task(**record)
+        return res
+
+    def map(self, fn: Callable, items: List[Any], labels: List[str] = None) -> List[Dict[str, Any]]:
+        """Apply fn to every item concurrently; results keep the order of items."""
+        labels = labels or [f"call {i + 1}" for i in range(len(items))]
+        if len(items) <= 1:
+            return [self.call(fn, item, label=lbl) for item, lbl in zip(items, labels)]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as pool:
+            futures = [pool.submit(self.call, fn, item, label=lbl) for item, lbl in zip(items, labels)]
+            return [f.result() for f in futures]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lat = sorted(c["latency"] for c in self.calls)
+            failed = sum(1 for c in self.calls if not c["ok"])
+            retries = sum(c["attempts"] - 1 for c in self.calls)
+        if not lat:
+            return {"calls": 0, "failed": 0, "retries": 0}
+        pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]
+        return {"calls": len(lat), "failed": failed, "retries": retries,
+                "p50": pct(0.5), "p95": pct(0.95), "max": lat[-1], "total_latency": sum(lat)}
+
+
+# -------------------------
+# Process-wide client registry + single-flight
+# -------------------------
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs fn, callers arriving while
+    it is in flight wait and receive the same result (or exception). Nothing is kept afterwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}   # key -> [done Event, result, exception]
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            slot = self._inflight.get(key)
+            leader = slot is None
+            if leader:
+                slot = self._inflight[key] = [threading.Event(), None, None]
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            slot[0].wait()
+            if slot[2] is not None:
+                raise slot[2]
+            return slot[1]
+        try:
+            slot[1] = fn()
+            return slot[1]
+        except Exception as e:
+            slot[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            slot[0].set()
+
+
+class SharedModel:
+    """
+    A model shared by every session of the process. Identical non-streaming prompts that are in
+    flight at the same time go out as one request; streamed calls pass straight through.
+    """
+
+    def __init__(self, model, model_name: str):
+        self.model = model
+        self.model_name = model_name
+        self.flight = SingleFlight()
+
+    def generate_content(self, prompt: str, **kwargs):
+        if kwargs.get("stream"):
+            return self.model.generate_content(prompt, **kwargs)
+        key = fingerprint(prompt, sorted((k, repr(v)) for k, v in kwargs.items()))
+        return self.flight.do(key, lambda: self.model.generate_content(prompt, **kwargs))
+
+    def generate_uncoalesced(self, prompt: str, **kwargs):
+        """Always a fresh request (used for hedged duplicates, which must not join the original)."""
+        return self.model.generate_content(prompt, **kwargs)
+
+
+def _genai_model(api_key: str, model_name: str):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model_name)
+    # A GenerativeModel picks up the configured client on its first request. Binding it now keeps a
+    # later configure() for another key from retargeting this model. The SDK has no public hook for
+    # this, so when the private attribute is missing, say so instead of silently sharing one key.
+    try:
+        from google.generativeai import client as genai_client
+        if not hasattr(model, "_client"):
+            raise AttributeError("GenerativeModel has no _client attribute")
+        model._client = genai_client.get_default_generative_client()
+    except (ImportError, AttributeError) as e:
+        logger.warning("Gemini client not bound to %s (%s): the model uses whichever API key was configured last",
+                       model_name, e)
+    return model
+
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_shared_model(api_key: str, model_name: str = "gemini-2.5-flash",
+                     factory: Callable[[str, str], Any] = None) -> SharedModel:
+    """
+    Return the process-wide SharedModel for (api_key, model_name), creating it once.
+    factory(api_key, model_name) builds the underlying model (default: google.generativeai).
+    """
+    key = (fingerprint(api_key), model_name)
+    with _REGISTRY_LOCK:
+        shared = _REGISTRY.get(key)
+        if shared is None:
+            shared = _REGISTRY[key] = SharedModel((factory or _genai_model)(api_key, model_name), model_name)
+        return shared
+
+
+def registry_stats() -> Dict[str, Any]:
+    with _REGISTRY_LOCK:
+        models = list(_REGISTRY.values())
+    return {"models": len(models), "requests": sum(m.flight.calls for m in models),
+            "coalesced": sum(m.flight.coalesced for m in models)}
+
+
+# -------------------------
+# Deadlines + hedged requests
+# -------------------------
+class LLMDeadlineExceeded(Exception):
+    """No response within the request deadline (deliberately not retryable)."""
+
+
+_HEDGE_POOL = None
+_HEDGE_POOL_LOCK = threading.Lock()
+HEDGE_POOL_WORKERS = 32
+
+
+def _hedge_pool() -> ThreadPoolExecutor:
+    """One worker pool for every HedgedModel in the process (one model is created per session)."""
+    global _HEDGE_POOL
+    with _HEDGE_POOL_LOCK:
+        if _HEDGE_POOL is None:
+            _HEDGE_POOL = ThreadPoolExecutor(max_workers=HEDGE_POOL_WORKERS, thread_name_prefix="llm-hedge")
+        return _HEDGE_POOL
+
+
+class HedgedModel:
+    """
+    Bound every non-streaming request by `deadline` seconds. With hedge=True, a duplicate request is
+    fired if the first has not answered after the hedge delay: the hedge_percentile of recently
+    observed latencies (hedge_after until min_samples latencies are known). The first successful
+    response wins; if both fail, the first error is raised. Past the deadline LLMDeadlineExceeded is
+    raised and the caller falls back to its deterministic answer. Abandoned requests finish in the
+    background and are ignored. Requests run on a process-wide pool shared by all instances.
+    """
+
+    def __init__(self, model, deadline: float = 20.0, hedge: bool = True, hedge_percentile: float = 0.95,
+                 hedge_after: float = 5.0, min_samples: int = 10):
+        self.model = model
+        self.model_name = getattr(model, "model_name", "")
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=200)
+        self.stats = {"requests": 0, "hedged": 0, "hedge_won": 0, "deadline_exceeded": 0}
+        self._lock = threading.Lock()
+        self._pool = _hedge_pool()
+
+    def hedge_delay(self) -> float:
+        with self._lock:
+            lat = sorted(self.latencies)
+        if len(lat) < self.min_samples:
+            return self.hedge_after
+        return lat[min(len(lat) - 1, int(self.hedge_percentile * len(lat)))]
+
+    def _timed(self, fn, prompt: str, kwargs: Dict[str, Any]):
+        start = time.monotonic()
+        resp = fn(prompt, **kwargs)
+        with self._lock:
+            self.latencies.append(time.monotonic() - start)
+        return resp
+
+    def generate_content(self, prompt: str, **kwargs):
+        if kwargs.get("stream"):
+            return self.model.generate_content(prompt, **kwargs)
+        start = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+        primary = self._pool.submit(self._timed, self.model.generate_content, prompt, kwargs)
+        pending, first_error = {primary}, None
+        hedge_at = start + self.hedge_delay() if self.hedge else None
+        while pending:
+            now = time.monotonic()
+            if now >= start + self.deadline:
+                break
+            timeout = start + self.deadline - now
+            if hedge_at is not None:
+                timeout = min(timeout, max(0.0, hedge_at - now))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if fut is not primary:
+                        with self._lock:
+                            self.stats["hedge_won"] += 1
+                    return fut.result()
+                first_error = first_error or fut.exception()
+            if hedge_at is not None and time.monotonic() >= hedge_at and (pending or first_error is None):
+                hedge_at = None
+                with self._lock:
+                    self.stats["hedged"] += 1
+                duplicate = getattr(self.model, "generate_uncoalesced", self.model.generate_content)
+                pending = set(pending) | {self._pool.submit(self._timed, duplicate, prompt, kwargs)}
+        if first_error is not None and not pending:
+            raise first_error
+        with self._lock:
+            self.stats["deadline_exceeded"] += 1
+        raise LLMDeadlineExceeded(f"no LLM response within {self.deadline:.1f}s")
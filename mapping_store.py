@@ -1,5 +1,5 @@
 #mapping_store.py
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from datetime import datetime
 import streamlit as st
 
@@ -20,6 +20,25 @@ def save_mapping(step_pattern, helper_chain, project="Default", source="manual",
     }
     coll.update_one({"step_pattern": step_pattern}, {"$set": doc}, upsert=True)
 
+def save_mappings_bulk(entries, project="Default", source="mined", confidence=0.8, overwrite=False):
+    """entries: list of (step_pattern, helper_chain). Existing patterns are kept unless overwrite=True."""
+    now = datetime.utcnow().isoformat()
+    ops = []
+    for step_pattern, helper_chain in entries:
+        doc = {
+            "step_pattern": step_pattern,
+            "project": project,
+            "helper_chain": helper_chain,
+            "created_on": now,
+            "source": source,
+            "confidence": confidence
+        }
+        ops.append(UpdateOne({"step_pattern": step_pattern}, {"$set" if overwrite else "$setOnInsert": doc}, upsert=True))
+    if not ops:
+        return 0
+    res = _get_collection().bulk_write(ops, ordered=False)
+    return res.upserted_count + (res.modified_count if overwrite else 0)
+
 def fetch_mappings(project="Default"):
     return list(_get_collection().find({"project": project}, {"_id": 0}))
 
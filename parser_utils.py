@@ -34,6 +34,8 @@ def load_grounding_templates(template_dir="templates"):
         st.warning(f"⚠️ Template folder '{template_dir}' not found.")
         return templates
     for fn in os.listdir(template_dir):
+        if not os.path.isfile(os.path.join(template_dir, fn)):
+            continue
         try:
             with open(os.path.join(template_dir, fn), "r", encoding="utf-8") as f:
                 templates[fn] = f.read()
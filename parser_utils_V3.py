@@ -7,22 +7,38 @@ for the BDD Step Wizard.
 Functions exported:
 - extract_steps_with_inheritance(feature_text)
 - parse_feature_text(feature_text)
-- parse_helper_file(source_code)
+- parse_helper_file(source_code), parse_helper_file_typed(source_code)
 - infer_helper_and_method(step_text, helpers)
-- generate_step_impl(step, calls, default_instances, known_context_vars)
+- step_pattern_and_args(step), generate_step_impl(step, calls, default_instances, known_context_vars)
+- hoist_fetcher_calls(steps, calls_per_step, default_instances=None)
+- merge_step_definitions(steps, calls_per_step), generate_step_definitions(...)
 - build_module(imports, instantiations, step_impls)
+- splice_step_module(existing_src, imports, instantiations, step_impls): incremental update of a step file
+- build_environment_module(imports, instantiations): behave environment.py with lazy helpers on context
+- build_dispatch_module(definitions): step module with a constant-time step dispatch index for behave
 - collect_context_vars(steps, include_all=False)
-- validate_stepfile_against_helpers(step_src, helpers)
+- build_instance_symbols(tree, helpers), validate_stepfile_against_helpers(step_src, helpers)
 - detect_ambiguous_steps(feature_steps)
-- mapping store helpers: load_mappings_store(), save_mappings_store(), suggest_mapping_for_step()
-- text->bdd generator: generate_bdd_from_text(...)
+- match_feature_steps(feature_text, step_src): behave-style matching -> unmatched / ambiguous / unused definitions
+- mapping store helpers: load_mappings_store(), save_mappings_store(), suggest_mapping_for_step(), save_mappings_bulk()
+- text->bdd generator: load_grounding_templates(), generate_bdd_from_text(...), stream_bdd_from_text(...)
 """
 
 import ast
+import builtins
+import copy
+import keyword
 import re
+from collections import OrderedDict
 import json
 import os
-from typing import List, Dict, Any, Tuple
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Iterator
+
+import llm_utils
+from telemetry import InstrumentedModel, SessionTelemetry
 
 STEP_LINE_PATTERN = re.compile(r'^\s*(Given|When|Then|And|But)\s+(.*)', re.IGNORECASE)
 PARAM_PATTERN = re.compile(r'\{([^}]+)\}|<([^>]+)\>|\"([^\"]+)\"|\'([^\']+)\'')
@@ -37,11 +53,18 @@ def extract_steps_with_inheritance(feature_text: str) -> List[Dict[str, Any]]:
     """
     Return list of steps with 'kind' normalized to 'given'/'when'/'then'
     And/But inherit the previous explicit type.
-    Each step: {'kind': 'given'/'when'/'then', 'text': '...', 'params': [...], 'raw': raw_line}
+    Each step: {'kind': 'given'/'when'/'then', 'text': '...', 'params': [...], 'raw': raw_line, 'scenario': idx}
+    'scenario' is the index of the enclosing Scenario/Scenario Outline (-1 for Background steps).
     """
     steps = []
     last_kind = None
+    scenario_idx = -1
     for raw in feature_text.splitlines():
+        stripped = raw.strip().lower()
+        if stripped.startswith("scenario outline:") or stripped.startswith("scenario:"):
+            scenario_idx += 1
+            last_kind = None
+            continue
         m = STEP_LINE_PATTERN.match(raw)
         if not m:
             continue
@@ -60,7 +83,7 @@ def extract_steps_with_inheritance(feature_text: str) -> List[Dict[str, Any]]:
             for g in pm.groups():
                 if g:
                     params.append(g.strip("<>"))
-        steps.append({"kind": kind, "text": rest, "params": params, "raw": raw})
+        steps.append({"kind": kind, "text": rest, "params": params, "raw": raw, "scenario": scenario_idx})
     return steps
 
 
@@ -113,6 +136,43 @@ def parse_helper_file(source_code: str) -> Dict[str, Dict[str, List[str]]]:
     return out
 
 
+def parse_helper_file_typed(source_code: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Like parse_helper_file, keeping argument kinds, annotations and defaults:
+    {ClassName: {method_name: {"args": [{"name", "type", "default"}], "returns": str or None}}}
+    *args / **kwargs keep their stars in "name"; keyword-only args carry "kwonly": True;
+    a leading self / cls is dropped.
+    """
+    try:
+        tree = ast.parse(source_code)
+    except Exception:
+        return {}
+    src = lambda n: ast.unparse(n) if n is not None else None
+    out = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        methods = {}
+        for item in node.body:
+            if not isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            a = item.args
+            positional = a.posonlyargs + a.args
+            defaults = [None] * (len(positional) - len(a.defaults)) + list(a.defaults)
+            args = [{"name": p.arg, "type": src(p.annotation), "default": src(d)} for p, d in zip(positional, defaults)]
+            if args and args[0]["name"] in ("self", "cls"):
+                args = args[1:]
+            if a.vararg:
+                args.append({"name": "*" + a.vararg.arg, "type": src(a.vararg.annotation), "default": None})
+            args += [{"name": p.arg, "type": src(p.annotation), "default": src(d), "kwonly": True}
+                     for p, d in zip(a.kwonlyargs, a.kw_defaults)]
+            if a.kwarg:
+                args.append({"name": "**" + a.kwarg.arg, "type": src(a.kwarg.annotation), "default": None})
+            methods[item.name] = {"args": args, "returns": src(item.returns)}
+        out[node.name] = methods
+    return out
+
+
 # -------------------------
 # Mapping store (persistence)
 # -------------------------
@@ -139,9 +199,10 @@ def make_step_key(step_text: str) -> str:
     """
     Normalize step text to key form: lowercase, strip variable placeholders
     e.g. "Trigger backup for <db_name>" -> "trigger backup for <param>"
-    We'll replace angle-bracket contents with "<param>" token.
+    We'll replace angle-bracket contents with "<param>" token; behave-style "{db_name}"
+    decorator placeholders normalize the same way.
     """
-    k = re.sub(r'<[^>]+>', '<param>', step_text)
+    k = re.sub(r'<[^>]+>|\{[^}]+\}', '<param>', step_text)
     k = re.sub(r'\s+', ' ', k).strip().lower()
     return k
 
@@ -174,6 +235,26 @@ def save_mapping_for_step(step_text: str, mapping_obj: Dict[str, Any], store_fil
     return save_mappings_store(store, store_filepath)
 
 
+def save_mappings_bulk(entries: Dict[str, Dict[str, Any]], store_filepath: str = MAPPINGS_STORE_FILE,
+                       overwrite: bool = False) -> int:
+    """
+    Merge many {step text or key: mapping_obj} entries into the store with a single load/save.
+    Existing mappings are kept unless overwrite=True. Returns the number of entries written.
+    """
+    store = load_mappings_store(store_filepath)
+    mappings = store.setdefault("mappings", {})
+    written = 0
+    for step_text, mapping_obj in entries.items():
+        key = make_step_key(step_text)
+        if key in mappings and not overwrite:
+            continue
+        mappings[key] = mapping_obj
+        written += 1
+    if written and not save_mappings_store(store, store_filepath):
+        return 0
+    return written
+
+
 # -------------------------
 # Heuristics
 # -------------------------
@@ -210,10 +291,135 @@ def infer_helper_and_method(step_text: str, helpers: Dict[str, Dict[str, List[st
 # -------------------------
 # Code generation
 # -------------------------
+def _param_identifier(name: str) -> str:
+    """Feature parameter name -> valid Python identifier ('db name' -> 'db_name', 'class' -> 'class_')."""
+    ident = re.sub(r'\W+', '_', name.strip()).strip('_') or "param"
+    if ident[0].isdigit():
+        ident = "p_" + ident
+    return ident + "_" if keyword.iskeyword(ident) else ident
+
+
+def step_pattern_and_args(step: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """
+    Behave decorator pattern and function arguments for a parsed step. Every parameter the parser
+    found becomes a '{name}' field: <db> and {db} -> {db}, "quoted value" -> "{quoted_value}".
+    e.g. 'Trigger backup for <db name> on "host1"' -> ('Trigger backup for {db_name} on "{host1}"', ['db_name', 'host1'])
+    """
+    args = []
+
+    def _field(m):
+        raw = next(g for g in m.groups() if g)
+        ident = _param_identifier(raw.strip("<>"))
+        if ident not in args:
+            args.append(ident)
+        quote = m.group(0)[0] if m.group(0)[0] in "\"'" else ""
+        return f"{quote}{{{ident}}}{quote}"
+
+    return PARAM_PATTERN.sub(_field, step["text"]), args
+
+
+def _step_body_lines(step: Dict[str, Any], calls: List[Dict[str, Any]], default_instances: Dict[str, str],
+                     known_context_vars: set, args: List[str], instance_prefix: str = "") -> List[str]:
+    body_lines = []
+
+    # If Given and no calls -> assign params into context
+    if step['kind'] == 'given' and not calls:
+        for p in args:
+            body_lines.append(f"context.{p} = {p}")
+            known_context_vars.add(p)
+        return body_lines
+    # iterate through calls
+    for c in calls:
+        save_to = c.get("save_to", "").strip()
+        # Resolve target context var name
+        if save_to:
+            if save_to.startswith("context."):
+                ctx_name = save_to.split(".", 1)[1]
+            else:
+                # store in context by default to persist across steps
+                ctx_name = save_to
+            ctx_target = f"context.{ctx_name}"
+        else:
+            ctx_name = None
+            ctx_target = None
+
+        # if ctx_target already present in known_context_vars and the call is flagged as fetcher, skip calling again
+        # We assume a call that returns a DB id is a fetcher if its method name contains 'get' or 'id' or 'fetch'
+        method = c.get("method")
+        is_fetcher = bool(method) and any(tok in method.lower() for tok in ("get", "id", "fetch"))
+        if ctx_name and ctx_name in known_context_vars and is_fetcher and not c.get("memo"):
+            # skip invocation and just reuse existing context var
+            # (user can choose to force re-fetch by providing a different save_to)
+            continue
+
+        # Pre-assign parameter expressions as local variables named after parameter names
+        # If expression is like 'context.xyz' or literal or saved var, use as provided
+        param_map = c.get("param_map", {}) or {}
+        param_lines = [f"{pname} = {expr}" for pname, expr in param_map.items()]
+
+        # Build instance name
+        inst = c.get("instance") or default_instances.get(c.get("class"), (c.get("class") or "").lower())
+        # only bare names move onto context; 'context.rubrik' (or any dotted receiver) is already qualified
+        inst = inst if "." in inst else instance_prefix + inst
+        call_expr = f"{inst}.{method}({', '.join(param_map.keys())})"
+
+        # memoized fetch (see hoist_fetcher_calls): only the first step of a scenario calls the helper,
+        # later steps reuse the shared context member
+        if c.get("memo"):
+            memo_name = c["memo"]
+            # hasattr, not "is None": a fetch that legitimately returned None is not repeated
+            body_lines.append(f"if not hasattr(context, '{memo_name}'):")
+            body_lines.extend("    " + l for l in param_lines)
+            body_lines.append(f"    context.{memo_name} = {call_expr}")
+            known_context_vars.add(memo_name)
+            if ctx_name and ctx_name != memo_name:
+                body_lines.append(f"{ctx_target} = context.{memo_name}")
+                known_context_vars.add(ctx_name)
+            continue
+
+        body_lines.extend(param_lines)
+
+        # If we need to save result, put into context.<name>
+        if ctx_target:
+            body_lines.append(f"{ctx_target} = {call_expr}")
+            known_context_vars.add(ctx_name)
+        else:
+            body_lines.append(call_expr)
+    return body_lines
+
+
+# pre-validated template every step function is stamped from (decorator kind / pattern / args / body replaced)
+_STEP_TEMPLATE = ast.parse("@given('')\ndef step_impl(context):\n    pass\n").body[0]
+_STEP_CODE_CACHE = OrderedDict()      # key -> (fragment, context vars the step adds)
+STEP_CODE_CACHE_SIZE = 5000
+STEP_CODE_STATS = {"hits": 0, "misses": 0, "invalid": 0}
+
+
+class InvalidStepMapping(ValueError):
+    """A mapping expression of a step is not valid Python, so no step function can be generated."""
+
+
+def _render_step_ast(kind: str, pattern: str, args: List[str], body_lines: List[str]) -> str:
+    fn = copy.deepcopy(_STEP_TEMPLATE)
+    fn.decorator_list[0].func.id = kind
+    fn.decorator_list[0].args[0].value = pattern      # a Constant: quotes in step text are escaped by unparse
+    fn.args.args = [ast.arg(arg=a) for a in ["context"] + args]
+    try:
+        fn.body = ast.parse("\n".join(body_lines)).body or [ast.Pass()]
+        fragment = ast.unparse(ast.fix_missing_locations(fn)) + "\n"
+        compile(fragment, "<step_impl>", "exec")
+    except SyntaxError as e:
+        # a mapping expression that is not valid Python: no stub in the module, the caller reports it
+        STEP_CODE_STATS["invalid"] += 1
+        raise InvalidStepMapping(f"{e.msg}: {(e.text or '').strip()}".rstrip(": ")) from e
+    return fragment
+
+
 def generate_step_impl(step: Dict[str, Any],
                        calls: List[Dict[str, Any]],
                        default_instances: Dict[str, str],
-                       known_context_vars: set) -> str:
+                       known_context_vars: set,
+                       instance_prefix: str = "") -> str:
     """
     Create behave step implementation string for one step.
     - When calls include a 'save_to' value:
@@ -221,75 +427,723 @@ def generate_step_impl(step: Dict[str, Any],
         if it's a bare name -> assign to context.<name> (we will prefer context storage)
     - known_context_vars: set of names already in context; used to avoid re-fetching
     - For parameter mapping, expressions are used as provided (e.g., "context.db_id", '"literal"', "saved_var")
+    - instance_prefix: "context." when helpers live on context (see build_environment_module)
+    Raises InvalidStepMapping (known_context_vars unchanged) when a mapping expression is not Python.
+    The function is stamped from a pre-parsed AST template (decorator pattern from
+    step_pattern_and_args) and syntax-checked once; fragments are cached keyed by the step, its calls
+    and the context vars they depend on, so regenerating an unchanged feature is a lookup.
     """
-    decorator = f"@{step['kind']}('{step['text']}')"
-    func_args = ["context"] + step.get("params", [])
-    func_sig = f"def step_impl({', '.join(func_args)}):"
-    body_lines = []
+    names = {(c.get("save_to") or "").strip().replace("context.", "", 1) for c in calls} | {c.get("memo") for c in calls}
+    key = json.dumps([step.get("kind"), step.get("text"), calls, instance_prefix,
+                      [default_instances.get(c.get("class")) for c in calls],
+                      sorted(n for n in names if n and n in known_context_vars)], sort_keys=True, default=str)
+    cached = _STEP_CODE_CACHE.get(key)
+    if cached is not None:
+        STEP_CODE_STATS["hits"] += 1
+        _STEP_CODE_CACHE.move_to_end(key)
+        fragment, added = cached
+        known_context_vars.update(added)
+        return fragment
+    STEP_CODE_STATS["misses"] += 1
+    pattern, args = step_pattern_and_args(step)
+    before = set(known_context_vars)
+    body_lines = _step_body_lines(step, calls, default_instances, known_context_vars, args, instance_prefix)
+    try:
+        fragment = _render_step_ast(step['kind'], pattern, args, body_lines)
+    except InvalidStepMapping:
+        known_context_vars.intersection_update(before)
+        raise
+    _STEP_CODE_CACHE[key] = (fragment, frozenset(known_context_vars - before))
+    if len(_STEP_CODE_CACHE) > STEP_CODE_CACHE_SIZE:
+        _STEP_CODE_CACHE.popitem(last=False)
+    return fragment
 
-    # If Given and no calls -> assign params into context
-    if step['kind'] == 'given' and not calls:
-        for p in step.get("params", []):
-            body_lines.append(f"context.{p} = {p}")
-            known_context_vars.add(p)
-    else:
-        # iterate through calls
-        for c in calls:
-            # if this call was marked as "use_cached" and its desired save_to already in known_context_vars, skip invocation
-            # But we still might want to call if user explicitly forces it (not implemented here).
-            save_to = c.get("save_to", "").strip()
-            # Resolve target context var name
-            if save_to:
-                if save_to.startswith("context."):
-                    ctx_name = save_to.split(".", 1)[1]
-                    ctx_target = f"context.{ctx_name}"
-                else:
-                    # store in context by default to persist across steps
-                    ctx_name = save_to
-                    ctx_target = f"context.{ctx_name}"
-            else:
-                ctx_name = None
-                ctx_target = None
-
-            # if ctx_target already present in known_context_vars and the call is flagged as fetcher, skip calling again
-            # We assume a call that returns a DB id is a fetcher if its method name contains 'get' or 'id' or 'fetch'
-            method = c.get("method")
-            is_fetcher = False
-            if method and any(tok in method.lower() for tok in ("get", "id", "fetch")):
-                is_fetcher = True
-            if ctx_name and ctx_name in known_context_vars and is_fetcher:
-                # skip invocation and just reuse existing context var
-                # (user can choose to force re-fetch by providing a different save_to)
+
+# -------------------------
+# Scenario dataflow (fetch hoisting)
+# -------------------------
+PURE_FETCH_PREFIXES = ("get", "fetch", "find", "list", "lookup", "describe")
+# tokens that mark a read as time-varying (status polls, existence checks, row data ...)
+VOLATILE_FETCH_TOKENS = ("status", "activity", "event", "events", "recent", "poll", "wait", "progress",
+                         "data", "exists", "table", "database", "snapshot", "current", "timestamp")
+
+
+def is_idempotent_fetch(call: Dict[str, Any]) -> bool:
+    """
+    A call is an idempotent fetch when its method is a read ('get_', 'fetch_', 'list_' ...) and
+    does not look time-varying. An explicit "pure": True/False on the call overrides the heuristic.
+    e.g. Rubrik.get_mssql_db_id_details -> True, Rubrik.get_activity_status -> False
+    """
+    if "pure" in call:
+        return bool(call["pure"])
+    tokens = [t for t in re.split(r'[_\W]+', (call.get("method") or "").lower()) if t]
+    if not tokens or tokens[0] not in PURE_FETCH_PREFIXES:
+        return False
+    return not any(t in VOLATILE_FETCH_TOKENS for t in tokens)
+
+
+def _context_member(expr: str) -> str:
+    """Return 'xyz' for 'context.xyz' expressions, else None."""
+    m = re.match(r'^\s*context\.(\w+)\s*$', expr or "")
+    return m.group(1) if m else None
+
+
+def _fetch_signature(call: Dict[str, Any], default_instances: Dict[str, str]) -> Tuple:
+    """
+    Return a hashable (instance, method, args) signature for a fetch whose inputs are all
+    context members or literals; None when an input is step-local (bare names, expressions).
+    """
+    args = []
+    for pname, expr in sorted((call.get("param_map") or {}).items()):
+        if _context_member(expr) is None:
+            try:
+                ast.literal_eval(expr)
+            except Exception:
+                return None
+        args.append((pname, expr.strip()))
+    inst = call.get("instance") or default_instances.get(call.get("class"), (call.get("class") or "").lower())
+    return (inst, call.get("method"), tuple(args))
+
+
+def _save_target(call: Dict[str, Any]) -> str:
+    save_to = (call.get("save_to") or "").strip()
+    return save_to.split(".", 1)[1] if save_to.startswith("context.") else (save_to or None)
+
+
+def hoist_fetcher_calls(steps: List[Dict[str, Any]],
+                        calls_per_step: List[List[Dict[str, Any]]],
+                        default_instances: Dict[str, str] = None) -> Tuple[List[List[Dict[str, Any]]], Dict[str, Any]]:
+    """
+    Whole-scenario dataflow pass over the call chains of a feature.
+
+    Idempotent fetches (see is_idempotent_fetch) that are issued more than once in a scenario with
+    the same inputs are memoized: every occurrence is tagged with "memo": <context member>, so the
+    first step of the scenario that has the inputs performs the remote call and later steps reuse
+    the result from context. Inputs are versioned per scenario (Given params and save_to targets
+    redefine context members), and a fetch whose inputs change between occurrences is left alone.
+    The memo member is named after the method plus a hash of (instance, method, args), so fetches
+    with different inputs get different members even across features.
+    default_instances ({Class: instance name}) resolves calls that name a class but no instance, so
+    the same helper reached both ways is recognised as one fetch.
+
+    Returns (new_calls_per_step, report); the input lists are not modified.
+    report: {'hoisted': [{'instance', 'method', 'memo', 'steps', 'calls_saved'}], 'calls_saved': n}
+    """
+    default_instances = default_instances or {}
+    new_calls = [[dict(c) for c in (calls or [])] for calls in calls_per_step]
+    occurrences = {}   # signature -> list of (step_idx, call_idx, versions-of-inputs, scenario)
+    unsafe = set()
+
+    scenarios = {}
+    for i, s in enumerate(steps):
+        scenarios.setdefault(s.get("scenario", 0), []).append(i)
+
+    for sc, indices in scenarios.items():
+        versions = {}
+        seen_versions = {}
+        for i in indices:
+            step, calls = steps[i], new_calls[i]
+            if step["kind"] == "given" and not calls:
+                for p in step.get("params", []):
+                    versions[p] = versions.get(p, 0) + 1
                 continue
+            for ci, c in enumerate(calls):
+                sig = _fetch_signature(c, default_instances) if is_idempotent_fetch(c) else None
+                if sig is not None:
+                    inputs = tuple(versions.get(_context_member(e), 0) for _, e in sig[2] if _context_member(e))
+                    if seen_versions.setdefault(sig, inputs) != inputs:
+                        unsafe.add(sig)
+                    occurrences.setdefault(sig, []).append((i, ci, sc))
+                target = _save_target(c)
+                if target:
+                    versions[target] = versions.get(target, 0) + 1
 
-            # Pre-assign parameter expressions as local variables named after parameter names
-            param_map = c.get("param_map", {}) or {}
-            for pname, expr in param_map.items():
-                # If expression is like 'context.xyz' or literal or saved var, use as provided
-                body_lines.append(f"{pname} = {expr}")
+    used_targets = {_save_target(c) for calls in new_calls for c in calls if _save_target(c)}
+    report = {"hoisted": [], "calls_saved": 0}
+    for sig, occ in occurrences.items():
+        per_scenario = {}
+        for _, _, sc in occ:
+            per_scenario[sc] = per_scenario.get(sc, 0) + 1
+        saved = sum(n - 1 for n in per_scenario.values())
+        if sig in unsafe or saved == 0:
+            continue
+        inst, method, _ = sig
+        # dedicated context member, never shared with a user save_to (which may be rewritten elsewhere);
+        # named after the whole signature, so a fetch with other inputs in another feature never reuses
+        # it once the definitions of several features are merged into one module
+        base = re.sub(r'^(get|fetch|find|list|lookup|describe)_', '', method) or method
+        base = f"{base}_{llm_utils.fingerprint(list(sig))[:8]}"
+        memo, n = base, 2
+        while memo in used_targets:
+            memo, n = f"{base}_{n}", n + 1
+        used_targets.add(memo)
+        for i, ci, _ in occ:
+            new_calls[i][ci]["memo"] = memo
+        report["hoisted"].append({"instance": inst, "method": method, "memo": f"context.{memo}",
+                                  "steps": sorted({i for i, _, _ in occ}), "calls_saved": saved})
+        report["calls_saved"] += saved
+    return new_calls, report
 
-            # Build instance name
-            inst = c.get("instance") or default_instances.get(c.get("class"), (c.get("class") or "").lower())
-            args_list = ", ".join(list(param_map.keys()))
-            call_expr = f"{inst}.{method}({args_list})" if args_list else f"{inst}.{method}()"
 
-            # If we need to save result, put into context.<name>
-            if ctx_target:
-                body_lines.append(f"{ctx_target} = {call_expr}")
-                known_context_vars.add(ctx_name)
+# -------------------------
+# Step definition merging
+# -------------------------
+def pattern_key(kind: str, pattern: str, case_sensitive: bool = True) -> Tuple[str, str]:
+    """
+    (kind, pattern) with fields erased ('{db}', '{name:d}', legacy '<db>' -> '{}') and whitespace
+    normalized; case is folded only for case_sensitive=False (behave 1.2's parse matcher).
+    """
+    key = re.sub(r'\s+', ' ', re.sub(r'\{[^}]*\}|<[^>]+>', '{}', pattern)).strip()
+    return kind, key if case_sensitive else key.lower()
+
+
+def step_definition_key(step: Dict[str, Any], case_sensitive: bool = True) -> Tuple[str, str]:
+    """
+    What behave registers a step under: its type and its pattern. Parameter names do not matter for
+    matching ('{db}' and '{name}' collide); case does, as behave 1.3 matches case-sensitively.
+    """
+    pattern, _ = step_pattern_and_args(step)
+    return pattern_key(step["kind"], pattern, case_sensitive)
+
+
+def _chain_signature(calls: List[Dict[str, Any]]) -> str:
+    # memo tags only change how a fetch is cached, not what the step does
+    return json.dumps([{k: v for k, v in c.items() if k != "memo"} for c in calls], sort_keys=True, default=str)
+
+
+def merge_step_definitions(steps: List[Dict[str, Any]], calls_per_step: List[List[Dict[str, Any]]],
+                           case_sensitive: bool = True) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Group step occurrences that behave would register as the same definition (step_definition_key)
+    and keep one definition per group, in first-occurrence order. case_sensitive=False groups
+    wordings that differ only in case, as behave 1.2 matches them with one definition.
+
+    Within a group, an empty When/Then chain counts as unmapped and is compatible with anything;
+    chains that are prefixes of the longest chain merge into it. An empty Given chain is not unmapped:
+    it stores its parameters as context.<param>, so it conflicts with a call chain in the same group.
+    Otherwise the group is a conflict: the most common chain is used (ties: first seen) and the
+    conflict is reported. Given steps without calls conflict when their parameter names differ,
+    since they store different context members.
+
+    Returns (definitions, report):
+      definitions: [{'step', 'calls', 'occurrences': [step indices], 'conflict': None or message}]
+      report: {'occurrences', 'definitions', 'duplicates_removed', 'merged': n, 'conflicts': [...]}
+    """
+    groups = OrderedDict()
+    for i, step in enumerate(steps):
+        groups.setdefault(step_definition_key(step, case_sensitive), []).append(i)
+
+    definitions, report = [], {"occurrences": len(steps), "definitions": 0, "duplicates_removed": 0,
+                               "merged": 0, "conflicts": []}
+    for (kind, pattern), indices in groups.items():
+        chains = OrderedDict()   # signature -> [step indices]
+        for i in indices:
+            if calls_per_step[i]:
+                chains.setdefault(_chain_signature(calls_per_step[i]), []).append(i)
+        conflict = None
+        if not chains:
+            rep = indices[0]
+            arg_lists = {tuple(step_pattern_and_args(steps[i])[1]) for i in indices}
+            if kind == "given" and len(arg_lists) > 1:
+                conflict = f"parameter names differ between occurrences: {sorted(arg_lists)}"
+        else:
+            ordered = [(sig, occ, calls_per_step[occ[0]]) for sig, occ in chains.items()]
+            longest = max(ordered, key=lambda t: len(t[2]))
+            longest_sig = [_chain_signature([c]) for c in longest[2]]
+            compatible = all([_chain_signature([c]) for c in chain] == longest_sig[:len(chain)] for _, _, chain in ordered)
+            if compatible:
+                rep = longest[1][0]
+                if len(ordered) > 1:
+                    report["merged"] += 1
             else:
-                body_lines.append(call_expr)
+                best = max(ordered, key=lambda t: len(t[1]))
+                rep = best[1][0]
+                conflict = f"{len(ordered)} different call chains; using the one from step {rep + 1}"
+            assigns_only = [i for i in indices if not calls_per_step[i]] if kind == "given" else []
+            if assigns_only:
+                # context.<param> = <param> versus helper calls: whichever is used more wins
+                top = max(chains.values(), key=lambda occ: (len(occ), -occ[0]))
+                if (len(assigns_only), -assigns_only[0]) > (len(top), -top[0]):
+                    rep = assigns_only[0]
+                conflict = (f"steps {[i + 1 for i in assigns_only]} only store their parameters on context, "
+                            f"other occurrences call helpers; using the one from step {rep + 1}")
+            # prefer an occurrence whose chain carries the memo tags (same behaviour, fewer remote calls)
+            if calls_per_step[rep]:
+                same = [i for i in chains[_chain_signature(calls_per_step[rep])]
+                        if any(c.get("memo") for c in calls_per_step[i])]
+                rep = same[0] if same else rep
+        if conflict:
+            report["conflicts"].append({"kind": kind, "pattern": steps[indices[0]]["text"], "reason": conflict,
+                                        "steps": [i + 1 for i in indices]})
+        definitions.append({"step": steps[rep], "calls": calls_per_step[rep], "occurrences": indices,
+                            "conflict": conflict})
+    report["definitions"] = len(definitions)
+    report["duplicates_removed"] = len(steps) - len(definitions)
+    return definitions, report
 
-    if not body_lines:
-        body_lines.append("pass")
-    indented = "\n".join("    " + l for l in body_lines)
-    return f"{decorator}\n{func_sig}\n{indented}\n"
+
+def generate_step_definitions(steps: List[Dict[str, Any]], calls_per_step: List[List[Dict[str, Any]]],
+                              default_instances: Dict[str, str],
+                              known_context_vars: set = None,
+                              instance_prefix: str = "",
+                              registered: List[Tuple[str, str]] = None,
+                              case_sensitive: bool = True) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    merge_step_definitions + generate_step_impl; conflicting definitions get a '# CONFLICT' comment.
+    Definitions whose mapping is not valid Python are left out and listed in report['invalid']
+    ({'kind', 'pattern', 'steps', 'reason'}).
+    Fragments come in an order behave registers without AmbiguousStep (registration_order): a
+    specific pattern before a general one that matches its text. A definition no order can save
+    (it clashes both ways, or with one of registered, the (kind, pattern)s of modules behave loads
+    earlier) is left out and reported in report['conflicts']. case_sensitive=False: behave 1.2 matching.
+    """
+    known_context_vars = set() if known_context_vars is None else known_context_vars
+    definitions, report = merge_step_definitions(steps, calls_per_step, case_sensitive)
+    generated, report["invalid"] = [], []
+    for d in definitions:
+        try:
+            code = generate_step_impl(d["step"], d["calls"], default_instances, known_context_vars, instance_prefix)
+        except InvalidStepMapping as e:
+            report["invalid"].append({"kind": d["step"]["kind"], "pattern": d["step"]["text"],
+                                      "steps": [i + 1 for i in d["occurrences"]], "reason": str(e)})
+            continue
+        if d["conflict"]:
+            code = f"# CONFLICT: {d['conflict']} (steps {', '.join(str(i + 1) for i in d['occurrences'])})\n" + code
+        generated.append((d, code))
+    patterns = [{"kind": d["step"]["kind"], "pattern": step_pattern_and_args(d["step"])[0]} for d, _ in generated]
+    order, rejected = registration_order(patterns, [{"kind": k, "pattern": p} for k, p in registered or []],
+                                         case_sensitive)
+    for n, other in rejected.items():
+        d = generated[n][0]
+        report["conflicts"].append({"kind": d["step"]["kind"], "pattern": d["step"]["text"],
+                                    "steps": [i + 1 for i in d["occurrences"]],
+                                    "reason": f"behave rejects it as ambiguous with @{d['step']['kind']}({other!r}); "
+                                              f"not generated, reword one of the steps"})
+    return [generated[n][1] for n in order], report
 
 
 def build_module(imports: List[str], instantiations: List[str], impls: List[str]) -> str:
     header = ["from behave import given, when, then"] + imports + [""]
     insts = instantiations + [""]
-    return "\n".join(header + insts + impls)
+    # identical fragments would register the same step twice (behave rejects that as ambiguous)
+    return "\n".join(header + insts + list(dict.fromkeys(impls)))
+
+
+ENVIRONMENT_TEMPLATE = '''"""
+behave environment hooks generated by the BDD Step Wizard.
+
+Helpers are created lazily, once per test run: before_all puts a proxy on context for each helper
+(steps call context.<helper>.method(...)), the real object is constructed on first use, and
+after_all tears down whatever was actually constructed. Helpers a run never uses are never built.
+"""
+{imports}
+
+TEARDOWN_METHODS = ("close", "disconnect", "shutdown", "logout")
+
+
+class LazyHelper:
+    """Build the helper on first attribute access and forward everything to it."""
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+
+    def __getattr__(self, attr):
+        if self._instance is None:
+            self._instance = self._factory()
+        return getattr(self._instance, attr)
+
+
+HELPER_FACTORIES = {{
+{factories}
+}}
+
+
+def before_all(context):
+    context.helpers = {{name: LazyHelper(name, factory) for name, factory in HELPER_FACTORIES.items()}}
+    for name, helper in context.helpers.items():
+        setattr(context, name, helper)
+
+
+def after_all(context):
+    for name, helper in getattr(context, "helpers", {{}}).items():
+        instance = helper._instance
+        if instance is None:
+            continue
+        for method in TEARDOWN_METHODS:
+            teardown = getattr(instance, method, None)
+            if callable(teardown):
+                try:
+                    teardown()
+                except Exception as e:
+                    print(f"teardown of {{name}}.{{method}}() failed: {{e}}")
+                break
+'''
+
+
+def build_environment_module(imports: List[str], instantiations: List[str]) -> str:
+    """
+    behave environment.py for the helper instantiations ('rubrik = Rubrik()' lines): each becomes a
+    lazy factory registered on context in before_all, so step modules generated with
+    instance_prefix="context." import nothing expensive. Lines that are not simple 'name = expr'
+    assignments are kept as module-level code.
+    """
+    factories, extra = [], []
+    for line in instantiations:
+        try:
+            node = ast.parse(line.strip()).body[0] if line.strip() else None
+        except SyntaxError:
+            node = None
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            factories.append(f"    {node.targets[0].id!r}: lambda: {ast.unparse(node.value)},")
+        elif line.strip():
+            extra.append(line)
+    header = "\n".join([l for l in imports if l.strip()] + ([""] + extra if extra else []))
+    return ENVIRONMENT_TEMPLATE.format(imports=header, factories="\n".join(factories))
+
+
+# -------------------------
+# Step dispatch index
+# -------------------------
+DISPATCH_TEMPLATE = '''"""
+Step dispatch index generated by the BDD Step Wizard.
+
+behave finds the definition for a step by trying every registered definition of its type in turn.
+For the definitions below this module replaces that scan: a step without fields is a dict lookup,
+otherwise the first literal word of the step picks a small bucket and one compiled alternation regex
+per bucket picks the definition. Candidates are ranked by registration order, as behave's own scan
+is, and hand-written definitions registered before the candidate are tried first. Only then does the
+candidate's own matcher parse the step. Anything the index cannot answer (a step no pattern matches,
+a candidate whose matcher disagrees, generic @step definitions) falls through to behave's normal
+lookup, so the results are the same, only faster. behave loads this file
+like any other step module; the index binds to the registered definitions on first use.
+"""
+import re
+
+try:
+    # the registry the runner looks steps up in (behave.step_registry.registry may have been reset since)
+    from behave.runner import the_step_registry as registry
+except ImportError:
+    from behave.step_registry import registry
+
+# step type -> [(decorator pattern, first literal word or "", regex or None when the pattern has no fields)]
+DISPATCH_TABLE = {table}
+
+
+class StepDispatchIndex:
+    def __init__(self, step_registry, table):
+        self.registry = step_registry
+        self.table = table
+        self.original_find_match = step_registry.find_match
+        self.index = None
+        self.stats = {{"hits": 0, "fallbacks": 0}}
+
+    def bind(self):
+        """Resolve the table against the registered definitions (step type -> (literals, buckets, others))."""
+        self.index = {{}}
+        for step_type, entries in self.table.items():
+            registered = self.registry.steps.get(step_type, [])
+            position = {{}}
+            for n, definition in enumerate(registered):
+                pattern = getattr(definition, "pattern", None) or getattr(definition, "string", None)
+                position.setdefault(pattern, (n, definition))
+            literals, grouped, indexed = {{}}, {{}}, set()
+            for pattern, word, rx in entries:
+                found = position.get(pattern)
+                if found is None:
+                    continue
+                indexed.add(found[0])
+                if rx is None:
+                    literals[pattern.lower()] = min(literals.get(pattern.lower(), found), found, key=lambda f: f[0])
+                else:
+                    grouped.setdefault(word, []).append((found, rx))
+            buckets = {{}}
+            for word, members in grouped.items():
+                # registration order: the regex tries alternatives left to right, behave scans in this order
+                members.sort(key=lambda m: m[0][0])
+                regex = re.compile("|".join(f"(?P<d{{n}}>{{rx}})" for n, (_, rx) in enumerate(members)),
+                                   re.IGNORECASE | re.DOTALL)
+                buckets[word] = (regex, [found for found, _ in members])
+            # definitions the table does not know (hand-written ones): they win when registered earlier
+            others = [(n, definition) for n, definition in enumerate(registered) if n not in indexed]
+            self.index[step_type] = (literals, buckets, others)
+
+    def lookup(self, step_type, text):
+        """(registration index, definition) of the earliest indexed candidate for a step, or None."""
+        if self.index is None:
+            self.bind()
+        entry = self.index.get(step_type)
+        if entry is None:
+            return None
+        literals, buckets, _ = entry
+        candidates = [literals.get(text.lower())]
+        words = text.split(None, 1)
+        for word in (words[0].lower() if words else "", ""):
+            bucket = buckets.get(word)
+            if bucket is not None:
+                m = bucket[0].fullmatch(text)
+                if m:
+                    candidates.append(bucket[1][int(m.lastgroup[1:])])
+        candidates = [c for c in candidates if c is not None]
+        return min(candidates, key=lambda c: c[0]) if candidates else None
+
+    def find_match(self, step):
+        found = self.lookup(step.step_type, step.name)
+        if found is not None:
+            n, definition = found
+            for m, other in self.index[step.step_type][2]:
+                if m >= n:
+                    break
+                result = other.match(step.name)
+                if result:
+                    self.stats["hits"] += 1
+                    return result
+            result = definition.match(step.name)
+            if result:
+                self.stats["hits"] += 1
+                return result
+        # no candidate, or the candidate's own matcher disagrees: behave's full scan decides
+        self.stats["fallbacks"] += 1
+        return self.original_find_match(step)
+
+
+def install(step_registry=registry):
+    """Route step_registry.find_match through the index (once per registry)."""
+    dispatch = getattr(step_registry, "dispatch_index", None)
+    if dispatch is None:
+        dispatch = step_registry.dispatch_index = StepDispatchIndex(step_registry, DISPATCH_TABLE)
+        step_registry.find_match = dispatch.find_match
+    return dispatch
+
+
+install()
+'''
+
+_PARSE_FIELD = re.compile(r'\{\{|\}\}|\{[^{}]*\}')
+
+
+def dispatch_entry(pattern: str) -> Tuple[str, str, Any]:
+    """
+    (pattern, first literal word, regex) for a behave parse pattern; regex is None for a pattern
+    without fields. Every field becomes a lazy '.+?': the regex only has to pick a candidate, the
+    definition's own matcher has the final say.
+    """
+    parts, pos = [], 0
+    for m in _PARSE_FIELD.finditer(pattern):
+        parts.append(re.escape(pattern[pos:m.start()]))
+        parts.append(re.escape(m.group(0)[0]) if m.group(0) in ("{{", "}}") else "(?:.+?)")
+        pos = m.end()
+    parts.append(re.escape(pattern[pos:]))
+    first = _PARSE_FIELD.search(pattern)
+    literal = pattern[:first.start()] if first else pattern
+    words = literal.split(None, 1)
+    # the first word only counts if it is complete, i.e. not glued to a field
+    word = words[0].lower() if words and (len(words) > 1 or literal[-1:].isspace() or not first) else ""
+    return pattern, word, "".join(parts) if first else None
+
+
+def build_dispatch_module(definitions: List[Tuple[str, str]], case_sensitive: bool = True) -> str:
+    """
+    Step module with a dispatch index for the given (kind, decorator pattern) definitions, e.g. from
+    step_pattern_and_args() of merged definitions. Duplicates by pattern_key keep the first.
+    """
+    table, seen = {}, set()
+    for kind, pattern in definitions:
+        key = pattern_key(kind, pattern, case_sensitive)
+        if key in seen:
+            continue
+        seen.add(key)
+        table.setdefault(kind, []).append(dispatch_entry(pattern))
+    lines = ["{"]
+    for kind, entries in table.items():
+        lines.append(f"    {kind!r}: [")
+        lines.extend(f"        {entry!r}," for entry in entries)
+        lines.append("    ],")
+    lines.append("}")
+    return DISPATCH_TEMPLATE.format(table="\n".join(lines))
+
+
+# -------------------------
+# Incremental step-file update
+# -------------------------
+GENERATED_MARKER = "# generated-by bdd-wizard:"
+STEP_DECORATORS = ("given", "when", "then", "step")
+
+
+def _fragment_hash(text: str) -> str:
+    return llm_utils.fingerprint(text.strip())[:12]
+
+
+def _decorated_patterns(node: ast.AST) -> List[Tuple[str, str]]:
+    """(kind, pattern) of every behave decorator on a function (@given('..'), @behave.when(u'..'), @step(..))."""
+    patterns = []
+    for d in getattr(node, "decorator_list", []):
+        if not (isinstance(d, ast.Call) and d.args and isinstance(d.args[0], ast.Constant)
+                and isinstance(d.args[0].value, str)):
+            continue
+        name = d.func.id if isinstance(d.func, ast.Name) else getattr(d.func, "attr", "")
+        if name.lower() in STEP_DECORATORS:
+            patterns.append((name.lower(), d.args[0].value))
+    return patterns
+
+
+def _decorated_keys(node: ast.AST, case_sensitive: bool = True) -> List[Tuple[str, str]]:
+    """pattern_key of every behave decorator on a function."""
+    return [pattern_key(kind, pattern, case_sensitive) for kind, pattern in _decorated_patterns(node)]
+
+
+def _source_lines(src: str) -> List[str]:
+    """Lines with their own endings, split exactly where ast counts lines (\n, \r\n, \r)."""
+    return re.findall(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+\Z', src)
+
+
+def _step_functions(src: str, case_sensitive: bool = True) -> List[Dict[str, Any]]:
+    """Top-level step functions of a module: keys, 0-based [start, end) line span incl. marker, marker hash."""
+    lines = [l.rstrip("\r\n") for l in _source_lines(src)]
+    out = []
+    for node in ast.parse(src).body:
+        keys = _decorated_keys(node, case_sensitive)
+        if not keys:
+            continue
+        start = min([node.lineno] + [d.lineno for d in node.decorator_list]) - 1
+        # comment lines directly above the decorators belong to the function (conflict notes, marker)
+        top = start
+        while top > 0 and lines[top - 1].lstrip().startswith("#"):
+            top -= 1
+        marker, span_start = None, start
+        for n in range(top, start):
+            if lines[n].startswith(GENERATED_MARKER):
+                marker, span_start = lines[n][len(GENERATED_MARKER):].strip(), n
+                break
+        body_start = span_start + 1 if marker else start
+        out.append({"keys": keys, "patterns": _decorated_patterns(node), "start": span_start,
+                    "end": node.end_lineno, "marker": marker,
+                    "current_hash": _fragment_hash("\n".join(lines[body_start:node.end_lineno]))})
+    return out
+
+
+def splice_step_module(existing_src: str, imports: List[str], instantiations: List[str],
+                       impls: List[str], remove: List[Tuple[str, str]] = None,
+                       case_sensitive: bool = True) -> Tuple[str, Dict[str, Any]]:
+    """
+    Update an existing step module with freshly generated fragments instead of rewriting it.
+
+    Fragments are matched to existing functions by decorator (pattern_key, case folded only when
+    case_sensitive=False). Every generated function
+    is written with a '# generated-by bdd-wizard: <hash>' marker line; an existing function is only
+    replaced when its marker hash still matches its text (it was not edited since generation) and the
+    new fragment differs. Hand-written or hand-edited functions are kept, functions with no fragment
+    are kept (unless listed in remove), and new steps are appended, or inserted before the first
+    existing function whose pattern matches theirs (behave rejects the general one registered first).
+    remove holds pattern_keys of definitions that no longer belong in this module: a generated,
+    unedited function with such a key and no fragment is deleted; an edited or hand-written one is
+    kept and reported. Lines outside replaced functions stay byte-identical, and
+    inserted lines use the module's own line ending (CRLF files stay CRLF); missing import /
+    instantiation lines are inserted after the last top-level import.
+
+    Raises SyntaxError if existing_src does not parse (nothing is spliced into a broken file).
+    Returns (new_src, report) with report lists 'added', 'replaced', 'unchanged', 'kept_edited',
+    'kept_handwritten', 'removed', 'kept_stale', 'not_generated' (patterns).
+    """
+    report = {k: [] for k in ("added", "replaced", "unchanged", "kept_edited", "kept_handwritten", "removed",
+                              "kept_stale", "not_generated")}
+    if not existing_src.strip():
+        existing_src = build_module(imports, instantiations, [])
+    lines = _source_lines(existing_src)
+    first_break = re.search(r'\r\n|\r|\n', existing_src)
+    nl = first_break.group(0) if first_break else "\n"
+    functions = _step_functions(existing_src, case_sensitive)
+    by_key = {}
+    for f in functions:
+        for k in f["keys"]:
+            by_key.setdefault(k, f)
+
+    replacements, appended, matched = {}, [], set()
+    for frag in dict.fromkeys(impls):
+        frag = frag.rstrip("\n")
+        patterns = [p for node in ast.parse(frag).body for p in _decorated_patterns(node)]
+        keys = [pattern_key(kind, pattern, case_sensitive) for kind, pattern in patterns]
+        new_hash = _fragment_hash(frag)
+        marked = f"{GENERATED_MARKER} {new_hash}\n{frag}"
+        label = keys[0][1] if keys else frag.splitlines()[0]
+        f = next((by_key[k] for k in keys if k in by_key), None)
+        if f is None:
+            appended.append((marked, patterns))
+            report["added"].append(label)
+            continue
+        matched.add(f["start"])
+        if f["marker"] is None:
+            report["kept_handwritten"].append(label)
+        elif f["marker"] != f["current_hash"]:
+            report["kept_edited"].append(label)
+        elif f["marker"] == new_hash:
+            report["unchanged"].append(label)
+        else:
+            replacements[f["start"]] = (f["end"], marked)
+            report["replaced"].append(label)
+    remove = set(remove or [])
+    for f in functions:
+        if f["start"] in matched or not remove.intersection(f["keys"]):
+            continue
+        matched.add(f["start"])
+        if f["marker"] is not None and f["marker"] == f["current_hash"]:
+            end = f["end"]
+            while end < len(lines) and not lines[end].strip():
+                end += 1
+            replacements[f["start"]] = (end, None)
+            report["removed"].append(f["keys"][0][1])
+        else:
+            report["kept_stale"].append(f["keys"][0][1])
+    report["not_generated"] = [f["keys"][0][1] for f in functions if f["start"] not in matched]
+
+    # a new function whose text an existing one matches has to go before it (behave: AmbiguousStep)
+    staying = [(f, {"kind": kind, "pattern": pattern}) for f in functions
+               if replacements.get(f["start"], (None, ""))[1] is not None for kind, pattern in f["patterns"]]
+    inserted, at_end = {}, []
+    for marked, patterns in appended:
+        candidates = [{"kind": kind, "pattern": pattern} for kind, pattern in patterns]
+        definitions = [d for _, d in staying] + candidates
+        index = StepDefinitionIndex(definitions, case_sensitive)
+        starts = [staying[m][0]["start"] for n in range(len(staying), len(definitions))
+                  for m in _shadowing(index, definitions, n) if m < len(staying)]
+        if starts:
+            inserted.setdefault(min(starts), []).append(marked)
+        else:
+            at_end.append(marked)
+
+    out, n = [], 0
+    while n < len(lines):
+        for text in inserted.pop(n, []):
+            out.extend(l + nl for l in text.split("\n"))
+            out.append(nl)
+        if n in replacements:
+            end, text = replacements[n]
+            if text is not None:
+                out.extend(l + nl for l in text.split("\n"))
+            n = end
+        else:
+            out.append(lines[n])
+            n += 1
+
+    # header lines the existing module lacks go after its last top-level import
+    present = {l.strip() for l in out}
+    missing = [l for l in ["from behave import given, when, then"] + imports + instantiations
+               if l.strip() and l.strip() not in present]
+    if missing:
+        tree = ast.parse("".join(out))
+        last_import = max((node.end_lineno for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))),
+                          default=0)
+        if last_import and not out[last_import - 1].endswith(("\n", "\r")):
+            out[last_import - 1] += nl
+        out[last_import:last_import] = [l + nl for l in missing]
+
+    text = "".join(out)
+    if at_end:
+        text = text.rstrip("\r\n") + nl + nl + nl + (nl + nl).join(a.replace("\n", nl) for a in at_end) + nl
+    elif text and not text.endswith(("\n", "\r")):
+        text += nl
+    return text, report
 
 
 def collect_context_vars(steps: List[Dict[str, Any]], include_all: bool = False) -> List[str]:
@@ -323,30 +1177,166 @@ def collect_context_vars(steps: List[Dict[str, Any]], include_all: bool = False)
 # -------------------------
 # Validation helpers
 # -------------------------
-def validate_stepfile_against_helpers(step_src: str, helpers: Dict[str, Dict[str, List[str]]]) -> List[Dict[str, Any]]:
+def _arity_problem(spec: Any, node: ast.Call) -> str:
+    """Why a call does not fit a typed method spec ({"args": [...]}), or "" if it fits (or cannot be checked)."""
+    if not isinstance(spec, dict) or any(isinstance(a, ast.Starred) for a in node.args) \
+            or any(k.arg is None for k in node.keywords):
+        return ""
+    params = spec.get("args", [])
+    named = [p for p in params if not p["name"].startswith("*")]
+    var_positional = any(p["name"].startswith("*") and not p["name"].startswith("**") for p in params)
+    var_keyword = any(p["name"].startswith("**") for p in params)
+    # keyword-only parameters (after * or *args) never take positional arguments
+    positional = [p["name"] for p in named if not p.get("kwonly")]
+    if len(node.args) > len(positional) and not var_positional:
+        return f"takes at most {len(positional)} positional argument(s), {len(node.args)} given"
+    names = [p["name"] for p in named]
+    unknown = [k.arg for k in node.keywords if k.arg not in names]
+    if unknown and not var_keyword:
+        return f"unexpected keyword argument(s): {', '.join(unknown)}"
+    twice = [k.arg for k in node.keywords if k.arg in positional[:len(node.args)]]
+    if twice:
+        return f"multiple values for argument(s): {', '.join(twice)}"
+    given = set(positional[:len(node.args)]) | {k.arg for k in node.keywords}
+    missing = [p["name"] for p in named if p["default"] is None and p["name"] not in given]
+    if missing:
+        return f"missing required argument(s): {', '.join(missing)}"
+    return ""
+
+
+def _instance_class(value: ast.AST, helper_map: Dict[str, Any]):
+    """Class name for 'Cls(...)' / 'mod.Cls(...)' values: the helper class, "" for any other call, None otherwise."""
+    if not isinstance(value, ast.Call):
+        return None
+    func = value.func
+    name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+    return name if name in helper_map else ""
+
+
+def _assignment_targets(node: ast.AST):
+    if isinstance(node, ast.Assign):
+        return node.targets, node.value
+    if isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+        return [node.target], node.value
+    return [], None
+
+
+def _symbol_key(target: ast.AST) -> str:
+    """'x' for a name, 'context.x' for a context member, "" for anything else."""
+    if isinstance(target, ast.Name):
+        return target.id
+    if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name) and target.value.id == "context":
+        return f"context.{target.attr}"
+    return ""
+
+
+def _scan_step_module(tree: ast.AST, helper_map: Dict[str, Any]):
+    """One pass over a step module: (module symbols, {function node: local symbols}, [(call, function node)])."""
+    module_symbols, local_symbols, calls = {}, {}, []
+
+    def bind(table, key, cls):
+        # a helper binding is never downgraded by a later non-helper assignment of the same name
+        if key and (cls or key not in table):
+            table[key] = cls or ""
+
+    stack = [(tree, None)]
+    while stack:
+        node, func = stack.pop()
+        table = module_symbols if func is None else local_symbols[func]
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            bind(table, node.name, "")
+            func = node
+            table = local_symbols[node] = {}
+            a = node.args
+            for p in a.posonlyargs + a.args + a.kwonlyargs + [a.vararg, a.kwarg]:
+                if p is not None:
+                    bind(table, p.arg, "")
+        elif isinstance(node, ast.ClassDef):
+            bind(table, node.name, "")
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                bind(table, (alias.asname or alias.name).split(".")[0], "")
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bind(table, node.name, "")
+        elif isinstance(node, ast.Call):
+            calls.append((node, func))
+        targets, value = _assignment_targets(node)
+        if isinstance(node, (ast.For, ast.AsyncFor, ast.comprehension)):
+            targets = [node.target]
+        elif isinstance(node, (ast.With, ast.AsyncWith)):
+            targets = [i.optional_vars for i in node.items if i.optional_vars is not None]
+        for t in targets:
+            for leaf in ([t] if not isinstance(t, (ast.Tuple, ast.List)) else t.elts):
+                key = _symbol_key(leaf)
+                cls = _instance_class(value, helper_map) if leaf is t else None
+                bind(module_symbols if key.startswith("context.") else table, key, cls)
+        stack.extend((child, func) for child in ast.iter_child_nodes(node))
+    return module_symbols, local_symbols, calls
+
+
+def build_instance_symbols(tree: ast.AST, helper_map: Dict[str, Any]) -> Tuple[Dict[str, str], Dict[ast.AST, Dict[str, str]]]:
+    """
+    Symbol tables for a parsed step module: (module symbols, {function node: local symbols}).
+    Keys are 'x' or 'context.x', values the helper class assigned to them ('x = MSSQLConnection()'),
+    or "" when the name is bound to something else (imports, parameters, other values).
+    context members are global to the run, so they are module symbols wherever they are assigned.
+    """
+    module_symbols, local_symbols, _ = _scan_step_module(tree, helper_map)
+    return module_symbols, local_symbols
+
+
+def validate_stepfile_against_helpers(step_src: str, helpers: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Check every helper call in a step module. Receivers are resolved through the file's own
+    assignments (build_instance_symbols): 'mssql = MSSQLConnection()' at module level, inside a step
+    or as context.mssql; a receiver named after a helper class ('rubrik' -> Rubrik, e.g. lazy helpers
+    from environment.py) resolves by name. Each call is then one dict lookup plus an arity check.
+    helpers: parse_helper_file() ({Class: {method: [args]}}, existence only) or
+    parse_helper_file_typed() (also arity).
+    Issues: syntax_error, unknown_instance, missing_method, bad_arguments (with 'line').
+    """
     issues = []
     try:
         tree = ast.parse(step_src)
     except Exception as e:
         return [{"type": "syntax_error", "msg": str(e)}]
-    helper_map = {cls: set(methods.keys()) for cls, methods in helpers.items()}
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Call):
-            func = node.func
-            if isinstance(func, ast.Attribute):
-                if isinstance(func.value, ast.Name):
-                    inst = func.value.id
-                    mname = func.attr
-                    matched_cls = None
-                    for cls in helper_map:
-                        if inst.lower() == cls.lower() or inst.lower() == cls.lower()[0:len(inst)]:
-                            matched_cls = cls
-                            break
-                    if matched_cls:
-                        if mname not in helper_map.get(matched_cls, set()):
-                            issues.append({"type": "missing_method", "instance": inst, "mapped_class": matched_cls, "method": mname})
-                    else:
-                        issues.append({"type": "unknown_instance", "instance": inst, "method": mname})
+    by_lower = {cls.lower(): cls for cls in helpers}
+    module_symbols, local_symbols, calls = _scan_step_module(tree, helpers)
+
+    def check(node: ast.Call, local: Dict[str, str]):
+        func = node.func
+        if not isinstance(func, ast.Attribute):
+            return
+        key = _symbol_key(func.value)
+        if not key:
+            return
+        cls = local.get(key) if not key.startswith("context.") else None
+        if cls is None:
+            cls = module_symbols.get(key)
+        if cls is None:
+            cls = by_lower.get(key.split(".")[-1].lower())
+        inst, line = key, getattr(node, "lineno", None)
+        if cls is None:
+            # a bare name bound nowhere in this file; unbound context members may come from
+            # environment.py or another step module and are not reported
+            if not key.startswith("context.") and not hasattr(builtins, key):
+                issues.append({"type": "unknown_instance", "instance": inst, "method": func.attr, "line": line})
+            return
+        if not cls:
+            return   # bound to something that is not a helper (module, data, ...)
+        methods = helpers[cls]
+        if func.attr not in methods:
+            issues.append({"type": "missing_method", "instance": inst, "mapped_class": cls, "method": func.attr,
+                           "line": line})
+            return
+        problem = _arity_problem(methods[func.attr], node)
+        if problem:
+            issues.append({"type": "bad_arguments", "instance": inst, "mapped_class": cls, "method": func.attr,
+                           "msg": problem, "line": line})
+
+    # calls are checked after the scan, so a name bound further down the module still resolves
+    for node, func in sorted(calls, key=lambda c: (c[0].lineno, c[0].col_offset)):
+        check(node, local_symbols[func] if func is not None else {})
     return issues
 
 
@@ -364,28 +1354,270 @@ def detect_ambiguous_steps(feature_steps: List[Dict[str, Any]]) -> List[Dict[str
 
 
 # -------------------------
-# Text -> BDD multi-scenario generator (improved)
+# Step definition matching (missing / ambiguous / unused steps)
 # -------------------------
-def generate_bdd_from_text(input_text: str, use_llm: bool = False, api_key: str = None, grounding_text: str = "") -> str:
+FEATURE_STEP_LINE = re.compile(r'^\s*(Given|When|Then|And|But|\*)\s+(.*)', re.IGNORECASE)
+SCENARIO_LINE = re.compile(r'^\s*(Scenario Outline|Scenario Template|Scenario|Example|Background)\s*:', re.IGNORECASE)
+EXAMPLES_LINE = re.compile(r'^\s*(Examples|Scenarios)\s*:', re.IGNORECASE)
+# regexes for the parse module's built-in field types; custom types match anything
+PARSE_TYPE_PATTERNS = {
+    "d": r"[-+]?(?:0[xob])?[0-9a-fA-F_]+", "n": r"[-+]?\d[\d,]*", "f": r"[-+]?\d*\.\d+", "F": r"[-+]?\d*\.?\d+",
+    "e": r"[-+]?\d*\.?\d+[eE][-+]?\d+", "g": r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?", "w": r"\w+", "W": r"\W+",
+    "s": r"\s+", "S": r"\S+", "l": r"[a-zA-Z]+",
+}
+
+
+def expand_feature_steps(feature_text: str) -> List[Dict[str, Any]]:
     """
-    Split input_text into logical scenario blocks and produce Scenario Outlines for each.
-    If use_llm=True and api_key provided, call Gemini with grounding context to produce refined output.
+    Steps as behave runs them: And/But/* inherit the previous kind, Background steps are listed once,
+    and Scenario Outline steps are expanded once per Examples row with <placeholders> substituted.
+    Each step: {'kind', 'text', 'line' (1-based), 'scenario' (index, -1 for Background), 'row' (or None)}.
     """
-    # Split by numbered steps or blank line Section boundaries
-    parts = re.split(r'\n\s*\d+\)|\n\s*Step\s+\d+|(?m)^\s*Scenario\s+\d+:', input_text)
-    parts = [p.strip() for p in parts if p.strip()]
-    scenarios = []
-    # fallback: if no numbered parts, split by double newline
-    if not parts:
-        parts = [p.strip() for p in input_text.split("\n\n") if p.strip()]
+    steps, outline, current = [], None, []
+    scenario_idx, last_kind, in_doc, examples, header = -1, None, None, None, None
+
+    def flush():
+        if outline and examples:
+            for row_no, row in enumerate(examples):
+                for s in current:
+                    text = re.sub(r'<([^>]+)>', lambda m: row.get(m.group(1), m.group(0)), s["text"])
+                    steps.append(dict(s, text=text, row=row_no))
+        else:
+            steps.extend(current)
+
+    for n, raw in enumerate(feature_text.splitlines(), 1):
+        stripped = raw.strip()
+        if in_doc:
+            in_doc = None if stripped.startswith(in_doc) else in_doc
+            continue
+        if stripped.startswith('"""') or stripped.startswith("```"):
+            in_doc = stripped[:3]
+            continue
+        m = SCENARIO_LINE.match(raw)
+        if m:
+            flush()
+            background = m.group(1).lower() == "background"
+            scenario_idx += 0 if background else 1
+            outline = m.group(1).lower().startswith("scenario ") and not background
+            current, last_kind, examples, header = [], None, None, None
+            continue
+        if EXAMPLES_LINE.match(raw):
+            examples, header = [] if examples is None else examples, None
+            continue
+        if stripped.startswith("|"):
+            if examples is not None:
+                cells = [c.strip() for c in stripped.strip("|").split("|")]
+                if header is None:
+                    header = cells
+                else:
+                    examples.append(dict(zip(header, cells)))
+            continue   # otherwise a step data table
+        m = FEATURE_STEP_LINE.match(raw)
+        if not m:
+            continue
+        token = m.group(1).lower()
+        kind = last_kind or "given" if token in ("and", "but", "*") else token
+        last_kind = kind
+        current.append({"kind": kind, "text": m.group(2).strip(), "line": n,
+                        "scenario": scenario_idx if outline is not None else -1, "row": None})
+    flush()
+    return steps
+
 
-    for idx, part in enumerate(parts, start=1):
-        if use_llm and api_key:
+def extract_step_definitions(step_src: str) -> List[Dict[str, Any]]:
+    """
+    Step definitions of a step module in registration order:
+    [{'kind' (given/when/then/step), 'pattern', 'function', 'line', 'matcher' ('parse', 'cfparse', 're')}].
+    use_step_matcher(...) calls at module level switch the matcher for the definitions that follow.
+    """
+    tree = ast.parse(step_src)
+    definitions, matcher = [], "parse"
+    for node in tree.body:
+        call = node.value if isinstance(node, ast.Expr) else None
+        if isinstance(call, ast.Call) and call.args and isinstance(call.args[0], ast.Constant):
+            name = call.func.id if isinstance(call.func, ast.Name) else getattr(call.func, "attr", "")
+            if name in ("use_step_matcher", "step_matcher"):
+                matcher = str(call.args[0].value)
+            continue
+        for d in getattr(node, "decorator_list", []):
+            if not (isinstance(d, ast.Call) and d.args and isinstance(d.args[0], ast.Constant)
+                    and isinstance(d.args[0].value, str)):
+                continue
+            name = d.func.id if isinstance(d.func, ast.Name) else getattr(d.func, "attr", "")
+            if name.lower() in STEP_DECORATORS:
+                definitions.append({"kind": name.lower(), "pattern": d.args[0].value, "function": node.name,
+                                    "line": d.lineno, "matcher": matcher})
+    return definitions
+
+
+def parse_pattern_regex(pattern: str) -> str:
+    """
+    Regex equivalent of a behave parse / cfparse pattern: literals escaped, '{{' / '}}' literal
+    braces, fields '{name}', '{name:d}', '{:w}', ... matched like the parse module does.
+    """
+    parts, pos = [], 0
+    for m in _PARSE_FIELD.finditer(pattern):
+        parts.append(re.escape(pattern[pos:m.start()]))
+        field = m.group(0)
+        if field in ("{{", "}}"):
+            parts.append(re.escape(field[0]))
+        else:
+            spec = field[1:-1].split(":", 1)[1] if ":" in field else ""
+            parts.append(f"(?:{PARSE_TYPE_PATTERNS.get(spec[-1:] if spec else '', '.+?')})")
+        pos = m.end()
+    parts.append(re.escape(pattern[pos:]))
+    return "".join(parts)
+
+
+class StepDefinitionIndex:
+    """
+    All step definitions of a module compiled once, with behave's matching rules: a step of kind K
+    is matched by @K and @step definitions, parse patterns must match the whole step text.
+    Lookups go through the literal / first-word index of the dispatch module (dispatch_entry), so
+    a step is only tried against the few definitions that share its first word.
+    Matching is case-sensitive like behave 1.3; case_sensitive=False gives behave 1.2's
+    case-insensitive parse matcher. Regex (re) definitions are always case-sensitive.
+    """
+
+    def __init__(self, definitions: List[Dict[str, Any]], case_sensitive: bool = True):
+        self.definitions = definitions
+        flags = 0 if case_sensitive else re.IGNORECASE
+        self._fold = (lambda t: t) if case_sensitive else str.lower
+        self._literals, self._buckets, self.errors = {}, {}, []
+        for n, d in enumerate(definitions):
             try:
-                import google.generativeai as genai
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel("gemini-1.5-flash")
-                prompt = f"""
+                if d.get("matcher", "parse").startswith("re"):
+                    word, regex = "", re.compile(d["pattern"])
+                else:
+                    _, word, rx = dispatch_entry(d["pattern"])
+                    if rx is None:
+                        self._literals.setdefault((d["kind"], self._fold(d["pattern"])), []).append(n)
+                        continue
+                    regex = re.compile(parse_pattern_regex(d["pattern"]), flags | re.DOTALL)
+            except re.error as e:
+                self.errors.append({"function": d.get("function"), "pattern": d["pattern"], "error": str(e)})
+                continue
+            self._buckets.setdefault((d["kind"], word), []).append((n, regex))
+
+    def matches(self, kind: str, text: str) -> List[int]:
+        """
+        Indexes of every definition matching the step in the order behave tries them (it uses the
+        first): the step's own type in registration order, then the generic @step definitions.
+        """
+        words = text.split(None, 1)
+        first = words[0].lower() if words else ""
+        ordered = []
+        for k in dict.fromkeys((kind, "step")):
+            found = set(self._literals.get((k, self._fold(text)), ()))
+            for word in {first, ""}:
+                found.update(n for n, regex in self._buckets.get((k, word), ()) if regex.fullmatch(text))
+            ordered.extend(sorted(found))
+        return ordered
+
+
+def _shadowing(index: StepDefinitionIndex, definitions: List[Dict[str, Any]], n: int) -> List[int]:
+    """Definitions of the same type whose matcher matches the pattern text of definitions[n]."""
+    d = definitions[n]
+    return [m for m in index.matches(d["kind"], d["pattern"]) if m != n and definitions[m]["kind"] == d["kind"]]
+
+
+def registration_conflicts(definitions: List[Dict[str, Any]], case_sensitive: bool = True) -> List[Dict[str, Any]]:
+    """
+    Definitions ({'kind', 'pattern', ...} in load order) that behave refuses to register: when a step
+    decorator runs, behave raises AmbiguousStep if an already registered definition of the same type
+    matches the new pattern text. Returns [{'definition': n, 'existing': m}], n and m indexes.
+    """
+    index = StepDefinitionIndex(definitions, case_sensitive)
+    out = []
+    for n in range(len(definitions)):
+        earlier = [m for m in _shadowing(index, definitions, n) if m < n]
+        if earlier:
+            out.append({"definition": n, "existing": earlier[0]})
+    return out
+
+
+def registration_order(definitions: List[Dict[str, Any]], registered: List[Dict[str, Any]] = None,
+                       case_sensitive: bool = True) -> Tuple[List[int], Dict[int, str]]:
+    """
+    An order in which behave registers definitions ({'kind', 'pattern'}) without AmbiguousStep (see
+    registration_conflicts): a specific pattern goes before a general one that matches its text,
+    otherwise first-occurrence order is kept. registered: definitions loaded earlier (other modules),
+    which cannot move. Returns (order, rejected): indexes into definitions, and {index: clashing
+    pattern} for definitions that no order gets past behave (two patterns that match each other,
+    or one an earlier module already matches).
+    """
+    registered = list(registered or [])
+    everything = registered + list(definitions)
+    index, base = StepDefinitionIndex(everything, case_sensitive), len(registered)
+    rejected, before = {}, {n: [] for n in range(len(definitions))}
+    for n in range(len(definitions)):
+        shadowing = _shadowing(index, everything, base + n)
+        loaded = [m for m in shadowing if m < base]
+        if loaded:
+            rejected[n] = registered[loaded[0]]["pattern"]
+        for m in shadowing:
+            if m >= base:
+                before[m - base].append(n)   # definitions[n] has to be registered before definitions[m - base]
+
+    order, state = [], {}
+
+    def visit(n):
+        if n in state or n in rejected:
+            return
+        state[n] = "visiting"
+        for p in before[n]:
+            if state.get(p) == "visiting":
+                # p has to come before n and n before p: keep the first one, drop this one
+                rejected[n] = definitions[p]["pattern"]
+                state[n] = "done"
+                return
+            visit(p)
+        state[n] = "done"
+        order.append(n)
+
+    for n in range(len(definitions)):
+        visit(n)
+    return order, rejected
+
+
+def match_feature_steps(feature_text: str, step_src: str, case_sensitive: bool = True) -> Dict[str, Any]:
+    """
+    Resolve every feature step (Examples rows expanded) against the definitions in step_src.
+    Returns {'unmatched': [{kind, text, line}], 'ambiguous': [{kind, text, line, definitions}],
+    'unused': [definition], 'matched': {(kind, text): definition index}, 'stats': {...}} where an
+    ambiguous step matches several definitions (behave silently takes the first).
+    """
+    return match_steps_to_definitions(expand_feature_steps(feature_text), extract_step_definitions(step_src),
+                                      case_sensitive)
+
+
+def match_steps_to_definitions(steps: List[Dict[str, Any]], definitions: List[Dict[str, Any]],
+                               case_sensitive: bool = True) -> Dict[str, Any]:
+    """match_feature_steps for already expanded steps and extracted definitions (e.g. from several step modules)."""
+    index = StepDefinitionIndex(definitions, case_sensitive)
+    matched, unmatched, ambiguous, used = {}, [], [], set()
+    for s in steps:
+        key = (s["kind"], s["text"])
+        if key in matched:
+            continue
+        found = index.matches(*key)
+        matched[key] = found[0] if found else None
+        used.update(found)
+        if not found:
+            unmatched.append({"kind": s["kind"], "text": s["text"], "line": s["line"]})
+        elif len(found) > 1:
+            ambiguous.append({"kind": s["kind"], "text": s["text"], "line": s["line"],
+                              "definitions": [f"{definitions[n]['function']} (line {definitions[n]['line']})" for n in found]})
+    unused = [d for n, d in enumerate(definitions) if n not in used]
+    return {"unmatched": unmatched, "ambiguous": ambiguous, "unused": unused, "matched": matched,
+            "stats": {"steps": len(steps), "distinct_steps": len(matched), "definitions": len(definitions),
+                      "bad_patterns": index.errors}}
+
+
+# -------------------------
+# Text -> BDD multi-scenario generator (improved)
+# -------------------------
+BDD_PROMPT_TEMPLATE = """
 You are a BDD generation assistant. Use the grounding examples and the description below to produce a Gherkin Scenario Outline that strictly follows the user's template style.
 
 Grounding examples:
@@ -396,15 +1628,174 @@ Description:
 
 Return ONLY the Scenario Outline in Gherkin.
 """
-                resp = model.generate_content(prompt)
-                text = resp.text
-                scenarios.append(text.strip())
-                continue
-            except Exception as e:
-                scenarios.append(f"# Gemini failed: {e}\nScenario Outline: [{idx}] {part[:40]} ...")
-        # Deterministic fallback: create a skeleton scenario outline
-        scenarios.append(f"Scenario Outline: [{idx}] Auto generated scenario\n  # Source text:\n  {part.replace(chr(10), chr(10)+'  ')}")
+
+
+def load_grounding_templates(template_dir: str = "templates") -> Dict[str, str]:
+    """{file name: content} for every readable file in template_dir (empty when it does not exist)."""
+    templates = {}
+    if not os.path.isdir(template_dir):
+        return templates
+    for fn in sorted(os.listdir(template_dir)):
+        path = os.path.join(template_dir, fn)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                templates[fn] = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+    return templates
+
+
+def split_text_parts(input_text: str) -> List[str]:
+    """Split input_text by numbered steps / 'Step N' / 'Scenario N:' markers, else by blank lines."""
+    parts = re.split(r'\n\s*\d+\)|\n\s*Step\s+\d+|^\s*Scenario\s+\d+:', input_text, flags=re.M)
+    parts = [p.strip() for p in parts if p.strip()]
+    # fallback: if no numbered parts, split by double newline
+    if not parts:
+        parts = [p.strip() for p in input_text.split("\n\n") if p.strip()]
+    return parts
+
+
+def _bdd_model(api_key: str, grounding_text: str, cache, telemetry, stage: str):
+    """Gemini model for Text -> BDD, wrapped with the response cache and telemetry when given."""
+    model = llm_utils.get_shared_model(api_key, "gemini-1.5-flash")
+    if cache is not None:
+        model = llm_utils.CachedModel(model, cache, "gemini-1.5-flash", llm_utils.fingerprint(grounding_text))
+    if telemetry is not None:
+        model = InstrumentedModel(model, telemetry, stage, "gemini-1.5-flash")
+    return model
+
+
+def _bdd_prompt(part: str, grounding_text: str, retriever) -> str:
+    grounding = retriever.grounding_text(part) if retriever is not None else grounding_text
+    return BDD_PROMPT_TEMPLATE.format(grounding_text=grounding, part=part)
+
+
+def _fallback_scenario(idx: int, part: str) -> str:
+    """Deterministic fallback: a skeleton scenario outline carrying the source text."""
+    return f"Scenario Outline: [{idx}] Auto generated scenario\n  # Source text:\n  {part.replace(chr(10), chr(10)+'  ')}"
+
+
+def _failed_scenario(idx: int, part: str, error) -> str:
+    return f"# Gemini failed: {error}\nScenario Outline: [{idx}] {part[:40]} ...\n\n{_fallback_scenario(idx, part)}"
+
+
+def generate_bdd_from_text(input_text: str, use_llm: bool = False, api_key: str = None, grounding_text: str = "",
+                           cache: "llm_utils.LLMResponseCache" = None,
+                           executor: "llm_utils.LLMExecutor" = None, retriever=None,
+                           telemetry: "SessionTelemetry" = None) -> str:
+    """
+    Split input_text into logical scenario blocks and produce Scenario Outlines for each.
+    If use_llm=True and api_key provided, call Gemini with grounding context to produce refined output.
+    With a cache (llm_utils.LLMResponseCache), identical parts are answered from disk.
+    Parts are generated concurrently through executor (llm_utils.LLMExecutor; a default one is
+    created when omitted), so wall time is roughly one round trip instead of one per part.
+    With a retriever (grounding_utils.GroundingRetriever) each part is grounded with only its
+    most relevant template chunks instead of the full grounding_text.
+    With telemetry (telemetry.SessionTelemetry) every call is recorded under stage 'transform.part'.
+    """
+    parts = split_text_parts(input_text)
+    if not (use_llm and api_key):
+        return "\n\n".join(_fallback_scenario(idx, part) for idx, part in enumerate(parts, start=1))
+
+    try:
+        model = _bdd_model(api_key, grounding_text, cache, telemetry, "transform.part")
+
+        def _generate(part):
+            return model.generate_content(_bdd_prompt(part, grounding_text, retriever)).text
+
+        executor = executor or llm_utils.LLMExecutor()
+        results = executor.map(_generate, parts, labels=[f"transform part {i}" for i in range(1, len(parts) + 1)])
+    except Exception as e:
+        results = [{"ok": False, "error": e}] * len(parts)
+
+    scenarios = []
+    for idx, (part, res) in enumerate(zip(parts, results), start=1):
+        scenarios.append((res["value"] or "").strip() if res["ok"] else _failed_scenario(idx, part, res["error"]))
     return "\n\n".join(scenarios)
 
 
+class _Cancelled(Exception):
+    pass
+
+
+def stream_bdd_from_text(input_text: str, use_llm: bool = False, api_key: str = None, grounding_text: str = "",
+                         cache: "llm_utils.LLMResponseCache" = None,
+                         executor: "llm_utils.LLMExecutor" = None, retriever=None,
+                         telemetry: "SessionTelemetry" = None,
+                         cancel: threading.Event = None) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of generate_bdd_from_text (same arguments): parts are generated concurrently
+    and Gherkin is yielded as it arrives, as events
+      {'part': i, 'event': 'start'}                 an attempt for part i began (discard its text so far)
+      {'part': i, 'event': 'chunk', 'text': ...}    new text for part i
+      {'part': i, 'event': 'done', 'text': ..., 'cancelled': bool}   final scenario text for part i
+    Setting cancel (threading.Event) stops every in-flight part after its current chunk; closing the
+    generator does the same. Cancelled parts keep their partial text and are not cached.
+    """
+    parts = split_text_parts(input_text)
+    if not (use_llm and api_key):
+        for idx, part in enumerate(parts, start=1):
+            yield {"part": idx, "event": "done", "text": _fallback_scenario(idx, part), "cancelled": False}
+        return
+    try:
+        model = _bdd_model(api_key, grounding_text, cache, telemetry, "transform.stream")
+    except Exception as e:
+        for idx, part in enumerate(parts, start=1):
+            yield {"part": idx, "event": "done", "text": _failed_scenario(idx, part, e), "cancelled": False}
+        return
+
+    cancel = cancel or threading.Event()
+    executor = executor or llm_utils.LLMExecutor()
+    events = queue.Queue()
+    partial = {}
+
+    def _stream_part(idx, part):
+        if cancel.is_set():
+            raise _Cancelled()
+        events.put({"part": idx, "event": "start"})
+        partial[idx] = []
+        chunks = model.generate_content(_bdd_prompt(part, grounding_text, retriever), stream=True)
+        try:
+            for chunk in chunks:
+                if cancel.is_set():
+                    raise _Cancelled()
+                text = llm_utils.chunk_text(chunk)
+                if text:
+                    partial[idx].append(text)
+                    events.put({"part": idx, "event": "chunk", "text": text})
+        finally:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+        return "".join(partial[idx])
+
+    def _run(idx, part):
+        res = executor.call(_stream_part, idx, part, label=f"transform part {idx}")
+        if res["ok"]:
+            events.put({"part": idx, "event": "done", "text": (res["value"] or "").strip(), "cancelled": False})
+        elif isinstance(res["error"], _Cancelled):
+            text = "".join(partial.get(idx, [])).strip() or _fallback_scenario(idx, part)
+            events.put({"part": idx, "event": "done", "text": f"# Generation cancelled\n{text}", "cancelled": True})
+        else:
+            events.put({"part": idx, "event": "done", "text": _failed_scenario(idx, part, res["error"]),
+                        "cancelled": False})
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(executor.max_concurrency, len(parts))))
+    try:
+        for idx, part in enumerate(parts, start=1):
+            pool.submit(_run, idx, part)
+        remaining = len(parts)
+        while remaining:
+            ev = events.get()
+            if ev["event"] == "done":
+                remaining -= 1
+            yield ev
+    finally:
+        # consumer finished or went away (Stop button, script rerun): stop whatever is still streaming
+        cancel.set()
+        pool.shutdown(wait=False)
+
+
 # End of parser_utils.py
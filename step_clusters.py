@@ -0,0 +1,255 @@
+"""
+step_clusters.py
+
+Corpus-level near-duplicate step clustering.
+
+detect_ambiguous_steps only catches exact duplicates inside one feature. This module streams
+thousands of .feature files, normalizes every step (make_step_key), and groups near-identical
+wordings such as
+    "the method returns trigger full backup status <x>"
+    "the method returns trigger full restore status <x>"
+with MinHash signatures + LSH banding. Memory is bounded: each distinct step keeps one fixed-size
+signature (array of 64-bit ints), a count and a few example origins; shingles are never stored.
+
+Each cluster is reported with a suggested canonical wording (the most used member) and a
+parameterized pattern that covers every member, where the differing runs of tokens (including
+tokens only some members have) are replaced by <param>.
+
+Usage:
+    python step_clusters.py features/ --threshold 0.6 --json clusters.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+from array import array
+from difflib import SequenceMatcher
+from typing import List, Dict, Any, Iterable
+
+import parser_utils_V3 as pu
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 64) - 1
+
+
+def step_shingles(key: str) -> set:
+    """Word unigrams + bigrams of a normalized step key."""
+    toks = key.split()
+    shingles = set(toks)
+    shingles.update(f"{a} {b}" for a, b in zip(toks, toks[1:]))
+    return shingles
+
+
+def _hash64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class StepClusterer:
+    """
+    Streaming MinHash/LSH clusterer over step texts.
+
+    threshold: estimated Jaccard similarity needed to link two wordings.
+    num_perm / bands: signature length and LSH banding (rows per band = num_perm // bands).
+    max_distinct: cap on distinct normalized steps kept in memory; further new wordings are counted
+    in 'dropped' but not indexed.
+    """
+
+    def __init__(self, threshold: float = 0.6, num_perm: int = 64, bands: int = 16,
+                 max_distinct: int = 200000, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_distinct = max_distinct
+        rnd = random.Random(seed)
+        self._perms = [(rnd.randrange(1, MERSENNE_PRIME), rnd.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._index = {}       # (kind, key) -> id
+        self._items = []       # id -> {'kind', 'key', 'text', 'count', 'origins'}
+        self._sigs = []        # id -> array('Q')
+        self._buckets = {}     # (kind, band, band hash) -> [ids]
+        self.dropped = 0
+
+    def signature(self, key: str) -> array:
+        sig = array("Q", [MAX_HASH]) * self.num_perm
+        for sh in step_shingles(key):
+            x = _hash64(sh)
+            for i, (a, b) in enumerate(self._perms):
+                h = (a * x + b) % MERSENNE_PRIME
+                if h < sig[i]:
+                    sig[i] = h
+        return sig
+
+    def add(self, text: str, kind: str = "step", origin: str = None) -> None:
+        key = pu.make_step_key(text)
+        ident = self._index.get((kind, key))
+        if ident is None:
+            if len(self._items) >= self.max_distinct:
+                self.dropped += 1
+                return
+            ident = len(self._items)
+            self._index[(kind, key)] = ident
+            self._items.append({"kind": kind, "key": key, "text": text, "count": 0, "origins": []})
+            sig = self.signature(key)
+            self._sigs.append(sig)
+            for b in range(self.bands):
+                band = sig[b * self.rows:(b + 1) * self.rows].tobytes()
+                self._buckets.setdefault((kind, b, hash(band)), []).append(ident)
+        item = self._items[ident]
+        item["count"] += 1
+        if origin and len(item["origins"]) < 3 and origin not in item["origins"]:
+            item["origins"].append(origin)
+
+    def add_feature(self, feature_text: str, origin: str = None) -> None:
+        for s in pu.extract_steps_with_inheritance(feature_text):
+            self.add(s["text"], s["kind"], origin)
+
+    def similarity(self, i: int, j: int) -> float:
+        a, b = self._sigs[i], self._sigs[j]
+        return sum(1 for x, y in zip(a, b) if x == y) / self.num_perm
+
+    def clusters(self, min_size: int = 2) -> List[Dict[str, Any]]:
+        """
+        Union candidate pairs from shared LSH buckets whose estimated similarity (and that of their
+        current cluster roots) passes the threshold.
+        """
+        parent = list(range(len(self._items)))
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for ids in self._buckets.values():
+            for n, i in enumerate(ids):
+                for j in ids[n + 1:]:
+                    ri, rj = find(i), find(j)
+                    # roots must also be similar, which keeps single-linkage from chaining drift
+                    if (ri != rj and self.similarity(i, j) >= self.threshold
+                            and self.similarity(ri, rj) >= self.threshold):
+                        parent[rj] = ri
+        groups = {}
+        for i in range(len(self._items)):
+            groups.setdefault(find(i), []).append(i)
+        out = []
+        for ids in groups.values():
+            if len(ids) < min_size:
+                continue
+            members = sorted((self._items[i] for i in ids), key=lambda m: (-m["count"], len(m["key"])))
+            out.append({
+                "kind": members[0]["kind"],
+                "canonical": members[0]["text"],
+                "pattern": canonical_pattern([m["key"] for m in members]),
+                "size": len(members),
+                "occurrences": sum(m["count"] for m in members),
+                "members": [{"text": m["text"], "count": m["count"], "origins": m["origins"]} for m in members],
+            })
+        out.sort(key=lambda c: (-c["occurrences"], c["canonical"]))
+        return out
+
+    def report(self, min_size: int = 2) -> Dict[str, Any]:
+        clusters = self.clusters(min_size)
+        return {
+            "distinct_steps": len(self._items),
+            "dropped": self.dropped,
+            "clusters": clusters,
+            "reducible_steps": sum(c["size"] - 1 for c in clusters),
+        }
+
+
+def pattern_matches(pattern: str, key: str) -> bool:
+    """Whether a canonical pattern covers a normalized step key; <param> stands for one or more tokens."""
+    rx = " ".join(r"\S+(?: \S+)*" if tok == "<param>" else re.escape(tok) for tok in pattern.split())
+    return re.fullmatch(rx, " ".join(key.split())) is not None
+
+
+def canonical_pattern(keys: List[str]) -> str:
+    """
+    Pattern covering every member: tokens of the first (most used) member that all members share,
+    in order, are kept as anchors; each gap between anchors where the members differ becomes one
+    <param> (one or more tokens). A gap that is empty in some member cannot be a <param>, so it is
+    widened by dropping a neighbouring anchor. The result is checked against every member.
+    """
+    toks = [k.split() for k in keys]
+    base = toks[0]
+    maps = [{i: i for i in range(len(base))}]      # per member: base index -> member index
+    for other in toks[1:]:
+        m = {}
+        for blk in SequenceMatcher(None, base, other, autojunk=False).get_matching_blocks():
+            m.update((blk.a + d, blk.b + d) for d in range(blk.size))
+        maps.append(m)
+    anchors = [i for i in range(len(base)) if all(i in m for m in maps)]
+    while True:
+        out, empty_gap = [], None
+        bounds = [-1] + anchors + [len(base)]
+        for a, b in zip(bounds, bounds[1:]):
+            gaps = {tuple(t[m[a] + 1 if a >= 0 else 0:m[b] if b < len(base) else len(t)]) for t, m in zip(toks, maps)}
+            if len(gaps) == 1:
+                out.extend(gaps.pop())
+            elif () in gaps:
+                empty_gap = (a, b)
+                break
+            else:
+                out.append("<param>")
+            if b < len(base):
+                out.append(base[b])
+        if empty_gap is None:
+            break
+        a, b = empty_gap
+        anchors.remove(b if b < len(base) else a)
+    pattern = " ".join(out)
+    if not all(pattern_matches(pattern, k) for k in keys):
+        raise AssertionError(f"canonical pattern {pattern!r} does not cover its cluster")
+    return pattern
+
+
+def iter_feature_files(paths: Iterable[str]) -> Iterable[str]:
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, files in os.walk(p):
+                for fn in sorted(files):
+                    if fn.endswith(".feature"):
+                        yield os.path.join(root, fn)
+        elif os.path.isfile(p):
+            yield p
+
+
+def cluster_feature_corpus(paths: List[str], threshold: float = 0.6, min_size: int = 2,
+                           max_distinct: int = 200000) -> Dict[str, Any]:
+    """Stream every .feature under paths through a StepClusterer and return its report."""
+    clusterer = StepClusterer(threshold=threshold, max_distinct=max_distinct)
+    for path in iter_feature_files(paths):
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            clusterer.add_feature(f.read(), path)
+    return clusterer.report(min_size)
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Cluster near-duplicate step wordings across feature files.")
+    ap.add_argument("paths", nargs="+", help="feature files or directories")
+    ap.add_argument("--threshold", type=float, default=0.6)
+    ap.add_argument("--min-size", type=int, default=2)
+    ap.add_argument("--max-distinct", type=int, default=200000)
+    ap.add_argument("--json", dest="json_out", help="write the full report to this file")
+    args = ap.parse_args(argv)
+
+    report = cluster_feature_corpus(args.paths, args.threshold, args.min_size, args.max_distinct)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(f"{report['distinct_steps']} distinct steps, {len(report['clusters'])} clusters, "
+          f"{report['reducible_steps']} wordings could be merged")
+    for c in report["clusters"]:
+        print(f"\n[{c['kind']}] {c['pattern']}  ({c['size']} wordings, {c['occurrences']} uses)")
+        for m in c["members"]:
+            print(f"    {m['count']:>5}  {m['text']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,264 @@
+"""
+step_miner.py
+
+Bulk miner that turns existing hand-written behave step modules into mapping-store entries.
+
+Each decorated step function (@given/@when/@then/@step) is AST-parsed into:
+  - the decorator text and kind
+  - the helper calls in evaluation order (class, instance, method, param_map, save_to), including
+    calls nested in expressions, where the receiver is resolved through the module-level / context
+    instantiations (e.g. `rubrik = Rubrik()`)
+  - the plain `context.x = <param>` assignments
+
+The result uses the same {"calls": [...], "assigns": [...]} shape the Wizard saves, so mined
+mappings are suggested by Simulate exactly like manually saved ones. A call argument that names a
+step-local variable built by a statement the chain does not contain (`db_id = output[...]`) cannot
+be regenerated: such steps carry 'unresolved' names and are not loaded into the store.
+
+Usage:
+    python step_miner.py templates/ --helpers templates/rubrik.py templates/mssql_connector.py
+"""
+
+import argparse
+import ast
+import copy
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import parser_utils_V3 as pu
+
+STEP_DECORATORS = ("given", "when", "then", "step")
+STEP_FILE_SUFFIXES = (".py",)
+
+
+def _decorator_step(dec: ast.expr) -> Tuple[str, str]:
+    """Return (kind, pattern) for @given('...') style decorators, else None."""
+    if not (isinstance(dec, ast.Call) and dec.args and isinstance(dec.args[0], ast.Constant)
+            and isinstance(dec.args[0].value, str)):
+        return None
+    func = dec.func
+    name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+    if not name or name.lower() not in STEP_DECORATORS:
+        return None
+    return name.lower(), dec.args[0].value
+
+
+def collect_helper_instances(tree: ast.Module) -> Dict[str, str]:
+    """
+    Build {instance_expr: ClassName} from `x = Cls()` / `context.x = Cls()` assignments anywhere
+    in the module. Only CamelCase constructors are treated as helper classes.
+    """
+    instances = {}
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)
+                and isinstance(node.value.func, ast.Name) and node.value.func.id[:1].isupper()):
+            continue
+        for tgt in node.targets:
+            if isinstance(tgt, (ast.Name, ast.Attribute)):
+                instances[ast.unparse(tgt)] = node.value.func.id
+    return instances
+
+
+class _SavedToContext(ast.NodeTransformer):
+    """Read bare names saved by mined calls from context, where generated steps store them."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Attribute(value=ast.Name(id="context", ctx=ast.Load()), attr=node.id,
+                                                   ctx=ast.Load()), node)
+        return node
+
+
+def _param_map(call: ast.Call, arg_names: List[str], saved: set = frozenset()) -> Dict[str, str]:
+    pmap = {}
+    for i, a in enumerate(call.args):
+        name = arg_names[i] if i < len(arg_names) else f"arg{i}"
+        pmap[name] = ast.unparse(_SavedToContext(saved).visit(copy.deepcopy(a)))
+    for kw in call.keywords:
+        if kw.arg:
+            pmap[kw.arg] = ast.unparse(_SavedToContext(saved).visit(copy.deepcopy(kw.value)))
+    return pmap
+
+
+def _local_reads(expr: ast.AST, local_names: set) -> set:
+    """Step-local names an argument expression reads (names bound inside it, e.g. comprehensions, excluded)."""
+    names = [n for n in ast.walk(expr) if isinstance(n, ast.Name)]
+    bound = {n.id for n in names if not isinstance(n.ctx, ast.Load)}
+    return {n.id for n in names if isinstance(n.ctx, ast.Load)} & local_names - bound
+
+
+def _mine_function(fn: ast.FunctionDef, instances: Dict[str, str],
+                   helpers: Dict[str, Dict[str, List[str]]]) -> Dict[str, Any]:
+    calls, assigns = [], []
+    step_args = {a.arg for a in fn.args.args}
+    body = ast.Module(body=fn.body, type_ignores=[])
+    # a call that is the whole value of `x = call(...)` saves its result to x
+    save_targets = {}
+    for stmt in ast.walk(body):
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.value, ast.Call) \
+                and isinstance(stmt.targets[0], (ast.Name, ast.Attribute)):
+            save_targets[id(stmt.value)] = ast.unparse(stmt.targets[0])
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+            target, value = stmt.targets[0], stmt.value
+            if (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                    and target.value.id == "context" and isinstance(value, ast.Name) and value.id in step_args):
+                assigns.append((stmt.lineno, {"param": value.id, "target": ast.unparse(target)}))
+    # helper calls anywhere in the body: nested in expressions, f-strings, conditions, ...
+    found = []
+    for node in ast.walk(body):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)):
+            continue
+        inst = ast.unparse(node.func.value)
+        cls = instances.get(inst)
+        if not cls:
+            continue
+        found.append((node, cls, inst))
+    # names the body binds itself; an argument may only read those a mined call saved (generated
+    # steps keep them on context), the statements that build any other local are not in the chain
+    local_names = {n.id for n in ast.walk(body) if isinstance(n, ast.Name) and not isinstance(n.ctx, ast.Load)}
+    saved = {save_targets[id(node)] for node, _, _ in found if id(node) in save_targets} & local_names
+    unresolved = set()
+    for node, cls, inst in found:
+        for arg in node.args + [kw.value for kw in node.keywords]:
+            unresolved |= _local_reads(arg, local_names) - step_args - saved
+        method = node.func.attr
+        arg_names = helpers.get(cls, {}).get(method, [])
+        calls.append((node.end_lineno, node.end_col_offset, {
+            "class": cls, "instance": inst, "method": method,
+            "param_map": _param_map(node, arg_names, saved - step_args), "save_to": save_targets.get(id(node), "")}))
+    # evaluation order: a call completes after the calls nested in its arguments
+    calls.sort(key=lambda c: (c[0], c[1]))
+    assigns.sort(key=lambda a: a[0])
+    mapping = {"calls": [c for _, _, c in calls], "assigns": [a for _, a in assigns]}
+    if unresolved:
+        mapping["unresolved"] = sorted(unresolved)
+    return mapping
+
+
+def mine_step_source(source: str, origin: str = "<string>",
+                     helpers: Dict[str, Dict[str, List[str]]] = None) -> List[Dict[str, Any]]:
+    """
+    Mine one step module. Returns a list of
+    {'kind', 'pattern', 'step_text', 'origin', 'mapping': {'calls': [...], 'assigns': [...]}}.
+    'step_text' is the pattern with {param} placeholders rewritten to feature-style <param>.
+    Unparseable sources yield an empty list.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    helpers = helpers or {}
+    instances = collect_helper_instances(tree)
+    mined = []
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for dec in node.decorator_list:
+            step = _decorator_step(dec)
+            if not step:
+                continue
+            kind, pattern = step
+            mapping = _mine_function(node, instances, helpers)
+            mapping.update({"source": "mined", "origin": f"{origin}:{node.lineno}"})
+            mined.append({
+                "kind": kind,
+                "pattern": pattern,
+                "step_text": re.sub(r'\{(\w+)(?::[^}]*)?\}', r'<\1>', pattern),
+                "origin": mapping["origin"],
+                "mapping": mapping,
+            })
+    return mined
+
+
+def _mine_file(args: Tuple[str, Dict[str, Dict[str, List[str]]]]) -> List[Dict[str, Any]]:
+    path, helpers = args
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            return mine_step_source(f.read(), path, helpers)
+    except OSError:
+        return []
+
+
+def find_step_files(paths: List[str]) -> List[str]:
+    """Expand files/directories into a sorted list of step module paths."""
+    found = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, files in os.walk(p):
+                found.extend(os.path.join(root, fn) for fn in files if fn.endswith(STEP_FILE_SUFFIXES))
+        elif os.path.isfile(p):
+            found.append(p)
+    return sorted(set(found))
+
+
+def mine_step_files(paths: List[str], helpers: Dict[str, Dict[str, List[str]]] = None,
+                    max_workers: int = None) -> List[Dict[str, Any]]:
+    """Mine many step modules in parallel (process pool); results keep file order."""
+    files = find_step_files(paths)
+    jobs = [(p, helpers or {}) for p in files]
+    if len(jobs) <= 1 or max_workers == 1:
+        results = [_mine_file(j) for j in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_mine_file, jobs, chunksize=8))
+    return [m for r in results for m in r]
+
+
+def mined_to_store_entries(mined: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Dict[str, Any]],
+                                                                  List[Dict[str, Any]]]:
+    """
+    Collapse mined steps into {normalized step key: mapping}.
+    The first occurrence wins; later occurrences with a different call chain are returned as conflicts.
+    Steps whose calls read unresolved locals are left out and returned as partial
+    ({'key', 'origin', 'unresolved'}). Returns (entries, conflicts, partial).
+    """
+    entries, conflicts, partial = {}, [], []
+    for m in mined:
+        key = pu.make_step_key(m["step_text"])
+        if m["mapping"].get("unresolved"):
+            partial.append({"key": key, "origin": m["origin"], "unresolved": m["mapping"]["unresolved"]})
+            continue
+        if key in entries:
+            if entries[key]["calls"] != m["mapping"]["calls"]:
+                conflicts.append({"key": key, "kept": entries[key]["origin"], "skipped": m["origin"]})
+            continue
+        entries[key] = m["mapping"]
+    return entries, conflicts, partial
+
+
+def load_helper_signatures(paths: List[str]) -> Dict[str, Dict[str, List[str]]]:
+    helpers = {}
+    for p in paths or []:
+        with open(p, "r", encoding="utf-8", errors="ignore") as f:
+            helpers.update(pu.parse_helper_file(f.read()))
+    return helpers
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Mine behave step modules into the mappings store.")
+    ap.add_argument("paths", nargs="+", help="step files or directories")
+    ap.add_argument("--helpers", nargs="*", default=[], help="helper modules used to name call arguments")
+    ap.add_argument("--store", default=pu.MAPPINGS_STORE_FILE, help="mappings store JSON file")
+    ap.add_argument("--overwrite", action="store_true", help="replace mappings that already exist in the store")
+    ap.add_argument("--workers", type=int, default=None)
+    args = ap.parse_args(argv)
+
+    mined = mine_step_files(args.paths, load_helper_signatures(args.helpers), args.workers)
+    entries, conflicts, partial = mined_to_store_entries(mined)
+    added = pu.save_mappings_bulk(entries, args.store, overwrite=args.overwrite)
+    print(f"Mined {len(mined)} step definitions -> {len(entries)} distinct patterns, {added} written to {args.store}")
+    for c in conflicts:
+        print(f"  conflict: '{c['key']}' kept {c['kept']}, skipped {c['skipped']}")
+    for p in partial:
+        print(f"  partial: '{p['key']}' ({p['origin']}) reads locals the chain does not build: "
+              f"{', '.join(p['unresolved'])}; not stored")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
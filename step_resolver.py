@@ -0,0 +1,200 @@
+"""
+step_resolver.py
+
+Deterministic-first step resolution for the main wizard.
+
+Each step goes down a cascade and stops at the first tier whose confidence passes its threshold:
+    1. exact      normalized step key (make_step_key) found in the mapping store
+    2. fuzzy      closest stored key by string similarity (candidates from a token index)
+    3. heuristic  helper method whose name tokens are covered by the step words; step fields fill
+                  the method parameters of the same name, and a call that still misses required
+                  arguments scores below the threshold (llm_utils.validate_calls would reject it)
+    4. llm        only the steps still unresolved are sent to the model, in one batched call
+    5. fallback   if the LLM gave no answer (failed, deadline passed, disabled), the best local
+                  candidate below its threshold is offered instead
+Tiers 1-3 are in-memory lookups built once per feature, so in a mature project most steps never
+reach the LLM. resolve_all() also reports how many steps each tier handled.
+
+Resolutions are dicts: {'tier', 'confidence', 'mapping' (helper chain), 'matched', 'source'};
+fallback resolutions also carry 'fallback_from' (the tier that produced the candidate).
+"""
+
+import re
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import List, Dict, Any, Callable, Tuple
+
+import llm_utils
+import parser_utils_V3 as pu
+
+TIERS = ("exact", "fuzzy", "heuristic", "llm", "fallback")
+DEFAULT_THRESHOLDS = {"exact": 0.0, "fuzzy": 0.85, "heuristic": 0.8, "llm": 0.0}
+LLM_CONFIDENCE = 0.6
+MAX_FUZZY_CANDIDATES = 25
+UNMAPPED_ARGS_PENALTY = 0.9   # heuristic calls missing required args end up this far below the threshold
+
+STOPWORDS = {"a", "an", "the", "to", "of", "for", "in", "on", "is", "be", "and", "with", "from", "by", "<param>"}
+
+
+def _tokens(text: str) -> List[str]:
+    """Lowercased word tokens, snake_case / CamelCase split, trailing plural 's' dropped."""
+    out = []
+    for tok in re.findall(r"[A-Za-z0-9]+", text):
+        for part in re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", tok) or [tok]:
+            part = part.lower()
+            if len(part) > 3 and part.endswith("s") and not part.endswith("ss"):
+                part = part[:-1]
+            out.append(part)
+    return out
+
+
+def _content_tokens(key: str) -> set:
+    return {t for t in _tokens(key.replace("<param>", " ")) if t not in STOPWORDS}
+
+
+def _param_names(spec: Any) -> List[str]:
+    """Parameter names of a helper method spec ([names], [{'name'}], {'args': [...]}); [] when unknown."""
+    args = spec.get("args", []) if isinstance(spec, dict) else spec if isinstance(spec, (list, tuple)) else []
+    names = [a if isinstance(a, str) else a.get("name", "") for a in args]
+    return [n for n in names if n and not n.startswith("*")]
+
+
+class StepResolver:
+    """
+    mappings: mapping-store documents ({'step_pattern', 'helper_chain', 'confidence', 'source', ...})
+    helper_classes: {class_name: [method names]}, {class_name: {method: params}} or typed signatures
+        (parse_helper_file_typed); with parameters the heuristic tier fills and checks arguments
+    thresholds: per-tier minimum confidence, merged over DEFAULT_THRESHOLDS
+    """
+
+    def __init__(self, mappings: List[Dict[str, Any]], helper_classes: Dict[str, Any] = None,
+                 thresholds: Dict[str, float] = None):
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self._exact = {}
+        for m in mappings or []:
+            # first document per key wins, like the JSON store
+            self._exact.setdefault(pu.make_step_key(m.get("step_pattern", "")), m)
+        self._keys = list(self._exact)
+        self._token_index = {}
+        for n, key in enumerate(self._keys):
+            for t in _content_tokens(key):
+                self._token_index.setdefault(t, []).append(n)
+        self._helpers = helper_classes or {}
+        self._methods = []   # (class_name, method_name, method tokens, class tokens)
+        for cls, methods in (helper_classes or {}).items():
+            for meth in methods:
+                toks = set(_tokens(meth)) - STOPWORDS
+                if toks:
+                    self._methods.append((cls, meth, toks, set(_tokens(cls))))
+
+    # ---- tiers ----
+    def exact(self, step_text: str):
+        doc = self._exact.get(pu.make_step_key(step_text))
+        if doc is None:
+            return None
+        return self._store_resolution("exact", doc, float(doc.get("confidence") or 1.0))
+
+    def fuzzy(self, step_text: str):
+        key = pu.make_step_key(step_text)
+        shared = Counter()
+        for t in _content_tokens(key):
+            for n in self._token_index.get(t, ()):
+                shared[n] += 1
+        best, best_score = None, 0.0
+        for n, _ in shared.most_common(MAX_FUZZY_CANDIDATES):
+            score = SequenceMatcher(None, key, self._keys[n], autojunk=False).ratio()
+            if score > best_score:
+                best, best_score = n, score
+        if best is None:
+            return None
+        doc = self._exact[self._keys[best]]
+        return self._store_resolution("fuzzy", doc, best_score * float(doc.get("confidence") or 1.0))
+
+    def heuristic(self, step_text: str):
+        words = set(_tokens(step_text))
+        best, best_score = None, 0.0
+        for cls, meth, toks, cls_toks in self._methods:
+            hits = len(toks & words)
+            if hits < 2 and hits < len(toks):
+                continue
+            # share of the method name the step covers; naming the helper class breaks ties
+            score = min(1.0, hits / len(toks) + (0.05 if cls_toks & words else 0.0))
+            if score > best_score:
+                best, best_score = (cls, meth), score
+        if best is None:
+            return None
+        cls, meth = best
+        methods = self._helpers.get(cls)
+        params = _param_names(methods[meth]) if isinstance(methods, dict) else []
+        # step fields ('<db_name>', "quoted") become step function arguments of the same name
+        fields = {f.lower(): f for f in pu.step_pattern_and_args({"text": step_text})[1]}
+        param_map = {p: fields[p.lower()] for p in params if p.lower() in fields}
+        chain = [{"class_name": cls, "method_name": meth, "param_map": param_map}]
+        _, problems = llm_utils.validate_calls(chain, self._helpers)
+        if problems:
+            # e.g. missing required arguments: not good enough to skip the LLM
+            best_score = min(best_score, self.thresholds["heuristic"]) * UNMAPPED_ARGS_PENALTY
+        res = {"tier": "heuristic", "confidence": round(best_score, 3), "mapping": chain,
+               "matched": f"{cls}.{meth}", "source": "heuristic"}
+        if problems:
+            res["problems"] = problems
+        return res
+
+    def _store_resolution(self, tier: str, doc: Dict[str, Any], confidence: float) -> Dict[str, Any]:
+        return {"tier": tier, "confidence": round(confidence, 3), "mapping": doc.get("helper_chain"),
+                "matched": doc.get("step_pattern"), "source": doc.get("source", "store")}
+
+    # ---- cascade ----
+    def resolve_local(self, step_text: str):
+        """Run the deterministic tiers; the first resolution that meets its threshold wins, else None."""
+        for tier in ("exact", "fuzzy", "heuristic"):
+            res = getattr(self, tier)(step_text)
+            if res is not None and res["confidence"] >= self.thresholds[tier]:
+                return res
+        return None
+
+    def best_local(self, step_text: str):
+        """Highest-confidence local candidate regardless of thresholds, as a 'fallback' resolution."""
+        candidates = [r for r in (self.exact(step_text), self.fuzzy(step_text), self.heuristic(step_text)) if r]
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda r: r["confidence"])
+        return dict(best, tier="fallback", fallback_from=best["tier"])
+
+    def resolve_all(self, step_texts: List[str],
+                    llm_resolver: Callable[[List[str]], Tuple[Dict[int, List[Any]], List[str]]] = None
+                    ) -> Tuple[List[Any], Dict[str, Any]]:
+        """
+        Resolve every step. llm_resolver(texts) -> ({index: calls}, errors) (e.g. a bound
+        llm_utils.batch_map_steps) is only called for the steps the local tiers could not resolve.
+        Returns (resolutions, report); unresolved steps are None.
+        """
+        start = time.perf_counter()
+        resolutions = [self.resolve_local(t) for t in step_texts]
+        local_seconds = time.perf_counter() - start
+        pending = [i for i, r in enumerate(resolutions) if r is None]
+        errors = []
+        llm_seconds = 0.0
+        if pending and llm_resolver is not None:
+            start = time.perf_counter()
+            suggestions, errors = llm_resolver([step_texts[i] for i in pending])
+            llm_seconds = time.perf_counter() - start
+            for n, i in enumerate(pending):
+                calls = suggestions.get(n)
+                if calls and LLM_CONFIDENCE >= self.thresholds["llm"]:
+                    resolutions[i] = {"tier": "llm", "confidence": LLM_CONFIDENCE, "mapping": calls,
+                                      "matched": None, "source": "llm"}
+        for i in pending:
+            if resolutions[i] is None:
+                resolutions[i] = self.best_local(step_texts[i])
+        counts = Counter(r["tier"] if r else "unresolved" for r in resolutions)
+        report = {
+            "steps": len(step_texts),
+            "by_tier": {t: counts.get(t, 0) for t in TIERS + ("unresolved",)},
+            "sent_to_llm": len(pending) if llm_resolver is not None else 0,
+            "local_seconds": round(local_seconds, 6),
+            "llm_seconds": round(llm_seconds, 3),
+            "errors": errors,
+        }
+        return resolutions, report
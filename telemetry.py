@@ -0,0 +1,189 @@
+"""
+telemetry.py
+
+Per-session instrumentation for LLM calls and pipeline stages.
+
+- SessionTelemetry: collects LLM call records, stage timings and how each step was resolved
+  (llm / store / heuristic / ...), with summary() and to_json() for export.
+- InstrumentedModel: wraps any model (genai.GenerativeModel, CachedModel, StubModel) and records
+  prompt bytes, estimated tokens, response bytes, latency, errors and cache hits per call.
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List
+
+import llm_utils
+
+
+class SessionTelemetry:
+    def __init__(self, max_records: int = 5000):
+        self.started = datetime.utcnow().isoformat()
+        self.max_records = max_records
+        self.llm_calls = []        # [{stage, model, prompt_bytes, prompt_tokens, response_bytes, latency, cache_hit, ok, error}]
+        self.stages = []           # [{stage, seconds, at}]
+        self.tasks = []            # executor tasks: [{label, latency, attempts, ok, error}]
+        self.resolutions = Counter()
+        self._lock = threading.Lock()
+
+    def record_llm_call(self, **record) -> None:
+        record.setdefault("at", time.time())
+        with self._lock:
+            self.llm_calls.append(record)
+            del self.llm_calls[:-self.max_records]
+
+    def record_task(self, **record) -> None:
+        """One LLMExecutor task (possibly several attempts)."""
+        with self._lock:
+            self.tasks.append(record)
+            del self.tasks[:-self.max_records]
+
+    def record_resolution(self, source: str, n: int = 1) -> None:
+        """source: which tier resolved a step, e.g. 'llm', 'store', 'heuristic', 'manual', 'unresolved'."""
+        with self._lock:
+            self.resolutions[source] += n
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a pipeline stage: `with telemetry.stage("simulate.llm"): ...`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append({"stage": name, "seconds": time.perf_counter() - start, "at": time.time()})
+                del self.stages[:-self.max_records]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.llm_calls.clear()
+            self.stages.clear()
+            self.tasks.clear()
+            self.resolutions.clear()
+            self.started = datetime.utcnow().isoformat()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = list(self.llm_calls)
+            stages = list(self.stages)
+            tasks = list(self.tasks)
+            resolutions = dict(self.resolutions)
+        live = [c for c in calls if not c.get("cache_hit")]
+        by_stage = {}
+        for s in stages:
+            agg = by_stage.setdefault(s["stage"], {"runs": 0, "seconds": 0.0, "max_seconds": 0.0})
+            agg["runs"] += 1
+            agg["seconds"] += s["seconds"]
+            agg["max_seconds"] = max(agg["max_seconds"], s["seconds"])
+        llm_by_stage = {}
+        for c in calls:
+            agg = llm_by_stage.setdefault(c.get("stage", ""), {"calls": 0, "prompt_tokens": 0, "latency": 0.0})
+            agg["calls"] += 1
+            agg["prompt_tokens"] += c.get("prompt_tokens", 0)
+            agg["latency"] += c.get("latency", 0.0)
+        lat = sorted(c["latency"] for c in live)
+        first = sorted(c["first_chunk_latency"] for c in live if c.get("first_chunk_latency") is not None)
+        return {
+            "since": self.started,
+            "llm": {
+                "calls": len(calls),
+                "cache_hits": len(calls) - len(live),
+                "errors": sum(1 for c in calls if not c.get("ok")),
+                "prompt_bytes": sum(c.get("prompt_bytes", 0) for c in calls),
+                "prompt_tokens": sum(c.get("prompt_tokens", 0) for c in calls),
+                "response_bytes": sum(c.get("response_bytes", 0) for c in calls),
+                "latency_total": sum(lat),
+                "latency_p50": lat[len(lat) // 2] if lat else 0.0,
+                "latency_max": lat[-1] if lat else 0.0,
+                "first_chunk_p50": first[len(first) // 2] if first else None,
+                "cancelled": sum(1 for c in calls if c.get("cancelled")),
+                "by_stage": llm_by_stage,
+                "tasks": len(tasks),
+                "retries": sum(t.get("attempts", 1) - 1 for t in tasks),
+                "failed_tasks": sum(1 for t in tasks if not t.get("ok")),
+            },
+            "stages": by_stage,
+            "step_resolution": resolutions,
+        }
+
+    def to_json(self, include_records: bool = True) -> str:
+        data = {"summary": self.summary()}
+        if include_records:
+            with self._lock:
+                data["llm_calls"] = list(self.llm_calls)
+                data["stages"] = list(self.stages)
+                data["tasks"] = list(self.tasks)
+        return json.dumps(data, indent=2, default=str)
+
+
+class InstrumentedModel:
+    """Record every generate_content call of the wrapped model into a SessionTelemetry."""
+
+    def __init__(self, model, telemetry: SessionTelemetry, stage: str, model_name: str = ""):
+        self.model = model
+        self.telemetry = telemetry
+        self.stage = stage
+        self.model_name = model_name or getattr(model, "model_name", "")
+
+    def generate_content(self, prompt: str, **kwargs):
+        start = time.perf_counter()
+        record = {"stage": self.stage, "model": self.model_name,
+                  "prompt_bytes": len(prompt.encode("utf-8")), "prompt_tokens": llm_utils.estimate_tokens(prompt)}
+        try:
+            resp = self.model.generate_content(prompt, **kwargs)
+        except Exception as e:
+            self.telemetry.record_llm_call(**record, response_bytes=0, latency=time.perf_counter() - start,
+                                           cache_hit=False, ok=False, error=str(e)[:200])
+            raise
+        if kwargs.get("stream"):
+            return self._instrument_stream(resp, record, start)
+        text = getattr(resp, "text", "") or ""
+        self.telemetry.record_llm_call(**record, response_bytes=len(text.encode("utf-8")),
+                                       latency=time.perf_counter() - start,
+                                       cache_hit=bool(getattr(resp, "cached", False)), ok=True, error=None)
+        return resp
+
+    def _instrument_stream(self, chunks, record: Dict[str, Any], start: float):
+        """Record a streamed call once it ends: time to first chunk, total latency, and whether it was cancelled."""
+        size, first, cache_hit, error, completed = 0, None, False, None, False
+        try:
+            for chunk in chunks:
+                if first is None:
+                    first = time.perf_counter() - start
+                    cache_hit = bool(getattr(chunk, "cached", False))
+                size += len(llm_utils.chunk_text(chunk).encode("utf-8"))
+                yield chunk
+            completed = True
+        except Exception as e:
+            error = str(e)[:200]
+            raise
+        finally:
+            self.telemetry.record_llm_call(**record, response_bytes=size, latency=time.perf_counter() - start,
+                                           first_chunk_latency=first, cache_hit=cache_hit, ok=error is None,
+                                           error=error, cancelled=not completed and error is None)
+
+
+def render_sidebar_panel(st, telemetry: SessionTelemetry) -> None:
+    """Streamlit sidebar panel (st is passed in so this module stays importable without streamlit)."""
+    summary = telemetry.summary()
+    with st.sidebar.expander("Telemetry"):
+        l = summary["llm"]
+        st.metric("LLM calls", l["calls"], help=f"{l['cache_hits']} cache hits, {l['errors']} errors, {l['retries']} retries")
+        st.metric("Prompt tokens (est.)", l["prompt_tokens"])
+        st.metric("LLM time (s)", round(l["latency_total"], 2), help=f"p50 {l['latency_p50']:.2f}s, max {l['latency_max']:.2f}s")
+        if l["first_chunk_p50"] is not None:
+            st.metric("Time to first chunk p50 (s)", round(l["first_chunk_p50"], 2), help=f"{l['cancelled']} streams cancelled")
+        if summary["stages"]:
+            st.write("Stages")
+            st.table([{"stage": k, "runs": v["runs"], "seconds": round(v["seconds"], 3), "max": round(v["max_seconds"], 3)}
+                      for k, v in summary["stages"].items()])
+        if summary["step_resolution"]:
+            st.write("Step resolution")
+            st.json(summary["step_resolution"])
+        st.download_button("Export telemetry JSON", telemetry.to_json(), file_name="bdd_wizard_telemetry.json")
+        if st.button("Reset telemetry"):
+            telemetry.reset()
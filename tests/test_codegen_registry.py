@@ -0,0 +1,62 @@
+"""Generated step packages must load into behave's step registry (no AmbiguousStep at import)."""
+import glob
+import os
+
+import pytest
+
+behave = pytest.importorskip("behave")
+from behave.step_registry import StepRegistry  # noqa: E402
+
+import batch_codegen  # noqa: E402
+import parser_utils_V3 as pu  # noqa: E402
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+
+class Step:
+    def __init__(self, step_type, name):
+        self.step_type, self.name = step_type, name
+
+
+def load_steps_package(steps_dir, monkeypatch):
+    """Exec steps/*.py in name order into a fresh registry, as behave's load_step_modules does."""
+    registry = StepRegistry()
+    for step_type in ("given", "when", "then", "step"):
+        monkeypatch.setattr(behave, step_type, registry.make_decorator(step_type))
+    for path in sorted(glob.glob(os.path.join(steps_dir, "*.py"))):
+        with open(path, encoding="utf-8") as f:
+            exec(compile(f.read(), path, "exec"), {"__name__": os.path.basename(path)[:-3]})
+    return registry
+
+
+def test_generated_package_loads_without_ambiguous_steps(tmp_path, monkeypatch):
+    features = sorted(glob.glob(os.path.join(TEMPLATES, "*.feature")))
+    report = batch_codegen.generate_steps_package(features, str(tmp_path), {}, [], [], max_workers=1)
+    registry = load_steps_package(str(tmp_path / "steps"), monkeypatch)
+
+    # JFMN-81: the specific pattern is registered before the general one that would match its text
+    found = registry.find_step_definition(Step("then", "the method returns status true for orders"))
+    assert found.pattern == "the method returns status {table_exists_status} for {table_name}"
+    found = registry.find_step_definition(Step("then", "the method returns status SUCCEEDED"))
+    assert found.pattern == "the method returns status {full_backup_trigger_status}"
+    assert not [c for c in report["conflicts"] if "AmbiguousStep" in c["reason"]]
+
+
+def test_unresolvable_overlap_is_reported_not_generated():
+    steps = [{"kind": "then", "text": "the job returns <status>"},
+             {"kind": "then", "text": "the job returns <status> for <table>"}]
+    impls, report = pu.generate_step_definitions(steps, [[], []], {},
+                                                 registered=[("then", "the job returns {anything}")])
+    assert impls == []
+    assert len(report["conflicts"]) == 2
+
+
+def test_wordings_that_differ_in_case_keep_their_own_definitions(tmp_path, monkeypatch):
+    steps = [{"kind": "given", "text": "the Job is ready"}, {"kind": "given", "text": "the job is ready"}]
+    impls, _ = pu.generate_step_definitions(steps, [[], []], {})
+    assert len(impls) == 2
+    (tmp_path / "steps.py").write_text(pu.build_module([], [], impls), encoding="utf-8")
+    registry = load_steps_package(str(tmp_path), monkeypatch)
+    for text in ("the Job is ready", "the job is ready"):
+        assert registry.find_step_definition(Step("given", text)).pattern == text
+    assert len(pu.generate_step_definitions(steps, [[], []], {}, case_sensitive=False)[0]) == 1
@@ -0,0 +1,296 @@
+"""
+validate_repo.py
+
+Headless, repository-wide version of the Validator tab, for CI.
+
+The tree is walked once and every file is classified:
+  - .feature files
+  - step modules (any .py with @given/@when/@then/@step decorators)
+  - helper modules (any other .py with top-level classes, plus --helpers files)
+Every step module is checked against the typed helper signatures (validate_stepfile_against_helpers);
+a class defined in several helper modules is taken from the module the step file imports it from,
+and collisions that cannot be resolved that way are reported as warnings.
+Every feature is then matched against the step modules behave would load for it
+(match_steps_to_definitions): those in the nearest steps/ directory at or above the feature, else
+the ones next to it, else all of them. Both phases run across a process pool.
+
+Results are cached per file in a JSON file, keyed by the file's content hash plus the hashes of its
+inputs (helper signatures for step modules, step modules for features). A re-run only validates
+files whose content or inputs changed.
+
+Usage:
+    python validate_repo.py . --json report.json --junit report.xml [--helpers helpers/*.py] [--workers 8]
+Exit status is 1 when any file fails (syntax error, helper issue, unmatched step), else 0.
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import llm_utils
+import parser_utils_V3 as pu
+
+CACHE_FILE = ".bdd_validate_cache.json"
+CACHE_VERSION = 4
+SKIP_DIRS = {".git", "__pycache__", ".venv", "venv", "node_modules", ".tox"}
+STEP_DECORATOR_LINE = re.compile(r'^\s*@(?:behave\.)?(?:given|when|then|step)\s*\(', re.M | re.I)
+CLASS_LINE = re.compile(r'^class\s+\w+', re.M)
+
+
+def _read(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def scan_repository(root: str, helper_paths: List[str] = None) -> Dict[str, Dict[str, str]]:
+    """{'features' | 'steps' | 'helpers': {path: source}} for everything under root."""
+    found = {"features": {}, "steps": {}, "helpers": {}}
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for fn in sorted(files):
+            path = os.path.join(dirpath, fn)
+            if fn.endswith(".feature"):
+                found["features"][path] = _read(path)
+            elif fn.endswith(".py"):
+                src = _read(path)
+                if STEP_DECORATOR_LINE.search(src):
+                    found["steps"][path] = src
+                elif CLASS_LINE.search(src):
+                    found["helpers"][path] = src
+    for path in helper_paths or []:
+        found["helpers"][path] = _read(path)
+    return found
+
+
+def _import_affinity(module: str, path: str) -> int:
+    """Trailing dotted components shared by an import and a helper file: 'models.rubrik' vs 'templates/rubrik.py' -> 1."""
+    stem = re.sub(r'(\.py)?(\.txt)?$', "", os.path.normpath(path))
+    file_parts = [p for p in stem.split(os.sep) if p not in ("", ".", "..")]
+    n = 0
+    for a, b in zip(reversed(module.split(".")), reversed(file_parts)):
+        if a != b:
+            break
+        n += 1
+    return n
+
+
+def helpers_for_step_module(src: str, helper_files: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Helper signatures a step module is checked against. A class defined in several helper files is
+    taken from the file the module imports it from ('from models.rubrik import Rubrik'); when that
+    cannot be resolved, the first file (path order) is used and a warning names the collision.
+    Returns (helpers, warnings).
+    """
+    imported = {}
+    for node in ast.walk(ast.parse(src)):
+        if isinstance(node, ast.ImportFrom) and node.module:
+            imported.update((a.asname or a.name, node.module) for a in node.names)
+    defined = {}
+    for path in sorted(helper_files):
+        for cls in helper_files[path]:
+            defined.setdefault(cls, []).append(path)
+    helpers, warnings = {}, []
+    for cls, paths in defined.items():
+        chosen = paths[0]
+        if len(paths) > 1:
+            module = imported.get(cls)
+            affinity = {p: _import_affinity(module, p) for p in paths} if module else {}
+            best = max(affinity.values(), default=0)
+            if best and sum(1 for a in affinity.values() if a == best) == 1:
+                chosen = next(p for p in paths if affinity[p] == best)
+            elif re.search(rf"\b{re.escape(cls)}\b", src):
+                warnings.append(f"class {cls} is defined in {', '.join(paths)}; checked against {chosen}")
+        helpers[cls] = helper_files[chosen][cls]
+    return helpers, warnings
+
+
+def step_scope(feature_path: str, step_paths: List[str], root: str) -> List[str]:
+    """The step modules behave would load for a feature (see module docstring)."""
+    root = os.path.abspath(root)
+    d = os.path.dirname(os.path.abspath(feature_path))
+    by_dir = {}
+    for p in step_paths:
+        by_dir.setdefault(os.path.dirname(os.path.abspath(p)), []).append(p)
+    while True:
+        steps_dir = os.path.join(d, "steps")
+        if steps_dir in by_dir:
+            return by_dir[steps_dir]
+        if d == root or os.path.dirname(d) == d:
+            break
+        d = os.path.dirname(d)
+    return by_dir.get(os.path.dirname(os.path.abspath(feature_path))) or list(step_paths)
+
+
+# -------------------------
+# Jobs (run in worker processes)
+# -------------------------
+def _validate_step_module(job: Tuple[str, str, Dict[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    path, src, helper_files = job
+    result = {"path": path, "type": "steps", "issues": [], "warnings": [], "definitions": []}
+    try:
+        result["definitions"] = pu.extract_step_definitions(src)
+    except SyntaxError as e:
+        result["issues"] = [{"type": "syntax_error", "msg": str(e)}]
+        return result
+    helpers, result["warnings"] = helpers_for_step_module(src, helper_files)
+    result["issues"] = pu.validate_stepfile_against_helpers(src, helpers)
+    return result
+
+
+def _validate_feature(job: Tuple[str, str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+    path, text, definitions = job
+    report = pu.match_steps_to_definitions(pu.expand_feature_steps(text), definitions)
+    return {"path": path, "type": "feature", "unmatched": report["unmatched"], "ambiguous": report["ambiguous"],
+            "used_definitions": sorted({f"{d['file']}:{d['line']}" for d in definitions} -
+                                       {f"{d['file']}:{d['line']}" for d in report["unused"]}),
+            "stats": {k: v for k, v in report["stats"].items() if k != "bad_patterns"}}
+
+
+def _run(fn, jobs: List[Any], max_workers: int = None) -> List[Dict[str, Any]]:
+    if len(jobs) <= 1 or max_workers == 1:
+        return [fn(j) for j in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(fn, jobs, chunksize=4))
+
+
+# -------------------------
+# Driver
+# -------------------------
+def _load_cache(path: str) -> Dict[str, Any]:
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("version") == CACHE_VERSION:
+                return cache["entries"]
+        except (OSError, ValueError, KeyError):
+            pass
+    return {}
+
+
+def _cached_run(fn, keyed_jobs: List[Tuple[str, Any]], cache: Dict[str, Any], fresh: Dict[str, Any],
+                max_workers: int = None) -> Tuple[List[Dict[str, Any]], int]:
+    """Results in job order; only jobs whose key is not cached are run. Returns (results, cache hits)."""
+    todo = [(key, job) for key, job in keyed_jobs if key not in cache]
+    computed = dict(zip((key for key, _ in todo), _run(fn, [job for _, job in todo], max_workers)))
+    results = []
+    for key, _ in keyed_jobs:
+        fresh[key] = cache.get(key) or computed[key]
+        results.append(fresh[key])
+    return results, len(keyed_jobs) - len(todo)
+
+
+def validate_repository(root: str, helper_paths: List[str] = None, cache_path: str = None,
+                        max_workers: int = None) -> Dict[str, Any]:
+    """Validate every feature and step module under root. Returns the JSON report (see main)."""
+    files = scan_repository(root, helper_paths)
+    # per file: two modules may define the same class (each step module gets the one it imports)
+    helper_files = {path: pu.parse_helper_file_typed(src) for path, src in files["helpers"].items()}
+    helpers_hash = llm_utils.fingerprint(helper_files)
+    cache = _load_cache(cache_path)
+    fresh = {}
+
+    step_hashes = {p: _content_hash(src) for p, src in files["steps"].items()}
+    step_jobs = [(llm_utils.fingerprint("steps", p, step_hashes[p], helpers_hash), (p, src, helper_files))
+                 for p, src in sorted(files["steps"].items())]
+    step_results, step_hits = _cached_run(_validate_step_module, step_jobs, cache, fresh, max_workers)
+    definitions = {r["path"]: [dict(d, file=r["path"]) for d in r["definitions"]] for r in step_results}
+
+    feature_jobs = []
+    for p, text in sorted(files["features"].items()):
+        scope = sorted(step_scope(p, list(files["steps"]), root))
+        key = llm_utils.fingerprint("feature", p, _content_hash(text), [step_hashes[s] for s in scope])
+        feature_jobs.append((key, (p, text, [d for s in scope for d in definitions[s]])))
+    feature_results, feature_hits = _cached_run(_validate_feature, feature_jobs, cache, fresh, max_workers)
+
+    # a definition is unused when no feature that loads its module uses it
+    used = {u for r in feature_results for u in r["used_definitions"]}
+    for r in step_results:
+        r["unused"] = [f"{d['function']} (line {d['line']}): {d['pattern']}" for d in r["definitions"]
+                       if f"{r['path']}:{d['line']}" not in used]
+
+    if cache_path:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "entries": fresh}, f)
+    failed = [r["path"] for r in step_results if r["issues"]] + [r["path"] for r in feature_results if r["unmatched"]]
+    return {
+        "summary": {"features": len(feature_results), "step_modules": len(step_results),
+                    "helper_modules": len(files["helpers"]), "failed": len(failed),
+                    "unmatched_steps": sum(len(r["unmatched"]) for r in feature_results),
+                    "ambiguous_steps": sum(len(r["ambiguous"]) for r in feature_results),
+                    "helper_issues": sum(len(r["issues"]) for r in step_results),
+                    "unused_definitions": sum(len(r["unused"]) for r in step_results),
+                    "helper_collisions": sum(len(r.get("warnings", [])) for r in step_results),
+                    "cache_hits": step_hits + feature_hits,
+                    "validated": len(step_jobs) + len(feature_jobs) - step_hits - feature_hits},
+        "step_modules": [{k: v for k, v in r.items() if k != "definitions"} for r in step_results],
+        "features": [{k: v for k, v in r.items() if k != "used_definitions"} for r in feature_results],
+    }
+
+
+def to_junit_xml(report: Dict[str, Any]) -> str:
+    """One testsuite per file type, one testcase per file; problems become <failure>, warnings <system-out>."""
+    suites = ET.Element("testsuites", name="bdd-validate")
+
+    def suite(name, results, problems, warnings):
+        el = ET.SubElement(suites, "testsuite", name=name, tests=str(len(results)),
+                           failures=str(sum(1 for r in results if problems(r))))
+        for r in results:
+            case = ET.SubElement(el, "testcase", classname=name, name=r["path"])
+            bad = problems(r)
+            if bad:
+                failure = ET.SubElement(case, "failure", message=f"{len(bad)} problem(s)")
+                failure.text = "\n".join(bad)
+            notes = warnings(r)
+            if notes:
+                ET.SubElement(case, "system-out").text = "\n".join(notes)
+
+    suite("step_modules", report["step_modules"],
+          lambda r: [f"line {i.get('line', '?')}: {i['type']} {i.get('instance', '')}.{i.get('method', '')} "
+                     f"{i.get('msg', '')}".strip() for i in r["issues"]],
+          lambda r: [f"helpers: {w}" for w in r.get("warnings", [])] + [f"unused: {u}" for u in r["unused"]])
+    suite("features", report["features"],
+          lambda r: [f"line {u['line']}: no step definition for [{u['kind']}] {u['text']}" for u in r["unmatched"]],
+          lambda r: [f"line {a['line']}: ambiguous [{a['kind']}] {a['text']}: {', '.join(a['definitions'])}"
+                     for a in r["ambiguous"]])
+    return ET.tostring(suites, encoding="unicode")
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Validate all features, step modules and helpers in a repository.")
+    ap.add_argument("root", nargs="?", default=".", help="repository root")
+    ap.add_argument("--helpers", nargs="*", default=[], help="extra helper modules (e.g. .py.txt files)")
+    ap.add_argument("--json", dest="json_path", help="write the JSON report here")
+    ap.add_argument("--junit", dest="junit_path", help="write a JUnit XML report here")
+    ap.add_argument("--cache", default=None, help=f"result cache file (default: <root>/{CACHE_FILE})")
+    ap.add_argument("--no-cache", action="store_true")
+    ap.add_argument("--workers", type=int, default=None)
+    args = ap.parse_args(argv)
+
+    cache_path = None if args.no_cache else args.cache or os.path.join(args.root, CACHE_FILE)
+    report = validate_repository(args.root, args.helpers, cache_path, args.workers)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.junit_path:
+        with open(args.junit_path, "w", encoding="utf-8") as f:
+            f.write(to_junit_xml(report))
+    s = report["summary"]
+    print(f"{s['features']} features, {s['step_modules']} step modules, {s['helper_modules']} helper modules: "
+          f"{s['failed']} failing files, {s['unmatched_steps']} unmatched steps, {s['helper_issues']} helper issues "
+          f"({s['validated']} validated, {s['cache_hits']} from cache)")
+    return 1 if s["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -14,29 +14,31 @@ def parse_helper_signatures(helper_text):
             classes[current].append(f.group(1))
     return classes
 
+def _calls_in_tree(tree):
+    calls = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute):
+                call = f"{getattr(func.value, 'id', 'unknown')}.{func.attr}"
+            elif isinstance(func, ast.Name):
+                call = func.id
+            else:
+                call = "unknown"
+            args = [astor.to_source(a).strip() for a in node.args]
+            calls.append((call, args))
+    return calls
+
 def extract_function_calls(step_py):
     """Return list of (class.method, args) from stepfile."""
     calls = []
     try:
-        tree = ast.parse(step_py)
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Call):
-                func = node.func
-                if isinstance(func, ast.Attribute):
-                    call = f"{getattr(func.value, 'id', 'unknown')}.{func.attr}"
-                elif isinstance(func, ast.Name):
-                    call = func.id
-                else:
-                    call = "unknown"
-                args = [astor.to_source(a).strip() for a in node.args]
-                calls.append((call, args))
+        calls = _calls_in_tree(ast.parse(step_py))
     except SyntaxError as e:
         st.error(f"Syntax error parsing step file: {e}")
     return calls
 
-def validate_stepfile(step_py, helpers_dict):
-    """Compare step calls to helper signatures."""
-    calls = extract_function_calls(step_py)
+def _check_calls(calls, helpers_dict):
     results = []
     for call, args in calls:
         valid = False
@@ -49,6 +51,72 @@ def validate_stepfile(step_py, helpers_dict):
         results.append({"call": call, "args": args, "valid": valid})
     return results
 
+def validate_stepfile(step_py, helpers_dict):
+    """Compare step calls to helper signatures."""
+    return _check_calls(extract_function_calls(step_py), helpers_dict)
+
+def split_top_level_blocks(step_py):
+    """
+    Split source into top-level blocks (decorators + def + body, or runs of module-level code)
+    by indentation alone, without parsing. Returns [(first line no, block text)].
+    """
+    blocks, current, start = [], [], 1
+    in_string, is_def, has_header = None, False, False
+    for n, line in enumerate(step_py.splitlines(), 1):
+        top = in_string is None and line[:1] not in ("", " ", "\t", "#", ")", "]", "}")
+        starts_def = top and line.startswith(("@", "def ", "async def ", "class "))
+        # split before a new def/decorator, or before module code following a complete def
+        if top and current and (has_header if is_def else starts_def):
+            blocks.append((start, "\n".join(current)))
+            current, start, is_def, has_header = [], n, False, False
+        if not current:
+            is_def = starts_def
+        if top and line.startswith(("def ", "async def ", "class ")):
+            has_header = True
+        current.append(line)
+        for quote in ('"""', "'''"):
+            if line.count(quote) % 2 and in_string in (None, quote):
+                in_string = quote if in_string is None else None
+    if current:
+        blocks.append((start, "\n".join(current)))
+    return blocks
+
+def validate_stepfile_incremental(step_py, helpers_dict, state=None):
+    """
+    validate_stepfile for repeated edits of the same file. Results are cached per top-level block
+    (keyed by its text), so only blocks that changed since the last call are parsed and checked.
+    Pass the returned state back in on the next call. A block that does not parse is reported in
+    report["syntax_errors"] and does not hide the results of the other blocks.
+    Returns (results, state, report).
+    """
+    helpers_key = repr(sorted((c, sorted(m)) for c, m in helpers_dict.items()))
+    if not state or state.get("helpers_key") != helpers_key:
+        state = {"helpers_key": helpers_key, "blocks": {}}
+    cache = state["blocks"]
+    blocks = {}
+    results, errors, revalidated = [], [], 0
+    for line, text in split_top_level_blocks(step_py):
+        entry = blocks.get(text) or cache.get(text)
+        if entry is None:
+            revalidated += 1
+            try:
+                tree = ast.parse(text)
+            except SyntaxError as e:
+                # line relative to the block: the same block may sit elsewhere in the file next time
+                entry = {"tree": None, "results": [], "error": (e.msg, (e.lineno or 1) - 1)}
+            else:
+                entry = {"tree": tree, "results": _check_calls(_calls_in_tree(tree), helpers_dict), "error": None}
+        blocks[text] = entry
+        results.extend(entry["results"])
+        if entry["error"]:
+            msg, offset = entry["error"]
+            errors.append(f"{msg} (line {line + offset})")
+    # only blocks still present are kept, so the state does not grow with every edit
+    state["blocks"] = blocks
+    report = {"blocks": len(blocks), "revalidated": revalidated, "reused": len(blocks) - revalidated,
+              "syntax_errors": errors}
+    return results, state, report
+
 def validate_decorators(step_py):
     """Check that And/But inherit correct decorator type."""
     lines = step_py.splitlines()